@@ -2,9 +2,11 @@ from flask import Flask, redirect, url_for, request, session, jsonify, render_te
 from config import Config
 from models import db, User, ProcessedEmail, CalendarEvent
 from auth import GoogleOAuth
-from datetime import datetime
+from datetime import datetime, timedelta
+import click
 import json
 import os
+import threading
 
 app = Flask(__name__)
 app.config.from_object(Config)
@@ -30,33 +32,227 @@ db.init_app(app)
 # Create tables
 with app.app_context():
     db.create_all()
+    
+    from migrations import run_migrations
+    run_migrations()
 
 
-# Simple progress tracker
-class ProgressTracker:
-    def __init__(self):
-        self.listeners = []
-        self.current_status = {
-            'stage': 'idle',
-            'progress': 0,
-            'message': 'Ready',
-            'total': 0,
-            'current': 0
-        }
+# Time every DB commit for /metrics
+from metrics import instrument_sessions
+
+instrument_sessions()
+
+
+# Proactive token refresh for scheduled syncs
+from token_refresher import TokenRefresher
+from cost_rollups import CostCompactor
+
+token_refresher = TokenRefresher(
+    app,
+    horizon=timedelta(minutes=Config.TOKEN_REFRESH_HORIZON_MINUTES),
+    interval=Config.TOKEN_REFRESH_INTERVAL_SECONDS,
+    batch_size=Config.TOKEN_REFRESH_BATCH_SIZE,
+    max_per_second=Config.TOKEN_REFRESH_MAX_PER_SECOND,
+    max_expired=timedelta(days=Config.TOKEN_REFRESH_MAX_EXPIRED_DAYS)
+)
+
+cost_compactor = CostCompactor(
+    app,
+    retention=timedelta(days=Config.COST_RETENTION_DAYS),
+    interval=Config.COST_COMPACTION_INTERVAL_SECONDS,
+    batch_size=Config.COST_COMPACTION_BATCH_SIZE
+)
+
+
+@app.cli.command('reencrypt-tokens')
+def reencrypt_tokens_command():
+    """Re-encrypt stored OAuth tokens with the newest ENCRYPTION_KEYS entry"""
+    from models import reencrypt_user_tokens
     
-    def update(self, stage, current, total, message):
-        self.current_status = {
-            'stage': stage,
-            'progress': int((current / total * 100)) if total > 0 else 0,
-            'message': message,
-            'total': total,
-            'current': current
-        }
+    rotated, skipped = reencrypt_user_tokens(batch_size=Config.REENCRYPT_BATCH_SIZE)
+    print(f"Re-encrypted tokens for {rotated} users ({skipped} skipped: no key decrypts them)")
+
+
+def _reencrypt_in_background():
+    with app.app_context():
+        from models import reencrypt_user_tokens
+        try:
+            rotated, skipped = reencrypt_user_tokens(batch_size=Config.REENCRYPT_BATCH_SIZE, pause=1.0)
+            print(f"Background re-encryption done: {rotated} users migrated to the newest key, {skipped} skipped")
+        except Exception as e:
+            print(f"Background re-encryption failed: {e}")
+
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """EXPLAIN the hot queries and fail if any of them stopped using its index"""
+    from migrations import check_query_plans
     
-    def get_status(self):
-        return self.current_status
+    failures = check_query_plans()
+    if failures:
+        raise SystemExit(f"{len(failures)} hot queries are not using their index")
+
+
+# Progress of each sync job, shared with the other app processes
+from progress import create_registry
 
-progress_tracker = ProgressTracker()
+progress_registry = create_registry(
+    app,
+    broker_kind=Config.PROGRESS_BROKER,
+    max_jobs=Config.PROGRESS_MAX_JOBS,
+    ttl=Config.PROGRESS_TTL_SECONDS
+)
+
+
+# Sync jobs run on a local worker pool instead of in the request thread
+from job_queue import SyncWorkerPool
+
+sync_pool = SyncWorkerPool(
+    app,
+    size=Config.SYNC_WORKERS,
+    lease_seconds=Config.SYNC_JOB_LEASE_SECONDS,
+    progress_factory=lambda job: progress_registry.callback_for(job.id)
+)
+
+
+# Background threads are started by whatever serves the app (first request,
+# or `flask run-workers`), never on import, so CLI commands and the debug
+# reloader's watcher process don't claim jobs or refresh tokens.
+_background_started = False
+_background_lock = threading.Lock()
+
+
+def start_background_services(workers=None):
+    """
+    Start the progress relay, metrics snapshots, sync workers, token refresher, cost compactor and re-encryption
+    
+    Idempotent; safe to call from every request.
+    
+    Args:
+        workers (int, optional): Sync worker threads (defaults to Config.SYNC_WORKERS)
+    """
+    global _background_started
+    
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+    
+    progress_registry.broker.start(progress_registry)
+    
+    from metrics import start_snapshots
+    start_snapshots(Config.METRICS_DIR, Config.METRICS_SNAPSHOT_SECONDS)
+    
+    if workers is not None:
+        sync_pool.size = workers
+    if sync_pool.size > 0:
+        sync_pool.start()
+    
+    if Config.TOKEN_REFRESHER_ENABLED:
+        token_refresher.start()
+    
+    if Config.COST_COMPACTION_ENABLED:
+        cost_compactor.start()
+    
+    if Config.REENCRYPT_TOKENS_ON_STARTUP:
+        threading.Thread(target=_reencrypt_in_background, name='token-reencryption', daemon=True).start()
+
+
+@app.before_request
+def _start_background_on_first_request():
+    if Config.BACKGROUND_SERVICES:
+        start_background_services()
+
+
+@app.cli.command('run-scheduler')
+@click.option('--once', is_flag=True, help='Plan and queue one round of syncs, then exit')
+def run_scheduler_command(once):
+    """Queue periodic syncs for every user (run one scheduler per deployment)"""
+    import time
+    from scheduler import SyncScheduler
+    
+    scheduler = SyncScheduler(
+        app,
+        min_interval=timedelta(minutes=Config.SCHEDULER_MIN_INTERVAL_MINUTES),
+        max_interval=timedelta(minutes=Config.SCHEDULER_MAX_INTERVAL_MINUTES),
+        jitter=Config.SCHEDULER_JITTER,
+        max_concurrent=Config.SCHEDULER_MAX_CONCURRENT,
+        tick=Config.SCHEDULER_TICK_SECONDS
+    )
+    if once:
+        scheduler.run_once()
+        print(scheduler.get_metrics()['last_plan'])
+        return
+    
+    scheduler.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        scheduler.stop()
+
+
+@app.cli.command('push-notify')
+@click.argument('email_address')
+@click.argument('history_id', type=int)
+def push_notify_command(email_address, history_id):
+    """Post a Gmail notification to the local /gmail/push webhook (offline stand-in for Pub/Sub)"""
+    from push import pubsub_envelope
+    
+    with app.test_client() as client:
+        response = client.post(f'/gmail/push?token={Config.GMAIL_PUSH_TOKEN}',
+                               json=pubsub_envelope(email_address, history_id))
+    print(f"{response.status_code} {response.get_data(as_text=True)}")
+
+
+@app.cli.command('set-budget')
+@click.argument('email')
+@click.option('--daily', type=float, help='Dollars per UTC day (0 = no cap)')
+@click.option('--monthly', type=float, help='Dollars per month (0 = no cap)')
+@click.option('--default', 'use_default', is_flag=True, help='Go back to the USER_*_DOLLAR_CAP defaults')
+def set_budget_command(email, daily, monthly, use_default):
+    """Set a user's OpenAI dollar caps"""
+    from budget import budget_status
+    
+    user = User.query.filter_by(email=email).first()
+    if user is None:
+        raise click.ClickException(f"No user {email}")
+    if use_default:
+        user.daily_dollar_cap = None
+        user.monthly_dollar_cap = None
+    if daily is not None:
+        user.daily_dollar_cap = daily
+    if monthly is not None:
+        user.monthly_dollar_cap = monthly
+    db.session.commit()
+    print(budget_status(user))
+
+
+@app.cli.command('compact-costs')
+@click.option('--retention-days', type=int, default=None, help='Keep per-sync rows this long (default COST_RETENTION_DAYS)')
+def compact_costs_command(retention_days):
+    """Roll up old syncs' costs and delete their per-sync rows"""
+    days = retention_days if retention_days is not None else Config.COST_RETENTION_DAYS
+    rolled_up, deleted = CostCompactor(app, retention=timedelta(days=days),
+                                       batch_size=Config.COST_COMPACTION_BATCH_SIZE).run_once()
+    print(f"Rolled up {rolled_up} syncs, deleted {deleted} older than {days} days")
+    if days < Config.COST_RETENTION_DAYS:
+        print(f"Note: /costs/timings and /costs/quota read up to COST_RETENTION_DAYS={Config.COST_RETENTION_DAYS} "
+              f"days of per-sync rows; their windows now undercount past {days} days")
+
+
+@app.cli.command('run-workers')
+def run_workers_command():
+    """Run sync workers (and the other background services) in the foreground"""
+    import time
+    
+    start_background_services(workers=max(1, Config.SYNC_WORKERS))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sync_pool.stop()
+        token_refresher.stop()
 
 
 @app.route('/')
@@ -524,6 +720,7 @@ def index():
             
             <script>
                 let eventSource = null;
+                let currentJobId = null;
                 
                 function showStatus(message, type) {
                     const statusDiv = document.getElementById('status');
@@ -557,7 +754,29 @@ def index():
                         eventSource.close();
                     }
                     
-                    eventSource = new EventSource('/sync-progress');
+                    // Queue the sync, then follow its progress
+                    fetch('/sync', {method: 'POST'})
+                        .then(response => response.json())
+                        .then(job => {
+                            if (!job.job_id) {
+                                throw new Error(job.error || 'Could not start sync');
+                            }
+                            currentJobId = job.job_id;
+                            followProgress();
+                        })
+                        .catch(error => {
+                            if (eventSource) eventSource.close();
+                            progressContainer.style.display = 'none';
+                            showStatus('❌ Error starting sync: ' + error.message, 'error');
+                        });
+                }
+                
+                function followProgress() {
+                    const progressContainer = document.getElementById('progressContainer');
+                    const progressFill = document.getElementById('progressFill');
+                    const progressMessage = document.getElementById('progressMessage');
+                    
+                    eventSource = new EventSource('/sync-progress?job_id=' + currentJobId);
 
                     eventSource.onmessage = function(event) {
                         const data = JSON.parse(event.data);
@@ -594,24 +813,22 @@ def index():
                     };
                     
                     eventSource.onerror = function() {
+                        // The browser reconnects on its own and resumes via Last-Event-ID
+                        if (eventSource.readyState === EventSource.CONNECTING) {
+                            progressMessage.textContent = 'Reconnecting...';
+                            return;
+                        }
                         eventSource.close();
                         progressContainer.style.display = 'none';
                         showStatus('❌ Connection error. Please try again.', 'error');
                     };
-                    
-                    // Start the sync
-                    fetch('/sync').catch(error => {
-                        if (eventSource) eventSource.close();
-                        progressContainer.style.display = 'none';
-                        showStatus('❌ Error starting sync: ' + error.message, 'error');
-                    });
                 }
                 
                 function fetchSyncResults() {
                     showStatus('⏳ Finalizing results...', 'loading');
                     
-                    // The sync already completed, just get the last result
-                    fetch('/sync-result')
+                    // The sync already completed, just get its result
+                    fetch('/sync-result?job_id=' + currentJobId)
                         .then(response => response.json())
                         .then(data => {
                             // DEBUG: Log the data to console
@@ -960,77 +1177,224 @@ def index():
         return render_template_string(html)
 
 
-# Store last sync result
-last_sync_result = {}
+def _final_job_status(job_id):
+    """Closing progress status for a job that finished or died, else None"""
+    from models import SyncJob
+    
+    job = db.session.get(SyncJob, job_id)
+    if job is None:
+        return {'stage': 'error', 'progress': 0, 'message': 'Sync job no longer exists',
+                'total': 1, 'current': 0}
+    
+    if job.status in ('complete', 'error'):
+        return {
+            'stage': job.status,
+            'progress': 100 if job.status == 'complete' else 0,
+            'message': job.error_message or 'Sync complete',
+            'total': 1,
+            'current': 1 if job.status == 'complete' else 0
+        }
+    
+    lease_lost = job.status == 'running' and job.lease_expires_at \
+        and job.lease_expires_at < datetime.utcnow()
+    if lease_lost and (job.attempts or 0) >= (job.max_attempts or 1):
+        return {'stage': 'error', 'progress': 0, 'message': 'Sync worker stopped responding',
+                'total': 1, 'current': 0}
+    
+    # Queued, running, or about to be retried by another worker
+    return None
+
 
 @app.route('/sync-progress')
 def sync_progress():
-    """Server-Sent Events endpoint for real-time progress"""
-    def generate():
-        import time
-        last_stage = None
-        last_message = None
-        
-        while True:
-            status = progress_tracker.get_status()
-            
-            # Send updates for rate_limit stage (always) and other stages (when changed)
-            should_send = False
-            
-            if status['stage'] == 'rate_limit':
-                # Always send rate_limit updates (for countdown)
-                should_send = True
-            elif status['stage'] != last_stage or status['message'] != last_message:
-                # Send when stage or message changes
-                should_send = True
-            elif status['stage'] in ['processing', 'extracting', 'adding']:
-                # Always send for these stages (for progress updates)
-                should_send = True
-            
-            if should_send:
-                yield f"data: {json.dumps(status)}\n\n"
-                last_stage = status['stage']
-                last_message = status['message']
-            
-            # Stop streaming when done
-            if status['stage'] in ['complete', 'error']:
-                break
-            
-            # Shorter sleep for rate_limit stage to show countdown
-            if status['stage'] == 'rate_limit':
-                time.sleep(0.1)  # Check more frequently during rate limit
-            else:
-                time.sleep(0.5)
+    """Server-Sent Events endpoint for real-time progress of one sync job"""
+    user = GoogleOAuth.get_current_user()
+    
+    if not user:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    from models import SyncJob
+    from progress import stream_progress, format_event
+    
+    job_id = request.args.get('job_id', type=int)
+    job = SyncJob.query.filter_by(id=job_id, user_id=user.id).first() if job_id else None
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    
+    if job.status in ('complete', 'error') and progress_registry.get_status(job_id) is None:
+        # Finished (and evicted) before the browser connected
+        final = dict(_final_job_status(job_id), seq=1)
+        return Response(format_event(final), mimetype='text/event-stream', headers=headers)
+    
+    # Sent by the browser when it reconnects; resume after that event
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0)
+    except ValueError:
+        last_event_id = 0
+    
+    # Running in another process: have the broker relay its updates here
+    progress_registry.watch(job_id)
+    
+    def check_job():
+        with app.app_context():
+            return _final_job_status(job_id)
     
-    return Response(generate(), mimetype='text/event-stream')
+    stream = stream_progress(
+        progress_registry, job_id,
+        last_event_id=last_event_id,
+        heartbeat=Config.PROGRESS_HEARTBEAT_SECONDS,
+        idle_timeout=Config.PROGRESS_IDLE_TIMEOUT_SECONDS,
+        check_job=check_job
+    )
+    return Response(stream, mimetype='text/event-stream', headers=headers)
 
-@app.route('/sync')
+@app.route('/sync', methods=['GET', 'POST'])
 def run_sync():
-    """Trigger sync with progress tracking"""
+    """Queue a sync for the current user and return its job ID"""
     user = GoogleOAuth.get_current_user()
     
     if not user:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    from sync_worker import SyncWorker
+    from job_queue import enqueue_sync, job_to_dict
     
-    def progress_callback(stage, current, total, message):
-        progress_tracker.update(stage, current, total, message)
+    # Older mail goes through /backfill
+    days = min(max(request.args.get('days', 1, type=int), 1), Config.SYNC_MAX_DAYS)
     
-    worker = SyncWorker(user)
-    results = worker.run_sync(progress_callback=progress_callback)
+    job = enqueue_sync(user.id, params={'days': days})
+    if job.status == 'queued':
+        progress_registry.publish(job.id, 'queued', 0, 1, '[queued] Waiting for a sync worker...', owner=False)
     
-    # Store result for later retrieval
-    global last_sync_result
-    last_sync_result = results
+    return jsonify(job_to_dict(job)), 202
+
+
+@app.route('/skipped')
+def skipped_emails():
+    """Emails the sender stats skipped, newest first"""
+    user = GoogleOAuth.get_current_user()
     
-    return jsonify(results)
+    if not user:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    from sender_stats import skipped_emails_query
+    
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+    rows = skipped_emails_query(user.id).limit(limit).all()
+    return jsonify({'skipped': [{
+        'email_id': row.email_id,
+        'subject': row.email_subject,
+        'sender': row.email_sender,
+        'reason': row.error_message,
+        'skipped_at': row.processed_at.isoformat() if row.processed_at else None
+    } for row in rows]})
+
+
+@app.route('/skipped/recover', methods=['POST'])
+def recover_skipped_emails():
+    """Extract skipped emails after all: all of them, or the given email_ids"""
+    user = GoogleOAuth.get_current_user()
+    
+    if not user:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    from sender_stats import recover_skipped
+    from job_queue import enqueue_sync, job_to_dict
+    
+    options = request.get_json(silent=True) or {}
+    recovered = recover_skipped(user.id, email_ids=options.get('email_ids'))
+    if not recovered:
+        return jsonify({'recovered': 0, 'job': None})
+    
+    # The recovered emails are due retries, so the next sync picks them up
+    job = enqueue_sync(user.id, params={'days': 1})
+    return jsonify({'recovered': recovered, 'job': job_to_dict(job)}), 202
+
+
+@app.route('/backfill', methods=['GET', 'POST'])
+def backfill():
+    """Show the user's backfill (GET) or start one over (POST)"""
+    user = GoogleOAuth.get_current_user()
+    
+    if not user:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    from models import BackfillState
+    from backfill import start_backfill, backfill_to_dict
+    
+    if request.method == 'GET':
+        state = db.session.get(BackfillState, user.id)
+        return jsonify({'backfill': backfill_to_dict(state)})
+    
+    options = request.get_json(silent=True) or {}
+    state = start_backfill(user.id, days=options.get('days'), window_days=options.get('window_days'),
+                           token_budget=options.get('token_budget'),
+                           dollar_budget=options.get('dollar_budget'))
+    return jsonify({'backfill': backfill_to_dict(state)}), 202
+
+
+@app.route('/backfill/pause', methods=['POST'])
+def backfill_pause():
+    """Pause the user's backfill after its current window"""
+    user = GoogleOAuth.get_current_user()
+    
+    if not user:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    from backfill import pause_backfill, backfill_to_dict
+    
+    state = pause_backfill(user.id)
+    if state is None:
+        return jsonify({'error': 'No backfill'}), 404
+    return jsonify({'backfill': backfill_to_dict(state)})
+
+
+@app.route('/backfill/resume', methods=['POST'])
+def backfill_resume():
+    """Resume the user's backfill, optionally with a bigger budget"""
+    user = GoogleOAuth.get_current_user()
+    
+    if not user:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    from backfill import resume_backfill, backfill_to_dict
+    
+    options = request.get_json(silent=True) or {}
+    state = resume_backfill(user.id, token_budget=options.get('token_budget'),
+                            dollar_budget=options.get('dollar_budget'))
+    if state is None:
+        return jsonify({'error': 'No backfill'}), 404
+    return jsonify({'backfill': backfill_to_dict(state)}), 202
 
 
 @app.route('/sync-result')
 def sync_result():
-    """Get the last sync result"""
-    return jsonify(last_sync_result)
+    """Get the result of a sync job (defaults to the user's latest job)"""
+    user = GoogleOAuth.get_current_user()
+    
+    if not user:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    from models import SyncJob
+    from job_queue import job_to_dict
+    
+    job_id = request.args.get('job_id', type=int)
+    query = SyncJob.query.filter_by(user_id=user.id)
+    if job_id:
+        job = query.filter_by(id=job_id).first()
+    else:
+        job = query.order_by(SyncJob.created_at.desc()).first()
+    
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    if job.status != 'complete' or not job.result:
+        return jsonify(job_to_dict(job))
+    
+    results = json.loads(job.result)
+    results.update(job_to_dict(job))
+    return jsonify(results)
 
 @app.route('/login')
 def login():
@@ -1153,17 +1517,17 @@ def test_apis():
         return redirect(url_for('login'))
     
     try:
-        from googleapiclient.discovery import build
+        from google_clients import google_clients
         
         # Get credentials
         credentials = GoogleOAuth.get_credentials(user)
         
         # Test Gmail API
-        gmail_service = build('gmail', 'v1', credentials=credentials)
+        gmail_service = google_clients.build('gmail', 'v1', credentials)
         profile = gmail_service.users().getProfile(userId='me').execute()
         
         # Test Calendar API
-        calendar_service = build('calendar', 'v3', credentials=credentials)
+        calendar_service = google_clients.build('calendar', 'v3', credentials)
         calendars = calendar_service.calendarList().list().execute()
         
         response = {
@@ -1289,31 +1653,59 @@ def clear_events():
 
 @app.route('/costs')
 def view_costs():
-    """View cost tracking for current user"""
+    """
+    View cost tracking for current user
+    
+    Totals come from the daily rollups. recent_syncs is paged newest first:
+    pass the response's next_cursor as ?before= for the next `limit` syncs.
+    """
     user = GoogleOAuth.get_current_user()
     
     if not user:
         return redirect(url_for('login'))
     
-    from models import SyncCost
-    from sqlalchemy import func
+    from cost_tracker import CostTracker
+    
+    limit = min(100, max(1, request.args.get('limit', 20, type=int)))
+    before = None
+    if request.args.get('before'):
+        try:
+            date, sync_id = request.args['before'].rsplit(',', 1)
+            before = (datetime.fromisoformat(date), int(sync_id))
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
     
     # Get recent syncs
-    recent_syncs = SyncCost.query.filter_by(user_id=user.id)\
-        .order_by(SyncCost.sync_date.desc())\
-        .limit(20).all()
+    recent_syncs = CostTracker.recent_syncs_query(user.id, limit=limit, before=before).all()
+    next_cursor = None
+    if len(recent_syncs) == limit:
+        next_cursor = f"{recent_syncs[-1].sync_date.isoformat()},{recent_syncs[-1].id}"
     
     # Calculate totals
-    total_cost = db.session.query(func.sum(SyncCost.total_cost))\
-        .filter_by(user_id=user.id).scalar() or 0
+    total_cost, total_tokens, _ = CostTracker.totals_query(user.id).one()
+    by_model = {
+        model: {'input_tokens': input_tokens or 0, 'output_tokens': output_tokens or 0, 'cost': round(cost or 0, 4)}
+        for model, input_tokens, output_tokens, cost in CostTracker.model_totals_query(user.id).all()
+    }
     
-    total_tokens = db.session.query(
-        func.sum(SyncCost.openai_input_tokens + SyncCost.openai_output_tokens)
-    ).filter_by(user_id=user.id).scalar() or 0
+    # Per-stage latencies of those syncs, in one query
+    timings = {}
+    if recent_syncs:
+        for timing in CostTracker.timings_query([sync.id for sync in recent_syncs]).all():
+            timings.setdefault(timing.sync_cost_id, {})[timing.stage] = {
+                'count': timing.count,
+                'errors': timing.errors,
+                'total_ms': timing.total_ms,
+                'p50_ms': timing.p50_ms,
+                'p95_ms': timing.p95_ms,
+                'max_ms': timing.max_ms
+            }
     
     return jsonify({
-        'total_cost': round(total_cost, 4),
-        'total_tokens': total_tokens,
+        'total_cost': round(total_cost or 0, 4),
+        'total_tokens': total_tokens or 0,
+        'by_model': by_model,
+        'next_cursor': next_cursor,
         'recent_syncs': [{
             'date': sync.sync_date.isoformat(),
             'emails_processed': sync.emails_processed,
@@ -1321,7 +1713,14 @@ def view_costs():
             'input_tokens': sync.openai_input_tokens,
             'output_tokens': sync.openai_output_tokens,
             'cost': round(sync.total_cost, 4),
-            'model': sync.model_used
+            'model': sync.model_used,
+            'gmail_requests': sync.gmail_api_calls,
+            'gmail_quota_units': sync.gmail_quota_units,
+            'gmail_retries': sync.gmail_retries,
+            'calendar_requests': sync.calendar_api_calls,
+            'calendar_retries': sync.calendar_retries,
+            'duration_seconds': round(sync.duration_seconds, 3) if sync.duration_seconds is not None else None,
+            'timings': timings.get(sync.id, {})
         } for sync in recent_syncs]
     })
 
@@ -1334,22 +1733,15 @@ def costs_summary():
     if not user:
         return redirect(url_for('login'))
     
-    from models import SyncCost
-    from sqlalchemy import func
+    from cost_tracker import CostTracker
     from datetime import timedelta
     
-    # Last 30 days
-    thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-    
-    monthly_cost = db.session.query(func.sum(SyncCost.total_cost))\
-        .filter(SyncCost.user_id == user.id)\
-        .filter(SyncCost.sync_date >= thirty_days_ago)\
-        .scalar() or 0
+    # Last 30 days (UTC days, today included)
+    thirty_days_ago = datetime.utcnow().date() - timedelta(days=29)
     
-    monthly_syncs = db.session.query(func.count(SyncCost.id))\
-        .filter(SyncCost.user_id == user.id)\
-        .filter(SyncCost.sync_date >= thirty_days_ago)\
-        .scalar() or 0
+    monthly_cost, _, monthly_syncs = CostTracker.totals_query(user.id, thirty_days_ago).one()
+    monthly_cost = monthly_cost or 0
+    monthly_syncs = monthly_syncs or 0
     
     avg_cost_per_sync = monthly_cost / monthly_syncs if monthly_syncs > 0 else 0
     
@@ -1362,9 +1754,273 @@ def costs_summary():
         'projected_monthly': round(monthly_cost, 2) if monthly_syncs > 0 else 0
     })
 
+@app.route('/costs/timings')
+def costs_timings():
+    """Where the last `days` (default 30, at most COST_RETENTION_DAYS) of syncs spent their time, per stage"""
+    user = GoogleOAuth.get_current_user()
+    
+    if not user:
+        return redirect(url_for('login'))
+    
+    from cost_tracker import CostTracker
+    from cost_rollups import raw_cost_days
+    from datetime import timedelta
+    
+    days = max(1, request.args.get('days', 30, type=int))
+    days_counted = raw_cost_days(days)
+    since = datetime.utcnow() - timedelta(days=days_counted)
+    
+    stages = {}
+    for stage, syncs, calls, errors, total_ms, p95_ms, max_ms in \
+            CostTracker.stage_totals_since_query(user.id, since).all():
+        stages[stage] = {
+            'syncs': syncs,
+            'count': calls or 0,
+            'errors': errors or 0,
+            'total_ms': round(total_ms or 0.0, 2),
+            'avg_ms': round((total_ms or 0.0) / calls, 2) if calls else None,
+            'worst_p95_ms': p95_ms,
+            'max_ms': max_ms
+        }
+    
+    return jsonify({'days': days, 'days_counted': days_counted, 'since': since.isoformat(), 'stages': stages})
+
+@app.route('/costs/quota')
+def costs_quota():
+    """The current user's Google API quota use over the last `days` (default 7), projected forward"""
+    user = GoogleOAuth.get_current_user()
+    
+    if not user:
+        return redirect(url_for('login'))
+    
+    from cost_tracker import project_quota
+    
+    days = max(1, request.args.get('days', 7, type=int))
+    return jsonify(project_quota(user.id, days=days))
+
+
+@app.route('/costs/quota/deployment')
+def costs_quota_deployment():
+    """Google API quota use of every user's syncs, and the headroom left (internal only)"""
+    if not _is_internal_request():
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    from cost_tracker import project_quota
+    
+    days = max(1, request.args.get('days', 7, type=int))
+    return jsonify(project_quota(days=days))
+
+
+@app.route('/costs/budget')
+def costs_budget():
+    """The current user's dollar caps and spend this day and month"""
+    user = GoogleOAuth.get_current_user()
+    
+    if not user:
+        return redirect(url_for('login'))
+    
+    from budget import budget_status
+    
+    return jsonify(budget_status(user))
+
+
+def _is_internal_request():
+    """
+    True for operator/monitoring requests
+    
+    With INTERNAL_API_TOKEN set, the request must carry it as a bearer token.
+    Otherwise only requests from the local machine are allowed.
+    """
+    if Config.INTERNAL_API_TOKEN:
+        import hmac
+        supplied = request.headers.get('Authorization', '')
+        return hmac.compare_digest(supplied, f"Bearer {Config.INTERNAL_API_TOKEN}")
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+
+@app.route('/token-refresher/metrics')
+def token_refresher_metrics():
+    """Refresh latency and failure counts for the background token refresher (internal only)"""
+    if not _is_internal_request():
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    return jsonify(token_refresher.get_metrics())
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus text exposition of the sync pipeline, across this host's app processes (internal only)"""
+    if not _is_internal_request():
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    from metrics import REGISTRY, MetricsRegistry, Gauge
+    from models import SyncJob, EmailRetry
+    from job_queue import ACTIVE_STATUSES
+    from sqlalchemy import func
+    
+    # Queue depths are read from the DB now, not aggregated across processes
+    queues = MetricsRegistry()
+    jobs = Gauge('sift_sync_jobs', 'Queued and running sync jobs', ('kind', 'status'), registry=queues)
+    for kind, status, count in db.session.query(SyncJob.kind, SyncJob.status, func.count(SyncJob.id))\
+            .filter(SyncJob.status.in_(ACTIVE_STATUSES)).group_by(SyncJob.kind, SyncJob.status).all():
+        jobs.set(count, kind, status)
+    retries = Gauge('sift_email_retries_queued', 'Emails waiting in the retry queue', registry=queues)
+    retries.set(db.session.query(func.count(EmailRetry.id)).scalar() or 0)
+    
+    body = REGISTRY.render(Config.METRICS_DIR, Config.METRICS_SNAPSHOT_SECONDS) + queues.render()
+    return Response(body, mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/gmail/push', methods=['POST'])
+def gmail_push():
+    """
+    Pub/Sub push endpoint for Gmail watch notifications
+    
+    The subscription's push URL carries GMAIL_PUSH_TOKEN as ?token=. Any 2xx
+    acks the message, so unknown mailboxes are acked too; Pub/Sub retries
+    anything else.
+    """
+    import hmac
+    
+    token = request.args.get('token', '')
+    if not Config.GMAIL_PUSH_TOKEN or not hmac.compare_digest(token, Config.GMAIL_PUSH_TOKEN):
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    from push import parse_pubsub_envelope, handle_notification
+    
+    try:
+        email_address, history_id = parse_pubsub_envelope(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    handle_notification(email_address, history_id)
+    return '', 204
+
+
+@app.route('/gmail/watch', methods=['GET', 'POST', 'DELETE'])
+def gmail_watch():
+    """Show (GET), start or renew (POST) or stop (DELETE) push syncs for the current user"""
+    user = GoogleOAuth.get_current_user()
+    
+    if not user:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    from models import GmailWatch
+    from push import register_watch, unregister_watch
+    
+    if request.method == 'DELETE':
+        return jsonify({'stopped': unregister_watch(user)})
+    
+    if request.method == 'POST':
+        if not Config.GMAIL_PUSH_TOPIC:
+            return jsonify({'error': 'Push sync is not configured (GMAIL_PUSH_TOPIC)'}), 400
+        try:
+            register_watch(user)
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({'error': f'Could not watch mailbox: {e}'}), 502
+    
+    watch = db.session.get(GmailWatch, user.id)
+    if watch is None:
+        return jsonify({'watch': None})
+    return jsonify({'watch': {
+        'topic': watch.topic,
+        'expiration': watch.expiration.isoformat() if watch.expiration else None,
+        'history_id': watch.history_id,
+        'pending_since': watch.pending_since.isoformat() if watch.pending_since else None,
+        'notifications': watch.notifications,
+        'last_delay_seconds': watch.last_delay_seconds
+    }})
+
+
+@app.route('/push/metrics')
+def push_metrics():
+    """Notification-to-event delay of recent push syncs, and watch counts (internal only)"""
+    if not _is_internal_request():
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    from push import push_metrics as collect_push_metrics
+    
+    return jsonify(collect_push_metrics())
+
+
+@app.route('/feed-url')
+def feed_url():
+    """Get (or create) the secret ICS feed URL for the current user"""
+    user = GoogleOAuth.get_current_user()
+    
+    if not user:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    from ics_feed import get_or_create_feed
+    
+    feed = get_or_create_feed(user)
+    
+    return jsonify({
+        'feed_url': url_for('ics_feed', token=feed.token, _external=True),
+        'created_at': feed.created_at.isoformat() if feed.created_at else None
+    })
+
+
+@app.route('/feed-url/rotate', methods=['POST'])
+def rotate_feed_url():
+    """Replace the ICS feed token so the old URL stops working"""
+    user = GoogleOAuth.get_current_user()
+    
+    if not user:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    from ics_feed import rotate_feed_token
+    
+    feed = rotate_feed_token(user)
+    
+    return jsonify({
+        'feed_url': url_for('ics_feed', token=feed.token, _external=True)
+    })
+
+
+@app.route('/feed/<token>.ics')
+def ics_feed(token):
+    """Subscribable ICS feed rendered from the local CalendarEvent store"""
+    from models import CalendarFeed
+    from ics_feed import feed_cache
+    
+    feed = CalendarFeed.query.filter_by(token=token).first()
+    if not feed:
+        return "Not found", 404
+    
+    window_start = feed_cache.window_start()
+    base_etag = feed_cache.fingerprint(feed.user_id, window_start)
+    
+    # gzip is a separate representation, so it gets its own strong ETag
+    use_gzip = 'gzip' in request.accept_encodings
+    etag = base_etag + '-gz' if use_gzip else base_etag
+    
+    # Cheap 304: answered from the aggregate query alone
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        rendered = feed_cache.get(feed.user_id, base_etag)
+        if not rendered:
+            rendered = feed_cache.render(feed.user_id, base_etag, window_start)
+        
+        body = rendered.gzipped() if use_gzip else rendered.body
+        response = Response(body, mimetype='text/calendar')
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+    
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
 @app.after_request
 def add_header(response):
     """Prevent caching during development"""
+    # Routes that manage their own caching (e.g. the ICS feed) keep their headers
+    if 'Cache-Control' in response.headers:
+        return response
     response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '0'
@@ -1,6 +1,4 @@
 from google_auth_oauthlib.flow import Flow
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
 from flask import session, redirect, url_for, request
 from config import Config
 from models import db, User
@@ -73,14 +71,14 @@ class GoogleOAuth:
         credentials = flow.credentials
         
         # Get user info from Google using People API
-        from googleapiclient.discovery import build
+        from google_clients import google_clients
 
         # First, make sure we have valid credentials
         if not credentials or not credentials.token:
             raise ValueError("Failed to obtain credentials from Google")
 
         # Build the oauth2 service with the credentials
-        oauth2_service = build('oauth2', 'v2', credentials=credentials)
+        oauth2_service = google_clients.build('oauth2', 'v2', credentials)
 
         # Get user info
         try:
@@ -108,6 +106,10 @@ class GoogleOAuth:
         
         db.session.commit()
         
+        # Drop any credentials cached from the previous tokens
+        from credential_cache import credential_cache
+        credential_cache.invalidate(user.id)
+        
         # Store user ID in session
         session['user_id'] = user.id
         
@@ -118,31 +120,18 @@ class GoogleOAuth:
         """
         Get valid credentials for a user, refreshing if necessary
         
+        Credentials come from the process-wide cache, so tokens are decrypted
+        once per user and refreshed at most once, ahead of token_expiry.
+        
         Args:
             user: User object
             
         Returns:
             Credentials object
         """
-        credentials = Credentials(
-            token=user.get_access_token(),
-            refresh_token=user.get_refresh_token(),
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=Config.GOOGLE_CLIENT_ID,
-            client_secret=Config.GOOGLE_CLIENT_SECRET,
-            scopes=Config.SCOPES
-        )
-        
-        # Refresh if expired
-        if credentials.expired and credentials.refresh_token:
-            credentials.refresh(Request())
-            
-            # Update stored tokens
-            user.set_access_token(credentials.token)
-            user.token_expiry = credentials.expiry
-            db.session.commit()
+        from credential_cache import credential_cache
         
-        return credentials
+        return credential_cache.get(user)
     
     @staticmethod
     def get_current_user():
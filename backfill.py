@@ -0,0 +1,209 @@
+from models import db, BackfillState
+from job_queue import enqueue_sync
+from config import Config
+from datetime import datetime, timedelta
+
+
+# Backfill windows run after live and scheduled syncs
+BACKFILL_PRIORITY = -2
+
+
+def start_backfill(user_id, days=None, window_days=None, token_budget=None, dollar_budget=None):
+    """
+    Start (or restart) a user's backfill and queue its first window
+
+    Args:
+        days (int): How far back to go (capped at Config.BACKFILL_MAX_DAYS)
+        window_days (int): Days of mail per window
+        token_budget (int): OpenAI tokens the whole backfill may use
+        dollar_budget (float): Dollars the whole backfill may spend
+
+    Returns:
+        BackfillState
+    """
+    now = datetime.utcnow()
+    days = min(days or Config.BACKFILL_MAX_DAYS, Config.BACKFILL_MAX_DAYS)
+
+    state = db.session.get(BackfillState, user_id)
+    if state is None:
+        state = BackfillState(user_id=user_id, created_at=now)
+        db.session.add(state)
+
+    state.status = 'running'
+    state.oldest = now - timedelta(days=days)
+    state.cursor = now
+    state.window_days = max(1, window_days or Config.BACKFILL_WINDOW_DAYS)
+    state.token_budget = token_budget if token_budget is not None else Config.BACKFILL_TOKEN_BUDGET
+    state.dollar_budget = dollar_budget if dollar_budget is not None else Config.BACKFILL_DOLLAR_BUDGET
+    state.tokens_used = 0
+    state.cost_used = 0.0
+    state.windows_done = 0
+    state.emails_processed = 0
+    state.events_added = 0
+    state.last_error = None
+    state.updated_at = now
+    db.session.commit()
+
+    queue_next_window(user_id)
+    return state
+
+
+def pause_backfill(user_id):
+    """
+    Stop a running backfill after its current window
+
+    Returns:
+        BackfillState or None
+    """
+    state = db.session.get(BackfillState, user_id)
+    if state is not None and state.status == 'running':
+        state.status = 'paused'
+        state.updated_at = datetime.utcnow()
+        db.session.commit()
+    return state
+
+
+def resume_backfill(user_id, token_budget=None, dollar_budget=None):
+    """
+    Continue a paused, failed or out-of-budget backfill where it stopped
+
+    Args:
+        token_budget (int, optional): New total token budget
+        dollar_budget (float, optional): New total dollar budget
+
+    Returns:
+        BackfillState or None
+    """
+    state = db.session.get(BackfillState, user_id)
+    if state is None or state.status == 'complete':
+        return state
+
+    if token_budget is not None:
+        state.token_budget = token_budget
+    if dollar_budget is not None:
+        state.dollar_budget = dollar_budget
+    state.status = 'running'
+    state.last_error = None
+    state.updated_at = datetime.utcnow()
+    db.session.commit()
+
+    queue_next_window(user_id)
+    return state
+
+
+def queue_next_window(user_id):
+    """Queue the backfill's next window if it's still running"""
+    state = db.session.get(BackfillState, user_id)
+    if state is None or state.status != 'running':
+        return None
+    return enqueue_sync(user_id, kind='backfill', priority=BACKFILL_PRIORITY)
+
+
+def next_window(state):
+    """(after, before) for the state's next window"""
+    after = max(state.cursor - timedelta(days=state.window_days), state.oldest)
+    return after, state.cursor
+
+
+def remaining_budget(state):
+    """What's left of the backfill's budget, as a SyncWorker budget dict"""
+    budget = {}
+    if state.token_budget is not None:
+        budget['tokens'] = state.token_budget - (state.tokens_used or 0)
+    if state.dollar_budget is not None:
+        budget['dollars'] = state.dollar_budget - (state.cost_used or 0.0)
+    return budget
+
+
+def run_backfill_window(make_worker, user, job_id=None, cancel=None, progress_callback=None):
+    """
+    Sync the user's next backfill window and move the cursor back
+
+    Windows run serially (one email at a time), so the budget check before
+    each email is exact. A window whose listing hit
+    BACKFILL_MAX_EMAILS_PER_WINDOW may have been cut short, so it is
+    re-run at half the size instead of being skipped past; already processed
+    emails cost nothing the second time.
+
+    Args:
+        make_worker: callable(user, **kwargs) -> SyncWorker
+
+    Returns:
+        dict: run_sync results plus 'backfill' (the state after this window)
+    """
+    state = db.session.get(BackfillState, user.id)
+    if state is None or state.status != 'running':
+        # Paused (or restarted) after this job was queued
+        return {'backfill': backfill_to_dict(state), 'skipped': True}
+
+    budget = remaining_budget(state)
+    if any(left <= 0 for left in budget.values()):
+        state.status = 'budget_exhausted'
+        state.updated_at = datetime.utcnow()
+        db.session.commit()
+        return {'backfill': backfill_to_dict(state), 'skipped': True}
+
+    after, before = next_window(state)
+    print(f"Backfilling {user.email}: {after:%Y-%m-%d} to {before:%Y-%m-%d}")
+
+    worker = make_worker(user, cancel=cancel, job_id=job_id, budget=budget, pipeline=False)
+    results = worker.run_sync(progress_callback=progress_callback, after=after, before=before)
+
+    if cancel is not None and cancel.is_set():
+        # The job goes back to the queue and resumes from its checkpoint,
+        # whose costs already include this attempt's
+        return results
+
+    # Pick up a pause that happened during the window
+    db.session.refresh(state)
+
+    costs = results.get('costs') or {}
+    state.tokens_used = (state.tokens_used or 0) + costs.get('openai_input_tokens', 0) + costs.get('openai_output_tokens', 0)
+    state.cost_used = (state.cost_used or 0.0) + costs.get('total_cost', 0.0)
+    state.emails_processed = (state.emails_processed or 0) + results.get('emails_processed', 0)
+    state.events_added = (state.events_added or 0) + results.get('events_added', 0)
+
+    if not results.get('completed'):
+        # The window failed as a whole; keep the cursor so a resume retries it
+        state.status = 'error'
+        state.last_error = results['errors'][-1] if results.get('errors') else 'Backfill window failed'
+    elif results.get('budget_exhausted'):
+        state.status = 'budget_exhausted'
+    elif results.get('emails_listed', 0) >= Config.BACKFILL_MAX_EMAILS_PER_WINDOW and state.window_days > 1:
+        state.window_days = max(1, state.window_days // 2)
+    else:
+        state.cursor = after
+        state.windows_done = (state.windows_done or 0) + 1
+        if state.cursor <= state.oldest and state.status == 'running':
+            state.status = 'complete'
+
+    state.updated_at = datetime.utcnow()
+    db.session.commit()
+
+    results['backfill'] = backfill_to_dict(state)
+    return results
+
+
+def backfill_to_dict(state):
+    """Public view of a backfill for the API"""
+    if state is None:
+        return None
+
+    budget = remaining_budget(state)
+    return {
+        'status': state.status,
+        'oldest': state.oldest.isoformat(),
+        'cursor': state.cursor.isoformat(),
+        'window_days': state.window_days,
+        'windows_done': state.windows_done,
+        'emails_processed': state.emails_processed,
+        'events_added': state.events_added,
+        'tokens_used': state.tokens_used,
+        'cost_used': round(state.cost_used or 0.0, 4),
+        'token_budget': state.token_budget,
+        'dollar_budget': state.dollar_budget,
+        'tokens_left': budget.get('tokens'),
+        'dollars_left': round(budget['dollars'], 4) if 'dollars' in budget else None,
+        'last_error': state.last_error,
+        'updated_at': state.updated_at.isoformat() if state.updated_at else None
+    }
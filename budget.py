@@ -0,0 +1,262 @@
+from cost_tracker import CostTracker
+from config import Config
+from datetime import datetime, timedelta
+import threading
+import time
+
+
+def period_starts(now):
+    """(start of the UTC day, start of the month) containing `now`"""
+    day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return day_start, day_start.replace(day=1)
+
+
+def next_reset(period, now):
+    """When the spend of the daily or monthly period containing `now` starts over"""
+    day_start, month_start = period_starts(now)
+    if period == 'daily':
+        return day_start + timedelta(days=1)
+    return (month_start + timedelta(days=32)).replace(day=1)
+
+
+def user_caps(user):
+    """A user's (daily, monthly) dollar caps: their own, else the Config defaults (0 = no cap)"""
+    daily = user.daily_dollar_cap if user.daily_dollar_cap is not None else Config.USER_DAILY_DOLLAR_CAP
+    monthly = user.monthly_dollar_cap if user.monthly_dollar_cap is not None else Config.USER_MONTHLY_DOLLAR_CAP
+    return daily or 0.0, monthly or 0.0
+
+
+class BudgetPlan:
+    """What to do with one email, and the spend reserved for it"""
+
+    __slots__ = ('mode', 'cheap', 'estimated_tokens', 'reserved', 'reason', 'retry_at')
+
+    def __init__(self, mode, cheap=False, estimated_tokens=0, reserved=0.0, reason=None, retry_at=None):
+        self.mode = mode  # 'full', 'cheap', 'skip' or 'defer'
+        self.cheap = cheap
+        self.estimated_tokens = estimated_tokens
+        self.reserved = reserved
+        self.reason = reason
+        self.retry_at = retry_at
+
+    @property
+    def extract(self):
+        return self.mode in ('full', 'cheap')
+
+
+class BudgetGuard:
+    """
+    Daily and monthly dollar caps on OpenAI spend, checked before every extraction
+
+    There are caps per user (User.daily_dollar_cap / monthly_dollar_cap,
+    defaulting to Config.USER_*_DOLLAR_CAP) and for the whole deployment
+    (Config.DEPLOYMENT_*_DOLLAR_CAP). Spend is what CostRollup has for the
+    current UTC day and month, plus this sync's cost so far, plus what's
+    reserved for extractions in flight, plus the estimated cost of the
+    call being planned (prompt tokens counted locally, see token_estimator,
+    and BUDGET_OUTPUT_TOKENS of output).
+
+    Under BUDGET_DEGRADE_AT of every cap the email is extracted normally.
+    Past it, the cheap deployment is used if there is one; if not, only
+    emails scoring at least BUDGET_HEURISTIC_MIN_SCORE (email_priority) and
+    queued retries are extracted, and the rest are recorded as skipped
+    (recoverable from /skipped). Mail that would take any cap over is
+    deferred to the retry queue until that cap resets.
+
+    The saved spend is loaded by refresh(), in the sync's thread; plan()
+    and release() may be called from the pipeline's threads. A plan is
+    counted in the summary when it's released (extracted) or held (skipped
+    or deferred), so one the caller drops and plans again isn't. Other syncs'
+    unsaved spend isn't seen, so the deployment caps can be overshot by
+    what the syncs running at the same time spend.
+
+    Args:
+        user: User whose sync this is
+        tracker (CostTracker): The sync's costs so far
+        model (str): Model of the regular deployment
+        cheap_model (str, optional): Model of the cheap deployment; None if there's none
+    """
+
+    def __init__(self, user, tracker, model, cheap_model=None):
+        self.user_id = user.id
+        self.tracker = tracker
+        self.model = model
+        self.cheap_model = cheap_model
+        self.degrade_at = Config.BUDGET_DEGRADE_AT
+        self.min_score = Config.BUDGET_HEURISTIC_MIN_SCORE
+        self.output_tokens = Config.BUDGET_OUTPUT_TOKENS
+
+        daily, monthly = user_caps(user)
+        self.caps = [cap for cap in (
+            {'scope': 'user', 'period': 'daily', 'limit': daily},
+            {'scope': 'user', 'period': 'monthly', 'limit': monthly},
+            {'scope': 'deployment', 'period': 'daily', 'limit': Config.DEPLOYMENT_DAILY_DOLLAR_CAP},
+            {'scope': 'deployment', 'period': 'monthly', 'limit': Config.DEPLOYMENT_MONTHLY_DOLLAR_CAP}
+        ) if cap['limit'] > 0]
+        for cap in self.caps:
+            cap['spent'] = 0.0
+
+        self._reserved = 0.0
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+        self.modes = {'full': 0, 'cheap': 0, 'skip': 0, 'defer': 0}
+        self.estimated_tokens = 0
+        self.actual_tokens = 0
+
+    @classmethod
+    def for_user(cls, user, tracker):
+        """A guard with the spend loaded, or None if no cap applies to the user"""
+        guard = cls(user, tracker, Config.AZURE_OPENAI_MODEL,
+                    Config.AZURE_OPENAI_CHEAP_MODEL if Config.AZURE_OPENAI_CHEAP_DEPLOYMENT else None)
+        if not guard.caps:
+            return None
+        guard.refresh()
+        return guard
+
+    def refresh(self, now=None):
+        """Load the saved spend of the current day and month (one query per scope)"""
+        now = now or datetime.utcnow()
+        self._refreshed_at = time.monotonic()
+        day_start, month_start = period_starts(now)
+        spend = {}
+        for scope in {cap['scope'] for cap in self.caps}:
+            user_id = self.user_id if scope == 'user' else None
+            daily, monthly = CostTracker.spend_query(day_start.date(), month_start.date(), user_id).one()
+            spend[scope] = {'daily': daily or 0.0, 'monthly': monthly or 0.0}
+        with self._lock:
+            for cap in self.caps:
+                cap['spent'] = spend[cap['scope']][cap['period']]
+                cap['resets_at'] = next_reset(cap['period'], now)
+
+    def refresh_if_stale(self):
+        """refresh() if the spend is BUDGET_REFRESH_SECONDS old, to see other syncs' saved costs"""
+        if time.monotonic() - self._refreshed_at >= Config.BUDGET_REFRESH_SECONDS:
+            self.refresh()
+
+    def _committed(self):
+        return self.tracker.calculate_total_cost() + self._reserved
+
+    def _fits(self, cost, fraction, committed):
+        """The cap that `cost` would take past `fraction` of its limit, or None if it fits them all"""
+        for cap in self.caps:
+            if cap['spent'] + committed + cost > cap['limit'] * fraction:
+                return cap
+        return None
+
+    def plan(self, estimated_tokens, score=None, forced=False):
+        """
+        Decide how to handle an email, reserving its estimated cost if it's extracted
+
+        Args:
+            estimated_tokens (int): Prompt tokens of the extraction
+            score (float, optional): email_priority score, for heuristics-only mode
+            forced (bool): A queued retry, extracted in heuristics-only mode regardless of score
+
+        Returns:
+            BudgetPlan
+        """
+        full_cost = CostTracker.price(self.model, estimated_tokens, self.output_tokens)
+        cheap_cost = CostTracker.price(self.cheap_model, estimated_tokens, self.output_tokens) \
+            if self.cheap_model else None
+
+        with self._lock:
+            committed = self._committed()
+            over = self._fits(full_cost, self.degrade_at, committed)
+            if over is None:
+                plan = BudgetPlan('full', estimated_tokens=estimated_tokens, reserved=full_cost)
+            elif cheap_cost is not None and self._fits(cheap_cost, 1.0, committed) is None:
+                plan = BudgetPlan('cheap', cheap=True, estimated_tokens=estimated_tokens, reserved=cheap_cost,
+                                  reason=self._describe(over, 'near'))
+            elif cheap_cost is None and self._fits(full_cost, 1.0, committed) is None:
+                if forced or (score is not None and score >= self.min_score):
+                    plan = BudgetPlan('full', estimated_tokens=estimated_tokens, reserved=full_cost,
+                                      reason=self._describe(over, 'near'))
+                else:
+                    plan = BudgetPlan('skip', estimated_tokens=estimated_tokens, reason=self._describe(over, 'near'))
+            else:
+                over = self._fits(cheap_cost if cheap_cost is not None else full_cost, 1.0, committed)
+                plan = BudgetPlan('defer', estimated_tokens=estimated_tokens, reason=self._describe(over, 'at'),
+                                  retry_at=over['resets_at'])
+
+            self._reserved += plan.reserved
+        return plan
+
+    def defer_all(self):
+        """A 'defer' plan for an email that wasn't fetched, once the caps are exhausted"""
+        with self._lock:
+            over = self._fits(0.0, 1.0, self._committed())
+        if over is None:
+            return None
+        return BudgetPlan('defer', reason=self._describe(over, 'at'), retry_at=over['resets_at'])
+
+    def release(self, plan, token_usage=None):
+        """Drop an extraction's reservation once its actual usage is in the tracker"""
+        with self._lock:
+            self._reserved -= plan.reserved
+            plan.reserved = 0.0
+            self.modes[plan.mode] += 1
+            self.estimated_tokens += plan.estimated_tokens
+            if token_usage:
+                self.actual_tokens += token_usage.get('input_tokens', 0)
+
+    def hold(self, plan):
+        """Count an email that was skipped or deferred"""
+        with self._lock:
+            self.modes[plan.mode] += 1
+
+    @staticmethod
+    def _describe(cap, where):
+        return f"{where} {cap['scope']} {cap['period']} cap of ${cap['limit']:.2f}"
+
+    def summary(self):
+        """Caps with their spend, and how this sync's emails were handled"""
+        with self._lock:
+            committed = self._committed()
+            return {
+                'caps': [{
+                    'scope': cap['scope'],
+                    'period': cap['period'],
+                    'limit': cap['limit'],
+                    'spent': round(cap['spent'] + committed, 4),
+                    'resets_at': cap['resets_at'].isoformat() if cap.get('resets_at') else None
+                } for cap in self.caps],
+                'modes': dict(self.modes),
+                'estimated_input_tokens': self.estimated_tokens,
+                'actual_input_tokens': self.actual_tokens
+            }
+
+
+def budget_status(user, now=None):
+    """
+    A user's caps and spend for the current day and month, without a sync running
+
+    Returns:
+        dict: caps (limit, spent, percent_used, resets_at) and whether
+        extraction is currently degraded or stopped
+    """
+    now = now or datetime.utcnow()
+    guard = BudgetGuard(user, CostTracker(user), Config.AZURE_OPENAI_MODEL)
+    if guard.caps:
+        guard.refresh(now)
+    caps = []
+    state = 'ok'
+    for cap in guard.caps:
+        fraction = cap['spent'] / cap['limit']
+        if fraction >= 1.0:
+            state = 'exhausted'
+        elif fraction >= guard.degrade_at and state == 'ok':
+            state = 'degraded'
+        caps.append({
+            'scope': cap['scope'],
+            'period': cap['period'],
+            'limit': cap['limit'],
+            'spent': round(cap['spent'], 4),
+            'percent_used': round(fraction * 100, 2),
+            'resets_at': cap['resets_at'].isoformat()
+        })
+    return {
+        'caps': caps,
+        'state': state,
+        'degrade_at': guard.degrade_at,
+        'cheap_deployment': bool(Config.AZURE_OPENAI_CHEAP_DEPLOYMENT)
+    }
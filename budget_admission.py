@@ -0,0 +1,72 @@
+from models import ProcessedEmail
+from email_priority import sender_address, score_email
+from metrics import EMAILS_SKIPPED
+
+
+class BudgetAdmission:
+    """
+    One sync's extractions planned against the dollar caps, and the emails held back
+
+    Each email is planned with the BudgetGuard before it's extracted (see
+    budget.BudgetGuard for the caps and modes). Emails the plan doesn't
+    extract are recorded here: a 'skip' like a sender-stats skip
+    (recoverable from /skipped), a 'defer' in the retry queue, due when the
+    cap resets, without counting as a failed attempt.
+
+    Args:
+        guard (BudgetGuard): The caps that apply to the user
+        extractor: EventExtractor-like object, for prompt token estimates
+        retries (RetryQueue): The sync's retry queue, for deferred emails
+        row_buffer (RowBuffer): The sync's buffered rows, for skipped emails
+        user_id (int): User whose sync this is
+    """
+
+    def __init__(self, guard, extractor, retries, row_buffer, user_id):
+        self.guard = guard
+        self.extractor = extractor
+        self.retries = retries
+        self.row_buffer = row_buffer
+        self.user_id = user_id
+
+    def exhausted(self):
+        """A 'defer' plan once a cap is used up (no point fetching the email), else None"""
+        return self.guard.defer_all()
+
+    def plan(self, email, score=None, forced=False):
+        """
+        BudgetPlan for extracting an email (any thread)
+
+        Args:
+            score (float, optional): email_priority score, if the sync already has it
+            forced (bool): A queued retry
+        """
+        if score is None:
+            score = score_email(email)[0]
+        return self.guard.plan(self.extractor.estimate_prompt_tokens(email), score, forced=forced)
+
+    def hold(self, message_id, email, plan, results):
+        """Record an email a 'skip' or 'defer' plan keeps from being extracted"""
+        self.guard.hold(plan)
+        if plan.mode == 'skip':
+            subject = email['subject']
+            print(f"Skipping email {subject[:50] + '...' if len(subject) > 50 else subject}: {plan.reason}")
+            results['emails_budget_skipped'] += 1
+            EMAILS_SKIPPED.inc('budget')
+            self.row_buffer.add(ProcessedEmail(
+                user_id=self.user_id,
+                email_id=message_id,
+                email_subject=subject,
+                email_sender=sender_address(email.get('sender')),
+                processing_status='skipped',
+                error_message=f"Skipped: {plan.reason}"
+            ))
+            return
+
+        self.retries.defer(message_id, email['subject'] if email is not None else None,
+                           plan.retry_at, plan.reason, self.row_buffer)
+        results['emails_budget_deferred'] += 1
+        EMAILS_SKIPPED.inc('budget_deferred')
+
+    def release(self, plan, token_usage=None):
+        """Drop an extraction's reservation once its usage is in the tracker"""
+        self.guard.release(plan, token_usage)
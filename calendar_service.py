@@ -1,6 +1,7 @@
-from googleapiclient.discovery import build
+from google_clients import google_clients, ApiUsage
 from auth import GoogleOAuth
 from models import db
+from timing import span
 
 
 class CalendarService:
@@ -15,7 +16,9 @@ class CalendarService:
         """
         self.user = user
         self.credentials = GoogleOAuth.get_credentials(user)
-        self.service = build('calendar', 'v3', credentials=self.credentials)
+        self.usage = ApiUsage('calendar')  # every request this service sends
+        self.service = google_clients.build('calendar', 'v3', self.credentials, usage=self.usage)
+        self.timer = None  # StageTimer of the sync using this service, if any
     
     def create_sift_calendar(self):
         """
@@ -28,7 +31,8 @@ class CalendarService:
         if self.user.sift_calendar_id:
             try:
                 # Verify it still exists
-                self.service.calendars().get(calendarId=self.user.sift_calendar_id).execute()
+                with span(self.timer, 'calendar.get_calendar'):
+                    self.service.calendars().get(calendarId=self.user.sift_calendar_id).execute()
                 print(f"Sift calendar already exists: {self.user.sift_calendar_id}")
                 return self.user.sift_calendar_id
             except Exception as e:
@@ -41,14 +45,16 @@ class CalendarService:
             'timeZone': 'America/Los_Angeles'  # You can make this dynamic later
         }
         
-        created_calendar = self.service.calendars().insert(body=calendar).execute()
+        with span(self.timer, 'calendar.create_calendar'):
+            created_calendar = self.service.calendars().insert(body=calendar).execute()
         calendar_id = created_calendar['id']
         
         print(f"Created Sift calendar: {calendar_id}")
         
         # Save to database
         self.user.sift_calendar_id = calendar_id
-        db.session.commit()
+        with span(self.timer, 'db.commit'):
+            db.session.commit()
         
         return calendar_id
     
@@ -71,10 +77,11 @@ class CalendarService:
         if not calendar_id:
             calendar_id = self.create_sift_calendar()
         
-        event = self.service.events().insert(
-            calendarId=calendar_id,
-            body=event_data
-        ).execute()
+        with span(self.timer, 'calendar.insert'):
+            event = self.service.events().insert(
+                calendarId=calendar_id,
+                body=event_data
+            ).execute()
         
         print(f"Created event: {event.get('summary')} - {event.get('id')}")
         return event.get('id')
@@ -89,11 +96,12 @@ class CalendarService:
         """
         calendar_id = self.user.sift_calendar_id
         
-        updated_event = self.service.events().update(
-            calendarId=calendar_id,
-            eventId=event_id,
-            body=event_data
-        ).execute()
+        with span(self.timer, 'calendar.update'):
+            updated_event = self.service.events().update(
+                calendarId=calendar_id,
+                eventId=event_id,
+                body=event_data
+            ).execute()
         
         return updated_event.get('id')
     
@@ -101,10 +109,11 @@ class CalendarService:
         """Delete an event from the Sift calendar"""
         calendar_id = self.user.sift_calendar_id
         
-        self.service.events().delete(
-            calendarId=calendar_id,
-            eventId=event_id
-        ).execute()
+        with span(self.timer, 'calendar.delete'):
+            self.service.events().delete(
+                calendarId=calendar_id,
+                eventId=event_id
+            ).execute()
         
         print(f"Deleted event: {event_id}")
     
@@ -128,13 +137,14 @@ class CalendarService:
             # Get upcoming events (from now onwards)
             now = datetime.utcnow().isoformat() + 'Z'
             
-            events_result = self.service.events().list(
-                calendarId=calendar_id,
-                timeMin=now,
-                maxResults=max_results,
-                singleEvents=True,
-                orderBy='startTime'
-            ).execute()
+            with span(self.timer, 'calendar.list'):
+                events_result = self.service.events().list(
+                    calendarId=calendar_id,
+                    timeMin=now,
+                    maxResults=max_results,
+                    singleEvents=True,
+                    orderBy='startTime'
+                ).execute()
             
             return events_result.get('items', [])
         except Exception as e:
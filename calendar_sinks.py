@@ -0,0 +1,368 @@
+from ics_feed import render_vevent, wrap_calendar
+from config import Config
+from timing import span
+from collections import deque
+from datetime import datetime
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the in-process lock applies
+    fcntl = None
+
+
+class WriteResult:
+    """Outcome of one event in a batched write"""
+
+    def __init__(self, event_id=None, error=None):
+        self.event_id = event_id
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class CalendarSink:
+    """
+    Base class for the places SyncWorker writes calendar events to
+
+    Subclasses implement ensure_calendar() and _write_batch(). Every batch
+    write is timed, and latency_summary() reports the recent write latencies.
+    """
+
+    name = 'base'
+    max_batch_size = 50
+
+    def __init__(self, latency_window=1000):
+        self.calendar_id = None
+        self._latencies = deque(maxlen=latency_window)  # seconds per batch
+        self._latency_lock = threading.Lock()
+        self.batches_written = 0
+        self.events_written = 0
+
+    def ensure_calendar(self):
+        """
+        Make sure the target calendar exists
+
+        Returns:
+            calendar_id (str): ID of the calendar events are written to
+        """
+        raise NotImplementedError
+
+    def _write_batch(self, events):
+        """Write up to max_batch_size events, returning a WriteResult per event"""
+        raise NotImplementedError
+
+    def add_events(self, events):
+        """
+        Write a batch of events
+
+        Args:
+            events (list): Google Calendar formatted event dicts
+
+        Returns:
+            list: WriteResult per input event, in the same order
+        """
+        results = []
+        for i in range(0, len(events), self.max_batch_size):
+            chunk = events[i:i + self.max_batch_size]
+
+            start = time.perf_counter()
+            chunk_results = self._write_batch(chunk)
+            elapsed = time.perf_counter() - start
+
+            with self._latency_lock:
+                self._latencies.append(elapsed)
+                self.batches_written += 1
+                self.events_written += sum(1 for r in chunk_results if r.ok)
+
+            results.extend(chunk_results)
+        return results
+
+    def add_event(self, event_data):
+        """
+        Write a single event
+
+        Returns:
+            event_id (str): ID of the created event
+
+        Raises:
+            Exception: whatever the backend raised for this event
+        """
+        result = self.add_events([event_data])[0]
+        if not result.ok:
+            raise result.error
+        return result.event_id
+
+    def latency_summary(self):
+        """Write latency stats (in milliseconds) over the recent batches"""
+        with self._latency_lock:
+            samples = sorted(self._latencies)
+            batches = self.batches_written
+            events = self.events_written
+
+        if not samples:
+            return {'sink': self.name, 'batches': 0, 'events': 0}
+
+        def percentile(p):
+            return samples[min(len(samples) - 1, int(p * len(samples)))] * 1000
+
+        return {
+            'sink': self.name,
+            'batches': batches,
+            'events': events,
+            'avg_ms': round(sum(samples) / len(samples) * 1000, 2),
+            'p50_ms': round(percentile(0.50), 2),
+            'p95_ms': round(percentile(0.95), 2),
+            'max_ms': round(samples[-1] * 1000, 2)
+        }
+
+
+class GoogleCalendarSink(CalendarSink):
+    """Write events to the user's Sift calendar in Google Calendar"""
+
+    name = 'google'
+    max_batch_size = 50  # Calendar API batch limit
+
+    def __init__(self, calendar_service, **kwargs):
+        super().__init__(**kwargs)
+        self.calendar = calendar_service
+
+    def ensure_calendar(self):
+        self.calendar_id = self.calendar.create_sift_calendar()
+        return self.calendar_id
+
+    def _write_batch(self, events):
+        from google_clients import execute_batch
+
+        if not self.calendar_id:
+            self.ensure_calendar()
+
+        if len(events) == 1:
+            try:
+                return [WriteResult(event_id=self.calendar.add_event(events[0]))]
+            except Exception as e:
+                return [WriteResult(error=e)]
+
+        results = [WriteResult(error=RuntimeError('No response in batch')) for _ in events]
+
+        def callback(request_id, response, exception):
+            idx = int(request_id)
+            if exception is not None:
+                results[idx] = WriteResult(error=exception)
+            else:
+                results[idx] = WriteResult(event_id=response.get('id'))
+
+        service = self.calendar.service
+        batch = service.new_batch_http_request(callback=callback)
+        for idx, event_data in enumerate(events):
+            batch.add(
+                service.events().insert(calendarId=self.calendar_id, body=event_data),
+                request_id=str(idx)
+            )
+        with span(self.calendar.timer, 'calendar.batch_insert'):
+            execute_batch(batch, 'calendar.events.insert')
+
+        print(f"Created {sum(1 for r in results if r.ok)}/{len(events)} events in batch")
+        return results
+
+
+class MemoryCalendarSink(CalendarSink):
+    """
+    Keep events in memory, for tests and offline benchmarks
+
+    Args:
+        write_delay (float): Seconds to sleep per batch, to simulate a remote API
+    """
+
+    name = 'memory'
+
+    def __init__(self, write_delay=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.write_delay = write_delay
+        self.events = {}
+        self._lock = threading.Lock()
+
+    def ensure_calendar(self):
+        if not self.calendar_id:
+            self.calendar_id = f"memory-{uuid.uuid4().hex}"
+        return self.calendar_id
+
+    def _write_batch(self, events):
+        if self.write_delay:
+            time.sleep(self.write_delay)
+
+        results = []
+        with self._lock:
+            for event_data in events:
+                event_id = uuid.uuid4().hex
+                self.events[event_id] = dict(event_data, id=event_id)
+                results.append(WriteResult(event_id=event_id))
+        return results
+
+
+# One lock per file so concurrent syncs in this process don't interleave rewrites
+_file_locks = {}
+_file_locks_guard = threading.Lock()
+
+
+def _lock_for(path):
+    with _file_locks_guard:
+        return _file_locks.setdefault(path, threading.Lock())
+
+
+class _FileLock:
+    """
+    Exclusive lock on a file across threads and processes
+
+    Takes the per-path thread lock, then an flock() on a sidecar `.lock`
+    file. The calendar file itself can't be locked because os.replace()
+    swaps in a new inode on every rewrite.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = _lock_for(path)
+        self._fd = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if fcntl is not None:
+            try:
+                self._fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except Exception:
+                self._release_fd()
+                self._thread_lock.release()
+                raise
+        return self
+
+    def __exit__(self, *exc):
+        self._release_fd()
+        self._thread_lock.release()
+
+    def _release_fd(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+class ICSFileCalendarSink(CalendarSink):
+    """
+    Append events to a local .ics file
+
+    The file is treated as append-only: existing VEVENT blocks are kept
+    verbatim and new ones are added at the end. Each batch rewrites the whole
+    file to a temp file in the same directory and os.replace()s it into
+    place, so readers never see a half-written calendar. The read and the
+    replace happen under a file lock, so sync workers in other processes
+    can't drop each other's events.
+    """
+
+    name = 'ics_file'
+
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = os.path.abspath(path)
+
+    def ensure_calendar(self):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        if not os.path.exists(self.path):
+            with _FileLock(self.path):
+                if not os.path.exists(self.path):
+                    self._rewrite([])
+        self.calendar_id = f"file:{self.path}"
+        return self.calendar_id
+
+    def _read_vevents(self):
+        """Return the VEVENT blocks currently in the file"""
+        if not os.path.exists(self.path):
+            return []
+
+        with open(self.path, 'r', encoding='utf-8', newline='') as f:
+            content = f.read()
+
+        blocks = []
+        start = content.find('BEGIN:VEVENT')
+        while start != -1:
+            end = content.find('END:VEVENT', start)
+            if end == -1:
+                break
+            end += len('END:VEVENT\r\n')
+            blocks.append(content[start:end])
+            start = content.find('BEGIN:VEVENT', end)
+        return blocks
+
+    def _rewrite(self, vevents):
+        directory = os.path.dirname(self.path)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.sift-', suffix='.ics')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+                f.write(wrap_calendar(vevents))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _write_batch(self, events):
+        if not self.calendar_id:
+            self.ensure_calendar()
+
+        results = []
+        new_blocks = []
+        now = datetime.utcnow()
+        for event_data in events:
+            try:
+                event_id = uuid.uuid4().hex
+                new_blocks.append(render_vevent(
+                    uid=f"{event_id}@sift",
+                    title=event_data['summary'],
+                    start=datetime.fromisoformat(event_data['start']['dateTime']),
+                    end=datetime.fromisoformat(event_data['end']['dateTime']),
+                    location=event_data.get('location'),
+                    description=event_data.get('description'),
+                    dtstamp=now
+                ))
+                results.append(WriteResult(event_id=event_id))
+            except Exception as e:
+                results.append(WriteResult(error=e))
+
+        if new_blocks:
+            with _FileLock(self.path):
+                self._rewrite(self._read_vevents() + new_blocks)
+
+        return results
+
+
+def create_sink(user, kind=None):
+    """
+    Build the calendar sink configured for this deployment
+
+    Args:
+        user: User object from database
+        kind (str, optional): 'google', 'memory' or 'ics_file'; defaults to Config.CALENDAR_SINK
+
+    Returns:
+        CalendarSink
+    """
+    kind = kind or Config.CALENDAR_SINK
+
+    if kind == 'google':
+        from calendar_service import CalendarService
+        return GoogleCalendarSink(CalendarService(user))
+    if kind == 'memory':
+        return MemoryCalendarSink()
+    if kind == 'ics_file':
+        return ICSFileCalendarSink(os.path.join(Config.ICS_SINK_DIR, f"user-{user.id}.ics"))
+
+    raise ValueError(f"Unknown calendar sink: {kind}")
@@ -34,6 +34,136 @@ class Config:
     AZURE_OPENAI_ENDPOINT = os.getenv('AZURE_OPENAI_ENDPOINT')
     AZURE_OPENAI_KEY = os.getenv('AZURE_OPENAI_KEY')
     AZURE_OPENAI_DEPLOYMENT = os.getenv('AZURE_OPENAI_DEPLOYMENT')
+    AZURE_OPENAI_MODEL = os.getenv('AZURE_OPENAI_MODEL', 'gpt-4o')  # what the deployment runs, for pricing
+    # Optional cheaper deployment, used when a budget cap is near
+    AZURE_OPENAI_CHEAP_DEPLOYMENT = os.getenv('AZURE_OPENAI_CHEAP_DEPLOYMENT', '')
+    AZURE_OPENAI_CHEAP_MODEL = os.getenv('AZURE_OPENAI_CHEAP_MODEL', 'gpt-4o-mini')
+    
+    # Where SyncWorker writes events: 'google', 'ics_file' or 'memory'
+    CALENDAR_SINK = os.getenv('CALENDAR_SINK', 'google')
+    ICS_SINK_DIR = os.getenv('ICS_SINK_DIR', 'calendars')
+    
+    # Start background threads (workers, refresher, progress relay) when this
+    # process serves its first request; `flask run-workers` starts them regardless
+    BACKGROUND_SERVICES = os.getenv('BACKGROUND_SERVICES', 'true').lower() == 'true'
+    
+    # Background sync workers in this process (0 = only enqueue, run workers elsewhere)
+    SYNC_WORKERS = int(os.getenv('SYNC_WORKERS', '2'))
+    SYNC_JOB_LEASE_SECONDS = int(os.getenv('SYNC_JOB_LEASE_SECONDS', '120'))
+    
+    # Overlap Gmail fetches, extraction and calendar writes within one sync
+    # ('false' processes one email at a time)
+    SYNC_PIPELINE = os.getenv('SYNC_PIPELINE', 'true').lower() == 'true'
+    SYNC_FETCH_WORKERS = int(os.getenv('SYNC_FETCH_WORKERS', '4'))
+    SYNC_EXTRACT_WORKERS = int(os.getenv('SYNC_EXTRACT_WORKERS', '4'))
+    SYNC_WRITE_WORKERS = int(os.getenv('SYNC_WRITE_WORKERS', '2'))
+    SYNC_PIPELINE_QUEUE_SIZE = int(os.getenv('SYNC_PIPELINE_QUEUE_SIZE', '8'))
+    
+    # Fetch a sync's emails first and extract the likeliest event mail first
+    # (invites, starred, dates in the next few days, senders who send events)
+    SYNC_PRIORITY = os.getenv('SYNC_PRIORITY', 'true').lower() == 'true'
+    
+    # Learned skip list: senders whose mail went this many emails in a row
+    # without events are demoted or skipped (skipped emails can be recovered
+    # from /skipped); a sample of would-be skips is extracted anyway
+    SENDER_SKIP = os.getenv('SENDER_SKIP', 'true').lower() == 'true'
+    SENDER_DEMOTE_AFTER = int(os.getenv('SENDER_DEMOTE_AFTER', '5'))
+    SENDER_SKIP_AFTER = int(os.getenv('SENDER_SKIP_AFTER', '15'))
+    SENDER_GLOBAL_SKIP_AFTER = int(os.getenv('SENDER_GLOBAL_SKIP_AFTER', '50'))
+    SENDER_EXPLORE_RATE = float(os.getenv('SENDER_EXPLORE_RATE', '0.05'))
+    
+    # Emails that fail transiently (LLM timeouts, 5xx, throttling) are retried by
+    # later syncs with exponential backoff, then recorded as errors
+    SYNC_RETRY_MAX_ATTEMPTS = int(os.getenv('SYNC_RETRY_MAX_ATTEMPTS', '5'))
+    SYNC_RETRY_BASE_SECONDS = int(os.getenv('SYNC_RETRY_BASE_SECONDS', '60'))
+    SYNC_RETRY_MAX_SECONDS = int(os.getenv('SYNC_RETRY_MAX_SECONDS', '21600'))
+    # Longest a sync goes without saving its work and checkpoint
+    SYNC_CHECKPOINT_SECONDS = int(os.getenv('SYNC_CHECKPOINT_SECONDS', '10'))
+    
+    # Longest lookback a live /sync?days= can ask for; older mail is backfilled
+    SYNC_MAX_DAYS = int(os.getenv('SYNC_MAX_DAYS', '14'))
+    
+    # Backfill: walks older mail in windows, newest first, within a budget
+    BACKFILL_MAX_DAYS = int(os.getenv('BACKFILL_MAX_DAYS', '365'))
+    BACKFILL_WINDOW_DAYS = int(os.getenv('BACKFILL_WINDOW_DAYS', '7'))
+    BACKFILL_MAX_EMAILS_PER_WINDOW = int(os.getenv('BACKFILL_MAX_EMAILS_PER_WINDOW', '200'))
+    BACKFILL_TOKEN_BUDGET = int(os.getenv('BACKFILL_TOKEN_BUDGET', '2000000'))
+    BACKFILL_DOLLAR_BUDGET = float(os.getenv('BACKFILL_DOLLAR_BUDGET', '5.0'))
+    
+    # Periodic syncs queued by `flask run-scheduler` (run one per deployment)
+    SCHEDULER_TICK_SECONDS = int(os.getenv('SCHEDULER_TICK_SECONDS', '30'))
+    SCHEDULER_MAX_CONCURRENT = int(os.getenv('SCHEDULER_MAX_CONCURRENT', '4'))
+    SCHEDULER_MIN_INTERVAL_MINUTES = int(os.getenv('SCHEDULER_MIN_INTERVAL_MINUTES', '15'))
+    SCHEDULER_MAX_INTERVAL_MINUTES = int(os.getenv('SCHEDULER_MAX_INTERVAL_MINUTES', '240'))
+    SCHEDULER_JITTER = float(os.getenv('SCHEDULER_JITTER', '0.1'))
+    
+    # Push sync: Gmail watch notifications via a Pub/Sub push subscription to
+    # /gmail/push?token=GMAIL_PUSH_TOKEN. Notifications are coalesced per user
+    # into one push job that starts PUSH_DEBOUNCE_SECONDS after the latest,
+    # at most PUSH_MAX_DELAY_SECONDS after the first.
+    GMAIL_PUSH_TOPIC = os.getenv('GMAIL_PUSH_TOPIC', '')  # projects/<project>/topics/<topic>
+    GMAIL_PUSH_TOKEN = os.getenv('GMAIL_PUSH_TOKEN', '')
+    GMAIL_WATCH_RENEW_HOURS = int(os.getenv('GMAIL_WATCH_RENEW_HOURS', '24'))
+    PUSH_DEBOUNCE_SECONDS = float(os.getenv('PUSH_DEBOUNCE_SECONDS', '5'))
+    PUSH_MAX_DELAY_SECONDS = float(os.getenv('PUSH_MAX_DELAY_SECONDS', '60'))
+    PUSH_MAX_MESSAGES = int(os.getenv('PUSH_MAX_MESSAGES', '100'))
+    
+    # Per-job sync progress: 'database' relays it between processes, 'local' keeps it in-process
+    PROGRESS_BROKER = os.getenv('PROGRESS_BROKER', 'database')
+    PROGRESS_MAX_JOBS = int(os.getenv('PROGRESS_MAX_JOBS', '1000'))
+    PROGRESS_TTL_SECONDS = int(os.getenv('PROGRESS_TTL_SECONDS', '600'))
+    PROGRESS_HEARTBEAT_SECONDS = int(os.getenv('PROGRESS_HEARTBEAT_SECONDS', '15'))
+    PROGRESS_IDLE_TIMEOUT_SECONDS = int(os.getenv('PROGRESS_IDLE_TIMEOUT_SECONDS', '120'))
+    
+    # Migrate stored tokens to the newest ENCRYPTION_KEYS entry in the background
+    REENCRYPT_TOKENS_ON_STARTUP = os.getenv('REENCRYPT_TOKENS_ON_STARTUP', 'false').lower() == 'true'
+    REENCRYPT_BATCH_SIZE = int(os.getenv('REENCRYPT_BATCH_SIZE', '100'))
+    
+    # Background refresh of access tokens that are about to expire
+    TOKEN_REFRESHER_ENABLED = os.getenv('TOKEN_REFRESHER_ENABLED', 'false').lower() == 'true'
+    TOKEN_REFRESH_HORIZON_MINUTES = int(os.getenv('TOKEN_REFRESH_HORIZON_MINUTES', '10'))
+    TOKEN_REFRESH_INTERVAL_SECONDS = int(os.getenv('TOKEN_REFRESH_INTERVAL_SECONDS', '60'))
+    TOKEN_REFRESH_BATCH_SIZE = int(os.getenv('TOKEN_REFRESH_BATCH_SIZE', '20'))
+    TOKEN_REFRESH_MAX_PER_SECOND = float(os.getenv('TOKEN_REFRESH_MAX_PER_SECOND', '5'))
+    # Tokens expired longer ago than this belong to dormant users; leave them to the next sign-in
+    TOKEN_REFRESH_MAX_EXPIRED_DAYS = int(os.getenv('TOKEN_REFRESH_MAX_EXPIRED_DAYS', '7'))
+    
+    # Bearer token for operator endpoints (refresher metrics); unset = localhost only
+    INTERNAL_API_TOKEN = os.getenv('INTERNAL_API_TOKEN')
 
 
-    
\ No newline at end of file
+        
+    # /metrics: with several app processes on a host, each writes its values
+    # here and /metrics adds them up (unset = this process only)
+    METRICS_DIR = os.getenv('METRICS_DIR', '')
+    METRICS_SNAPSHOT_SECONDS = float(os.getenv('METRICS_SNAPSHOT_SECONDS', '5'))
+    
+    # Google API quotas of the Cloud project, for /costs/quota projections
+    GMAIL_QUOTA_UNITS_PER_DAY = int(os.getenv('GMAIL_QUOTA_UNITS_PER_DAY', '1000000000'))
+    GMAIL_QUOTA_UNITS_PER_USER_SECOND = int(os.getenv('GMAIL_QUOTA_UNITS_PER_USER_SECOND', '250'))
+    CALENDAR_QUOTA_REQUESTS_PER_DAY = int(os.getenv('CALENDAR_QUOTA_REQUESTS_PER_DAY', '1000000'))
+    CALENDAR_QUOTA_REQUESTS_PER_USER_MINUTE = int(os.getenv('CALENDAR_QUOTA_REQUESTS_PER_USER_MINUTE', '600'))
+    
+    # Dollar caps on OpenAI spend per UTC day and calendar month (0 = no cap).
+    # User caps apply to every user without their own (`flask set-budget`).
+    # Before each extraction the sync projects the spend with the call's
+    # estimated cost: past BUDGET_DEGRADE_AT of a cap it uses the cheap
+    # deployment, or without one only extracts emails scoring at least
+    # BUDGET_HEURISTIC_MIN_SCORE; mail that would exceed a cap waits for it to reset.
+    USER_DAILY_DOLLAR_CAP = float(os.getenv('USER_DAILY_DOLLAR_CAP', '0'))
+    USER_MONTHLY_DOLLAR_CAP = float(os.getenv('USER_MONTHLY_DOLLAR_CAP', '0'))
+    DEPLOYMENT_DAILY_DOLLAR_CAP = float(os.getenv('DEPLOYMENT_DAILY_DOLLAR_CAP', '0'))
+    DEPLOYMENT_MONTHLY_DOLLAR_CAP = float(os.getenv('DEPLOYMENT_MONTHLY_DOLLAR_CAP', '0'))
+    BUDGET_DEGRADE_AT = float(os.getenv('BUDGET_DEGRADE_AT', '0.8'))
+    BUDGET_HEURISTIC_MIN_SCORE = float(os.getenv('BUDGET_HEURISTIC_MIN_SCORE', '2.0'))
+    BUDGET_OUTPUT_TOKENS = int(os.getenv('BUDGET_OUTPUT_TOKENS', '400'))  # expected per extraction
+    BUDGET_REFRESH_SECONDS = int(os.getenv('BUDGET_REFRESH_SECONDS', '60'))  # reload saved spend during a sync
+    
+    # Costs are summed per user, day and model as syncs are saved (CostRollup);
+    # per-sync rows (recent syncs, stage timings, quota peaks) are kept this
+    # long, then deleted by the compactor (this thread, or `flask compact-costs`
+    # from cron), which also rolls up syncs saved before rollups existed.
+    COST_RETENTION_DAYS = int(os.getenv('COST_RETENTION_DAYS', '90'))
+    COST_COMPACTION_ENABLED = os.getenv('COST_COMPACTION_ENABLED', 'false').lower() == 'true'
+    COST_COMPACTION_INTERVAL_SECONDS = int(os.getenv('COST_COMPACTION_INTERVAL_SECONDS', '3600'))
+    COST_COMPACTION_BATCH_SIZE = int(os.getenv('COST_COMPACTION_BATCH_SIZE', '500'))
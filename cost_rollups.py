@@ -0,0 +1,233 @@
+from models import db, SyncCost, SyncTiming, CostRollup
+from config import Config
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta
+import threading
+
+
+# Summed columns of CostRollup
+ROLLUP_FIELDS = ('syncs', 'emails_processed', 'events_extracted', 'input_tokens', 'output_tokens',
+                 'openai_cost', 'total_cost', 'gmail_api_calls', 'gmail_quota_units', 'calendar_api_calls')
+
+
+def add_to_rollup(user_id, day, model, amounts, now=None):
+    """
+    Add amounts to a user's CostRollup row for a day and model
+
+    Runs in the session's transaction, so the rollup commits (or not) with
+    the SyncCost rows it sums. Counters are incremented in SQL, so syncs of
+    the same user saving at once never lose each other's amounts.
+
+    Args:
+        amounts (dict): ROLLUP_FIELDS -> amount to add (missing fields add 0)
+    """
+    now = now or datetime.utcnow()
+    table = CostRollup.__table__
+
+    def update():
+        return db.session.execute(
+            table.update().where(
+                table.c.user_id == user_id,
+                table.c.day == day,
+                table.c.model == model
+            ).values(
+                updated_at=now,
+                **{field: table.c[field] + amounts.get(field, 0) for field in ROLLUP_FIELDS}
+            )
+        ).rowcount
+
+    if update():
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.execute(table.insert().values(
+                user_id=user_id, day=day, model=model, updated_at=now,
+                **{field: amounts.get(field, 0) for field in ROLLUP_FIELDS}
+            ))
+    except IntegrityError:
+        # Another sync created it first
+        update()
+
+
+def sync_cost_amounts(sync_cost):
+    """A SyncCost row as rollup amounts (all of it on its model_used)"""
+    return {
+        'syncs': 1,
+        'emails_processed': sync_cost.emails_processed or 0,
+        'events_extracted': sync_cost.events_extracted or 0,
+        'input_tokens': sync_cost.openai_input_tokens or 0,
+        'output_tokens': sync_cost.openai_output_tokens or 0,
+        'openai_cost': sync_cost.openai_cost or 0.0,
+        'total_cost': sync_cost.total_cost or 0.0,
+        'gmail_api_calls': sync_cost.gmail_api_calls or 0,
+        'gmail_quota_units': sync_cost.gmail_quota_units or 0,
+        'calendar_api_calls': sync_cost.calendar_api_calls or 0
+    }
+
+
+def pending_rollup_query(limit):
+    """SyncCost rows not yet added to CostRollup (saved before rollups existed), oldest first"""
+    return SyncCost.query.filter(SyncCost.rolled_up.is_(None)).order_by(SyncCost.sync_date).limit(limit)
+
+
+def compactable_query(before, limit):
+    """IDs of rolled-up SyncCost rows older than `before`, oldest first"""
+    return db.session.query(SyncCost.id).filter(
+        SyncCost.sync_date < before,
+        SyncCost.rolled_up.is_(True)
+    ).order_by(SyncCost.sync_date).limit(limit)
+
+
+def roll_up_pending(batch_size=500):
+    """
+    Add the SyncCost rows saved before rollups existed to CostRollup
+
+    Each batch is claimed by flagging its rows, in the same transaction as
+    the rollup update, so two processes never add a row twice.
+
+    Returns:
+        int: Syncs rolled up
+    """
+    table = SyncCost.__table__
+    rolled_up = 0
+    while True:
+        rows = pending_rollup_query(batch_size).all()
+        if not rows:
+            break
+        ids = [row.id for row in rows]
+        claimed = db.session.execute(
+            table.update().where(table.c.id.in_(ids), table.c.rolled_up.is_(None)).values(rolled_up=True)
+        ).rowcount
+        if claimed != len(ids):
+            # Another process is rolling these up
+            db.session.rollback()
+            break
+
+        totals = {}
+        for row in rows:
+            key = (row.user_id, (row.sync_date or datetime.utcnow()).date(), row.model_used or 'unknown')
+            amounts = totals.setdefault(key, dict.fromkeys(ROLLUP_FIELDS, 0))
+            for field, amount in sync_cost_amounts(row).items():
+                amounts[field] += amount
+        for (user_id, day, model), amounts in totals.items():
+            add_to_rollup(user_id, day, model, amounts)
+        db.session.commit()
+        rolled_up += len(rows)
+    return rolled_up
+
+
+def raw_cost_days(days):
+    """
+    A window of `days` over per-sync rows, capped at COST_RETENTION_DAYS
+
+    Older syncs are only in CostRollup once the compactor has run, so
+    readers of SyncCost and SyncTiming (stage timings, quota use and peaks)
+    don't reach further back and report the days they counted.
+    """
+    return max(1, min(days, Config.COST_RETENTION_DAYS))
+
+
+def compact_costs(before, batch_size=500):
+    """
+    Delete rolled-up SyncCost rows (and their SyncTiming rows) older than `before`
+
+    Their amounts stay in CostRollup; per-sync detail (recent_syncs, stage
+    timings, quota peaks) is only kept for newer syncs, and the readers of
+    it cap their windows with raw_cost_days.
+
+    Returns:
+        int: SyncCost rows deleted
+    """
+    deleted = 0
+    while True:
+        ids = [sync_cost_id for (sync_cost_id,) in compactable_query(before, batch_size).all()]
+        if not ids:
+            break
+        SyncTiming.query.filter(SyncTiming.sync_cost_id.in_(ids)).delete(synchronize_session=False)
+        SyncCost.query.filter(SyncCost.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        deleted += len(ids)
+    return deleted
+
+
+class CostCompactor:
+    """
+    Background thread that keeps CostRollup complete and the raw cost rows bounded
+
+    Every `interval` seconds it rolls up SyncCost rows saved before rollups
+    existed, then deletes rolled-up rows older than `retention`. Safe to run
+    in several processes. `flask compact-costs` does one pass.
+
+    Args:
+        app: Flask app (the thread needs an app context for the DB)
+        retention (timedelta): How long per-sync rows are kept
+        interval (float): Seconds between passes
+        batch_size (int): Rows per transaction
+    """
+
+    def __init__(self, app, retention=timedelta(days=90), interval=3600, batch_size=500):
+        self.app = app
+        self.retention = retention
+        self.interval = interval
+        self.batch_size = batch_size
+
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.passes = 0
+        self.rolled_up = 0
+        self.deleted = 0
+        self.last_pass_at = None
+        self.last_error = None
+
+    def start(self):
+        """Start the background thread (no-op if already running)"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='cost-compactor', daemon=True)
+        self._thread.start()
+        print(f"Cost compactor started (keeping {self.retention.days} days of syncs, every {self.interval}s)")
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    self.run_once()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Cost compaction failed: {e}")
+                with self._lock:
+                    self.last_error = str(e)
+            self._stop.wait(self.interval)
+
+    def run_once(self, now=None):
+        """
+        Returns:
+            tuple: (syncs rolled up, SyncCost rows deleted)
+        """
+        now = now or datetime.utcnow()
+        rolled_up = roll_up_pending(self.batch_size)
+        deleted = compact_costs(now - self.retention, self.batch_size)
+        with self._lock:
+            self.passes += 1
+            self.rolled_up += rolled_up
+            self.deleted += deleted
+            self.last_pass_at = now.isoformat()
+        if rolled_up or deleted:
+            print(f"Cost compaction: rolled up {rolled_up} syncs, deleted {deleted} older than {self.retention.days} days")
+        return rolled_up, deleted
+
+    def get_metrics(self):
+        with self._lock:
+            return {
+                'running': bool(self._thread and self._thread.is_alive()),
+                'passes': self.passes,
+                'rolled_up': self.rolled_up,
+                'deleted': self.deleted,
+                'last_pass_at': self.last_pass_at,
+                'last_error': self.last_error
+            }
@@ -1,5 +1,10 @@
-from models import db, SyncCost
-from datetime import datetime
+from models import db, SyncCost, SyncTiming, CostRollup
+from cost_rollups import add_to_rollup, raw_cost_days
+from metrics import OPENAI_TOKENS
+from config import Config
+from sqlalchemy import func, case, tuple_
+from datetime import datetime, timedelta
+import threading
 
 class CostTracker:
     """Track and calculate API costs"""
@@ -14,6 +19,10 @@ class CostTracker:
             'input': 0.0025,   # per 1K tokens
             'output': 0.01   # per 1K tokens
         },
+        'gpt-4o-mini': {
+            'input': 0.00015,   # per 1K tokens
+            'output': 0.0006   # per 1K tokens
+        },
         'gpt-3.5-turbo': {
             'input': 0.0005,  # per 1K tokens
             'output': 0.0015  # per 1K tokens
@@ -28,32 +37,81 @@ class CostTracker:
         self.model = model
         self.input_tokens = 0
         self.output_tokens = 0
+        # Tokens of other models than self.model (e.g. a cheaper one near a
+        # budget cap): model -> [input, output], also included in the totals
+        self.model_tokens = {}
+        # HTTP requests, counted by the services (google_clients.ApiUsage)
         self.gmail_calls = 0
+        self.gmail_retries = 0
+        self.gmail_quota_units = 0
         self.calendar_calls = 0
+        self.calendar_retries = 0
         self.emails_processed = 0
         self.events_extracted = 0
+        self._lock = threading.Lock()  # API requests are counted from fetch and write threads
+    
+    # Counters a checkpoint carries over to the worker that resumes a sync
+    COUNTERS = ('input_tokens', 'output_tokens', 'gmail_calls', 'gmail_retries', 'gmail_quota_units',
+                'calendar_calls', 'calendar_retries', 'emails_processed', 'events_extracted', 'model_tokens')
+    
+    def counters(self):
+        """Current counts, for a sync checkpoint"""
+        return {name: getattr(self, name) for name in self.COUNTERS}
+    
+    def restore(self, counters):
+        """Continue from a checkpoint's counts"""
+        for name in self.COUNTERS:
+            setattr(self, name, counters.get(name, 0))
+        self.model_tokens = {model: list(tokens) for model, tokens in (counters.get('model_tokens') or {}).items()}
+    
+    def within_budget(self, max_tokens=None, max_dollars=None):
+        """False once this tracker's OpenAI tokens or total cost reach either cap"""
+        if max_tokens is not None and self.input_tokens + self.output_tokens >= max_tokens:
+            return False
+        if max_dollars is not None and self.calculate_total_cost() >= max_dollars:
+            return False
+        return True
     
-    def add_openai_usage(self, input_tokens, output_tokens):
-        """Track OpenAI API usage"""
+    def add_openai_usage(self, input_tokens, output_tokens, model=None):
+        """Track OpenAI API usage (of `model`, self.model if None)"""
+        model = model or self.model
         self.input_tokens += input_tokens
         self.output_tokens += output_tokens
+        if model != self.model:
+            tokens = self.model_tokens.setdefault(model, [0, 0])
+            tokens[0] += input_tokens
+            tokens[1] += output_tokens
+        OPENAI_TOKENS.inc(model, 'input', amount=input_tokens)
+        OPENAI_TOKENS.inc(model, 'output', amount=output_tokens)
     
-    def add_gmail_call(self):
-        """Track Gmail API call"""
-        self.gmail_calls += 1
+    def add_api_requests(self, api, count, quota_units, retry=False):
+        """Track Gmail or Calendar HTTP requests (batch sub-requests and retries each count)"""
+        with self._lock:
+            if api == 'gmail':
+                self.gmail_calls += count
+                self.gmail_quota_units += quota_units
+                if retry:
+                    self.gmail_retries += count
+            elif api == 'calendar':
+                self.calendar_calls += count
+                if retry:
+                    self.calendar_retries += count
     
-    def add_calendar_call(self):
-        """Track Calendar API call"""
-        self.calendar_calls += 1
+    @classmethod
+    def price(cls, model, input_tokens, output_tokens):
+        """Dollar cost of tokens of `model` (unknown models are priced as gpt-4o)"""
+        pricing = cls.PRICING.get(model, cls.PRICING['gpt-4o'])
+        return (input_tokens / 1000) * pricing['input'] + (output_tokens / 1000) * pricing['output']
     
     def calculate_openai_cost(self):
         """Calculate OpenAI cost"""
-        pricing = self.PRICING.get(self.model, self.PRICING['gpt-4o'])
-        
-        input_cost = (self.input_tokens / 1000) * pricing['input']
-        output_cost = (self.output_tokens / 1000) * pricing['output']
-        
-        return input_cost + output_cost
+        input_tokens, output_tokens = self.input_tokens, self.output_tokens
+        cost = 0.0
+        for model, (model_input, model_output) in list(self.model_tokens.items()):
+            cost += self.price(model, model_input, model_output)
+            input_tokens -= model_input
+            output_tokens -= model_output
+        return cost + self.price(self.model, input_tokens, output_tokens)
     
     def calculate_total_cost(self):
         """Calculate total cost"""
@@ -61,26 +119,192 @@ class CostTracker:
         # Gmail and Calendar are free for now
         return openai_cost
     
-    def save(self):
-        """Save cost tracking to database"""
+    def rollup_amounts(self):
+        """
+        This sync's CostRollup amounts per model: per-sync counts go on
+        self.model, other models only get their tokens and cost
+        """
+        amounts = {}
+        other_cost = 0.0
+        input_tokens, output_tokens = self.input_tokens, self.output_tokens
+        for model, (model_input, model_output) in self.model_tokens.items():
+            cost = self.price(model, model_input, model_output)
+            amounts[model] = {'input_tokens': model_input, 'output_tokens': model_output,
+                              'openai_cost': cost, 'total_cost': cost}
+            other_cost += cost
+            input_tokens -= model_input
+            output_tokens -= model_output
+        amounts[self.model] = {
+            'syncs': 1,
+            'emails_processed': self.emails_processed,
+            'events_extracted': self.events_extracted,
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'openai_cost': self.calculate_openai_cost() - other_cost,
+            'total_cost': self.calculate_total_cost() - other_cost,
+            'gmail_api_calls': self.gmail_calls,
+            'gmail_quota_units': self.gmail_quota_units,
+            'calendar_api_calls': self.calendar_calls
+        }
+        return amounts
+    
+    def save(self, timings=None, duration=None):
+        """
+        Save cost tracking to database
+        
+        Args:
+            timings (dict, optional): StageTimer.summary() of the sync, saved
+                as SyncTiming rows in the same commit
+            duration (float, optional): Seconds the sync ran, for request rates
+        
+        The sync's amounts are added to the user's CostRollup rows for the
+        day in the same commit.
+        """
+        now = datetime.utcnow()
         sync_cost = SyncCost(
             user_id=self.user.id,
+            sync_date=now,
             emails_processed=self.emails_processed,
             events_extracted=self.events_extracted,
             openai_input_tokens=self.input_tokens,
             openai_output_tokens=self.output_tokens,
             openai_cost=self.calculate_openai_cost(),
             gmail_api_calls=self.gmail_calls,
+            gmail_retries=self.gmail_retries,
+            gmail_quota_units=self.gmail_quota_units,
             calendar_api_calls=self.calendar_calls,
+            calendar_retries=self.calendar_retries,
+            duration_seconds=duration,
             total_cost=self.calculate_total_cost(),
-            model_used=self.model
+            model_used=self.model,
+            rolled_up=True
         )
         
         db.session.add(sync_cost)
+        for stage, timing in (timings or {}).items():
+            db.session.add(SyncTiming(
+                sync_cost=sync_cost,
+                user_id=self.user.id,
+                stage=stage,
+                count=timing['count'],
+                errors=timing['errors'],
+                total_ms=timing['total_ms'],
+                p50_ms=timing['p50_ms'],
+                p95_ms=timing['p95_ms'],
+                max_ms=timing['max_ms']
+            ))
+        for model, amounts in self.rollup_amounts().items():
+            add_to_rollup(self.user.id, now.date(), model, amounts, now)
         db.session.commit()
         
         return sync_cost
     
+    @staticmethod
+    def recent_syncs_query(user_id, limit=20, before=None):
+        """
+        A user's latest SyncCost rows, newest first
+        
+        Args:
+            before (tuple, optional): (sync_date, id) of the last row of the
+                previous page; the page continues after it (keyset pagination)
+        """
+        query = SyncCost.query.filter(SyncCost.user_id == user_id)
+        if before is not None:
+            query = query.filter(tuple_(SyncCost.sync_date, SyncCost.id) < tuple_(*before))
+        return query.order_by(SyncCost.sync_date.desc(), SyncCost.id.desc()).limit(limit)
+    
+    @staticmethod
+    def timings_query(sync_cost_ids):
+        """SyncTiming rows of the given syncs"""
+        return SyncTiming.query.filter(SyncTiming.sync_cost_id.in_(sync_cost_ids))\
+            .order_by(SyncTiming.sync_cost_id, SyncTiming.stage)
+    
+    @staticmethod
+    def stage_totals_since_query(user_id, since):
+        """
+        Per stage, across a user's syncs since a date: (stage, syncs, calls,
+        errors, total ms, worst p95 ms, max ms)
+
+        Timings are per-sync rows, so `since` should be within the retained
+        days (see cost_rollups.raw_cost_days).
+        """
+        return db.session.query(
+            SyncTiming.stage,
+            func.count(SyncTiming.id),
+            func.sum(SyncTiming.count),
+            func.sum(SyncTiming.errors),
+            func.sum(SyncTiming.total_ms),
+            func.max(SyncTiming.p95_ms),
+            func.max(SyncTiming.max_ms)
+        ).join(
+            SyncCost, SyncCost.id == SyncTiming.sync_cost_id
+        ).filter(
+            SyncCost.user_id == user_id,
+            SyncCost.sync_date >= since
+        ).group_by(SyncTiming.stage)
+    
+    @staticmethod
+    def totals_query(user_id, since_day=None):
+        """(total cost, tokens, number of syncs) for a user, from CostRollup, all time or since a day"""
+        query = db.session.query(
+            func.sum(CostRollup.total_cost),
+            func.sum(CostRollup.input_tokens + CostRollup.output_tokens),
+            func.sum(CostRollup.syncs)
+        ).filter(CostRollup.user_id == user_id)
+        if since_day is not None:
+            query = query.filter(CostRollup.day >= since_day)
+        return query
+    
+    @staticmethod
+    def model_totals_query(user_id):
+        """Per model, all time: (model, input tokens, output tokens, cost)"""
+        return db.session.query(
+            CostRollup.model,
+            func.sum(CostRollup.input_tokens),
+            func.sum(CostRollup.output_tokens),
+            func.sum(CostRollup.openai_cost)
+        ).filter(CostRollup.user_id == user_id).group_by(CostRollup.model)
+    
+    @staticmethod
+    def spend_query(day, month_start, user_id=None):
+        """
+        (dollars on `day`, dollars since `month_start`) of saved syncs, from
+        CostRollup, for one user or the whole deployment; `day` must not be
+        before month_start
+        """
+        query = db.session.query(
+            func.sum(case((CostRollup.day >= day, CostRollup.total_cost), else_=0.0)),
+            func.sum(CostRollup.total_cost)
+        ).filter(CostRollup.day >= month_start)
+        if user_id is not None:
+            query = query.filter(CostRollup.user_id == user_id)
+        return query
+    
+    @staticmethod
+    def quota_usage_query(since, user_id=None):
+        """
+        Google API usage of syncs since a date, for one user or the whole
+        deployment: (syncs, users, Gmail requests, Gmail quota units,
+        Calendar requests, peak Gmail units per second, peak Calendar
+        requests per second)
+
+        Read from per-sync rows, so `since` should be within the retained
+        days (see cost_rollups.raw_cost_days).
+        """
+        duration = func.nullif(SyncCost.duration_seconds, 0)
+        query = db.session.query(
+            func.count(SyncCost.id),
+            func.count(func.distinct(SyncCost.user_id)),
+            func.sum(SyncCost.gmail_api_calls),
+            func.sum(SyncCost.gmail_quota_units),
+            func.sum(SyncCost.calendar_api_calls),
+            func.max(SyncCost.gmail_quota_units / duration),
+            func.max(SyncCost.calendar_api_calls / duration)
+        ).filter(SyncCost.sync_date >= since)
+        if user_id is not None:
+            query = query.filter(SyncCost.user_id == user_id)
+        return query
+    
     def get_summary(self):
         """Get cost summary"""
         return {
@@ -88,8 +312,78 @@ class CostTracker:
             'openai_output_tokens': self.output_tokens,
             'openai_cost': round(self.calculate_openai_cost(), 4),
             'gmail_api_calls': self.gmail_calls,
+            'gmail_retries': self.gmail_retries,
+            'gmail_quota_units': self.gmail_quota_units,
             'calendar_api_calls': self.calendar_calls,
+            'calendar_retries': self.calendar_retries,
             'total_cost': round(self.calculate_total_cost(), 4),
             'emails_processed': self.emails_processed,
             'events_extracted': self.events_extracted
-        }
\ No newline at end of file
+        }
+
+
+def project_quota(user_id=None, days=7, now=None):
+    """
+    Google API quota use projected from the last `days` of syncs
+
+    Daily figures are averages over the window, compared with the project's
+    daily limits; peak rates are the fastest single sync, compared with the
+    per-user rate limits. Only syncs are counted (not watch renewals or
+    token refreshes), so keep some headroom. The window is capped at the
+    COST_RETENTION_DAYS of per-sync rows kept; 'days_counted' is what the
+    averages are over.
+
+    Args:
+        user_id (int, optional): One user; the whole deployment if None
+
+    Returns:
+        dict
+    """
+    now = now or datetime.utcnow()
+    days_counted = raw_cost_days(days)
+    since = now - timedelta(days=days_counted)
+    syncs, users, gmail_requests, gmail_units, calendar_requests, peak_gmail_rate, peak_calendar_rate = \
+        CostTracker.quota_usage_query(since, user_id).one()
+
+    gmail_daily = (gmail_units or 0) / days_counted
+    calendar_daily = (calendar_requests or 0) / days_counted
+
+    def headroom(used, limit):
+        return {
+            'used': round(used, 2),
+            'limit': limit,
+            'percent_used': round(used / limit * 100, 4) if limit else None,
+            'headroom': round(limit - used, 2) if limit else None
+        }
+
+    projection = {
+        'days': days,
+        'days_counted': days_counted,
+        'since': since.isoformat(),
+        'syncs': syncs,
+        'users': users,
+        'gmail': {
+            'requests': gmail_requests or 0,
+            'quota_units': gmail_units or 0,
+            'units_per_day': headroom(gmail_daily, Config.GMAIL_QUOTA_UNITS_PER_DAY),
+            'projected_units_per_month': round(gmail_daily * 30),
+            'peak_units_per_user_second': headroom(peak_gmail_rate or 0.0, Config.GMAIL_QUOTA_UNITS_PER_USER_SECOND)
+        },
+        'calendar': {
+            'requests': calendar_requests or 0,
+            'requests_per_day': headroom(calendar_daily, Config.CALENDAR_QUOTA_REQUESTS_PER_DAY),
+            'projected_requests_per_month': round(calendar_daily * 30),
+            'peak_requests_per_user_minute': headroom((peak_calendar_rate or 0.0) * 60,
+                                                      Config.CALENDAR_QUOTA_REQUESTS_PER_USER_MINUTE)
+        }
+    }
+
+    if user_id is None and users:
+        # How many users like the current ones the daily limits leave room for
+        per_user_gmail = gmail_daily / users
+        per_user_calendar = calendar_daily / users
+        projection['supported_users'] = {
+            'gmail': int(Config.GMAIL_QUOTA_UNITS_PER_DAY / per_user_gmail) if per_user_gmail else None,
+            'calendar': int(Config.CALENDAR_QUOTA_REQUESTS_PER_DAY / per_user_calendar) if per_user_calendar else None
+        }
+    return projection
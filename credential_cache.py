@@ -0,0 +1,134 @@
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from config import Config
+from models import db
+from datetime import datetime, timedelta
+import threading
+
+
+class _CacheEntry:
+    """Decrypted credentials plus the stored token versions they correspond to"""
+
+    def __init__(self, credentials, versions):
+        self.credentials = credentials
+        # Encrypted (access_token, refresh_token) pairs this entry is valid for:
+        # the pair it was loaded from and any pair we wrote after refreshing.
+        self.versions = set(versions)
+
+
+class CredentialCache:
+    """
+    Process-wide cache of decrypted Google credentials, keyed by user ID
+
+    - Tokens are decrypted once and the Credentials object is shared by
+      every service built for that user in this process.
+    - Tokens are refreshed `refresh_margin` before token_expiry, so requests
+      never start with a token that is about to lapse.
+    - Refreshes are single-flight: one lock per user, so concurrent syncs
+      for the same user trigger exactly one refresh.
+    - The database is only written when a refresh actually happened.
+
+    A cached entry is invalidated automatically when the user's stored
+    (encrypted) tokens change to something we didn't write ourselves, e.g.
+    after a new OAuth login in another process.
+    """
+
+    def __init__(self, refresh_margin=timedelta(minutes=5)):
+        self.refresh_margin = refresh_margin
+        self._entries = {}
+        self._locks = {}
+        self._guard = threading.Lock()
+        self.refresh_count = 0
+
+    def _lock_for(self, user_id):
+        with self._guard:
+            return self._locks.setdefault(user_id, threading.Lock())
+
+    @staticmethod
+    def _version(user):
+        return (user.access_token, user.refresh_token)
+
+    def needs_refresh(self, credentials):
+        """True if the access token is missing, expired or about to expire"""
+        if not credentials.refresh_token:
+            return False
+        if not credentials.token:
+            return True
+        if credentials.expiry is None:
+            # Unknown expiry: let the transport refresh on a 401
+            return False
+        return credentials.expiry - self.refresh_margin <= datetime.utcnow()
+
+    def _lookup(self, user):
+        entry = self._entries.get(user.id)
+        if entry and self._version(user) in entry.versions \
+                and not self.needs_refresh(entry.credentials):
+            return entry.credentials
+        return None
+
+    def get(self, user, force_refresh=False):
+        """
+        Get valid credentials for a user, refreshing if necessary
+
+        Args:
+            user: User object
+            force_refresh (bool): Refresh even if the token still looks valid
+
+        Returns:
+            Credentials object
+        """
+        if not force_refresh:
+            credentials = self._lookup(user)
+            if credentials:
+                return credentials
+
+        with self._lock_for(user.id):
+            # Another thread may have refreshed while we waited
+            if not force_refresh:
+                credentials = self._lookup(user)
+                if credentials:
+                    return credentials
+
+            version = self._version(user)
+            entry = self._entries.get(user.id)
+            if entry and version in entry.versions:
+                credentials = entry.credentials
+            else:
+                credentials = Credentials(
+                    token=user.get_access_token(),
+                    refresh_token=user.get_refresh_token(),
+                    token_uri="https://oauth2.googleapis.com/token",
+                    client_id=Config.GOOGLE_CLIENT_ID,
+                    client_secret=Config.GOOGLE_CLIENT_SECRET,
+                    scopes=Config.SCOPES,
+                    expiry=user.token_expiry
+                )
+                entry = _CacheEntry(credentials, [version])
+
+            if force_refresh or self.needs_refresh(credentials):
+                self._refresh(user, credentials)
+                entry.versions.add(self._version(user))
+
+            self._entries[user.id] = entry
+            return credentials
+
+    def _refresh(self, user, credentials):
+        """Refresh the access token and persist it"""
+        old_refresh_token = credentials.refresh_token
+        credentials.refresh(Request())
+        self.refresh_count += 1
+
+        # Update stored tokens
+        user.set_access_token(credentials.token)
+        if credentials.refresh_token and credentials.refresh_token != old_refresh_token:
+            user.set_refresh_token(credentials.refresh_token)
+        user.token_expiry = credentials.expiry
+        db.session.commit()
+
+    def invalidate(self, user_id):
+        """Forget a user's cached credentials (e.g. after a new login)"""
+        with self._lock_for(user_id):
+            self._entries.pop(user_id, None)
+
+
+credential_cache = CredentialCache()
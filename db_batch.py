@@ -0,0 +1,78 @@
+from models import db
+
+
+class RowBuffer:
+    """
+    Buffer new rows and write them in chunked transactions
+
+    Each buffered unit is a parent row plus optional child rows. On flush,
+    every row is inserted inside its own SAVEPOINT, and each chunk of units
+    is committed with a single COMMIT. A row that violates a constraint only
+    rolls back its own savepoint (and its children, if it's a parent), so
+    one bad row never takes the rest of the chunk with it.
+
+    Children are linked to their parent after the parent's INSERT, by setting
+    `link_attr` on the child to the parent's primary key.
+
+    Args:
+        chunk_size (int): Units per transaction
+        link_attr (str): Foreign-key attribute on child rows
+    """
+
+    def __init__(self, chunk_size=50, link_attr='processed_email_id'):
+        self.chunk_size = chunk_size
+        self.link_attr = link_attr
+        self._pending = []
+        self.saved = 0
+        self.failed = []  # (row, exception)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, row, children=None):
+        """Queue a row (and the rows that depend on it) for the next flush"""
+        self._pending.append((row, list(children or [])))
+
+    def should_flush(self):
+        """True once a full chunk is waiting"""
+        return len(self._pending) >= self.chunk_size
+
+    def flush(self):
+        """
+        Write everything buffered so far
+
+        Returns:
+            list: (row, exception) for rows that could not be saved in this flush
+        """
+        pending, self._pending = self._pending, []
+        failures = []
+
+        for i in range(0, len(pending), self.chunk_size):
+            for row, children in pending[i:i + self.chunk_size]:
+                error = self._save(row)
+                if error:
+                    failures.append((row, error))
+                    failures.extend((child, error) for child in children)
+                    continue
+
+                for child in children:
+                    setattr(child, self.link_attr, row.id)
+                    child_error = self._save(child)
+                    if child_error:
+                        failures.append((child, child_error))
+
+            db.session.commit()
+
+        self.failed.extend(failures)
+        return failures
+
+    def _save(self, row):
+        """Insert one row inside a savepoint, returning the error if it failed"""
+        try:
+            with db.session.begin_nested():
+                db.session.add(row)
+            self.saved += 1
+            return None
+        except Exception as e:
+            print(f"Could not save {type(row).__name__}: {e}")
+            return e
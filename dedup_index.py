@@ -0,0 +1,187 @@
+from models import db, CalendarEvent
+from datetime import datetime, timedelta
+import bisect
+import re
+
+
+# Words that don't help tell two event titles apart
+STOPWORDS = {
+    'a', 'an', 'and', 'at', 'for', 'in', 'of', 'on', 'the', 'to', 'with',
+    'meeting', 'event', 'invitation', 'invite', 'reminder', 'call'
+}
+
+# Reply/forward/calendar-notification prefixes that show up in extracted titles
+PREFIX_RE = re.compile(
+    r'^\s*((re|fwd?|fw|updated invitation|invitation|accepted|tentative|reminder)\s*:\s*)+',
+    re.IGNORECASE
+)
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+def normalize_title(title):
+    """Lowercase a title and strip reply/forward prefixes and punctuation"""
+    if not title:
+        return ''
+    title = PREFIX_RE.sub('', title.lower())
+    return ' '.join(TOKEN_RE.findall(title))
+
+
+def title_tokens(title):
+    """Tokenize a title into a set of meaningful words"""
+    normalized = normalize_title(title)
+    tokens = frozenset(t for t in normalized.split() if t not in STOPWORDS)
+    # A title made only of stopwords ("Meeting") still needs something to compare
+    return tokens or frozenset(normalized.split())
+
+
+def title_similarity(a, b):
+    """
+    Similarity of two token sets in [0, 1]
+
+    Jaccard, except that a title which only gained words ("Team sync" vs
+    "Team sync w/ Alex") scores 1.0: when every word of the shorter title
+    (of at least two words) appears in the longer one, they name the same
+    thing. Titles that share words but each have their own ("Project Alpha
+    review" vs "Project Beta review") stay at their Jaccard score, since
+    those are usually different events.
+    """
+    if not a or not b:
+        return 0.0
+    shared = len(a & b)
+    smaller = min(len(a), len(b))
+    if smaller >= 2 and shared == smaller:
+        return 1.0
+    return shared / len(a | b)
+
+
+class IndexedEvent:
+    """An event in the interval index"""
+
+    __slots__ = ('title', 'tokens', 'start', 'end', 'ref')
+
+    def __init__(self, title, start, end, ref=None):
+        self.title = title
+        self.tokens = title_tokens(title)
+        self.start = start
+        self.end = end if end and end > start else start + timedelta(hours=1)
+        self.ref = ref
+
+
+class EventIntervalIndex:
+    """
+    In-memory interval index over a user's upcoming events
+
+    Events are kept in a list sorted by start time. A lookup bisects to the
+    window of events that could overlap the candidate (start within
+    [start - longest_duration - tolerance, end + tolerance]) and scores only
+    those, so each check is O(log n + k) with k the handful of events near
+    that time.
+
+    A candidate is a duplicate of an indexed event when their times overlap
+    (allowing `time_tolerance` of slack) and either
+      - the starts are within `time_tolerance` and the titles are similar, or
+      - the starts are further apart but the titles are near-identical.
+
+    Args:
+        time_tolerance (timedelta): Slack allowed between start times
+        similarity_threshold (float): Minimum title similarity for nearby starts
+        strict_similarity (float): Minimum title similarity for shifted starts
+    """
+
+    def __init__(self, time_tolerance=timedelta(minutes=15),
+                 similarity_threshold=0.6, strict_similarity=0.9):
+        self.time_tolerance = time_tolerance
+        self.similarity_threshold = similarity_threshold
+        self.strict_similarity = strict_similarity
+        self._starts = []
+        self._events = []
+        self._max_duration = timedelta(0)
+
+    @staticmethod
+    def load_query(user_id, since):
+        """Query for the events for_user() indexes (also EXPLAINed by migrations)"""
+        return db.session.query(
+            CalendarEvent.id,
+            CalendarEvent.event_title,
+            CalendarEvent.start_datetime,
+            CalendarEvent.end_datetime
+        ).filter(
+            CalendarEvent.user_id == user_id,
+            CalendarEvent.start_datetime >= since,
+            CalendarEvent.user_deleted.isnot(True)
+        ).order_by(CalendarEvent.start_datetime)
+
+    @classmethod
+    def for_user(cls, user_id, since=None, **kwargs):
+        """
+        Build an index from the user's upcoming CalendarEvents with one query
+
+        Args:
+            user_id (int): User to load events for
+            since (datetime, optional): Only events starting after this time
+                                        (defaults to one day ago)
+        """
+        index = cls(**kwargs)
+        since = since or datetime.now() - timedelta(days=1)
+
+        rows = cls.load_query(user_id, since).all()
+
+        for event_id, title, start, end in rows:
+            if start is None:
+                continue
+            index.add(title, start, end, ref=event_id)
+
+        return index
+
+    def __len__(self):
+        return len(self._events)
+
+    def add(self, title, start, end=None, ref=None):
+        """Insert an event, keeping the index sorted by start"""
+        entry = IndexedEvent(title, start, end, ref)
+        pos = bisect.bisect_right(self._starts, start)
+        self._starts.insert(pos, start)
+        self._events.insert(pos, entry)
+        self._max_duration = max(self._max_duration, entry.end - entry.start)
+        return entry
+
+    def remove(self, entry):
+        """Remove a previously added entry"""
+        lo = bisect.bisect_left(self._starts, entry.start)
+        hi = bisect.bisect_right(self._starts, entry.start)
+        for pos in range(lo, hi):
+            if self._events[pos] is entry:
+                del self._starts[pos]
+                del self._events[pos]
+                return True
+        return False
+
+    def find_match(self, title, start, end=None):
+        """
+        Find the best matching indexed event for a candidate
+
+        Returns:
+            IndexedEvent or None
+        """
+        candidate = IndexedEvent(title, start, end)
+        tolerance = self.time_tolerance
+
+        lo = bisect.bisect_left(self._starts, candidate.start - self._max_duration - tolerance)
+        hi = bisect.bisect_right(self._starts, candidate.end + tolerance)
+
+        best = None
+        best_score = 0.0
+        for entry in self._events[lo:hi]:
+            # Times must overlap, give or take the tolerance
+            if entry.start - tolerance > candidate.end or entry.end + tolerance < candidate.start:
+                continue
+
+            score = title_similarity(candidate.tokens, entry.tokens)
+            near_start = abs(entry.start - candidate.start) <= tolerance
+            threshold = self.similarity_threshold if near_start else self.strict_similarity
+
+            if score >= threshold and score > best_score:
+                best = entry
+                best_score = score
+
+        return best
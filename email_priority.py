@@ -0,0 +1,177 @@
+from models import SenderStat
+from datetime import datetime, timedelta
+from email.utils import parseaddr
+import re
+
+
+# How much each signal adds to an email's score. Scores are only compared
+# within one sync, so the scale is arbitrary; an invite attachment outweighs
+# everything else, and a sender who usually sends events comes next.
+WEIGHTS = {
+    'calendar_part': 5.0,
+    'sender': 3.0,  # times the sender's smoothed event rate
+    'date': 3.0,  # times 1 / (1 + days until the nearest date mentioned)
+    'keyword': 1.5,  # per invite keyword, up to MAX_KEYWORDS
+    'starred': 1.5,
+    'important': 1.0,
+    'category': -1.0,  # Promotions, Social, Updates or Forums
+    'demoted': -4.0,  # sender, domain or label with a long run of mail without events
+}
+MAX_KEYWORDS = 2
+
+# Event rate assumed for a sender with no history: (events + 1) / (emails + 4)
+SENDER_PRIOR_EVENTS = 1
+SENDER_PRIOR_EMAILS = 4
+
+# Dates further out than this don't make an email more urgent
+DATE_HORIZON_DAYS = 60
+
+KEYWORD_RE = re.compile(
+    r'\b(invitation|invite[ds]?|rsvp|save the date|appointment|reservation|booking|booked|'
+    r'meeting|interview|webinar|conference|dinner|lunch|breakfast|party|tickets?|flight|'
+    r'itinerary|check-in|scheduled|reschedul\w*|calendar)\b',
+    re.IGNORECASE
+)
+RELATIVE_DAY_RE = re.compile(r'\b(today|tonight|this evening|tomorrow)\b', re.IGNORECASE)
+WEEKDAY_RE = re.compile(r'\b(monday|tuesday|wednesday|thursday|friday|saturday|sunday)\b', re.IGNORECASE)
+MONTH_DAY_RE = re.compile(
+    r'\b(jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*\.?\s+(\d{1,2})(?:st|nd|rd|th)?\b',
+    re.IGNORECASE
+)
+NUMERIC_DATE_RE = re.compile(r'\b(\d{1,2})/(\d{1,2})(?:/(\d{2}|\d{4}))?\b')
+
+MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+CATEGORY_LABELS = {'CATEGORY_PROMOTIONS', 'CATEGORY_SOCIAL', 'CATEGORY_UPDATES', 'CATEGORY_FORUMS'}
+
+
+def sender_address(sender):
+    """Lowercased address from a From header ('Ann <ann@x.com>' -> 'ann@x.com')"""
+    return parseaddr(sender or '')[1].lower()
+
+
+def sender_domain(address):
+    """Domain part of an address ('ann@x.com' -> 'x.com')"""
+    return address.rpartition('@')[2] if '@' in address else ''
+
+
+def sender_stats_query(user_id, kind, keys):
+    """The user's SenderStat rows of one kind for `keys`"""
+    return SenderStat.query.filter(
+        SenderStat.user_id == user_id,
+        SenderStat.kind == kind,
+        SenderStat.key.in_(keys)
+    )
+
+
+def sender_rates(user_id, emails):
+    """Smoothed event rate per sender address of `emails`, from the user's sender stats"""
+    addresses = {sender_address(email.get('sender')) for email in emails} - {''}
+    if not addresses:
+        return {}
+    return {
+        stat.key: (stat.with_events + SENDER_PRIOR_EVENTS) / (stat.emails + SENDER_PRIOR_EMAILS)
+        for stat in sender_stats_query(user_id, 'address', list(addresses)).all()
+    }
+
+
+def days_until_mentioned_date(text, now):
+    """
+    Days from `now` to the nearest upcoming date mentioned in `text`, or None
+
+    Only cheap patterns are recognised: today/tonight/tomorrow, weekday names,
+    "Mar 5" style dates and m/d[/y] numbers. Dates in the past are ignored.
+    """
+    today = now.date()
+    found = []
+
+    for match in RELATIVE_DAY_RE.finditer(text):
+        found.append(1 if match.group(1).lower() == 'tomorrow' else 0)
+
+    for match in WEEKDAY_RE.finditer(text):
+        weekday = WEEKDAYS.index(match.group(1).lower())
+        found.append((weekday - today.weekday()) % 7)
+
+    candidates = []
+    for match in MONTH_DAY_RE.finditer(text):
+        candidates.append((MONTHS.index(match.group(1).lower()[:3]) + 1, int(match.group(2)), None))
+    for match in NUMERIC_DATE_RE.finditer(text):
+        year = match.group(3)
+        if year:
+            year = int(year) + 2000 if len(year) == 2 else int(year)
+        candidates.append((int(match.group(1)), int(match.group(2)), year))
+
+    for month, day, year in candidates:
+        try:
+            date = datetime(year or today.year, month, day).date()
+        except ValueError:
+            continue
+        if year is None and date < today - timedelta(days=1):
+            # "Jan 5" read in December means next year's
+            try:
+                date = date.replace(year=today.year + 1)
+            except ValueError:
+                continue
+        days = (date - today).days
+        if days >= 0:
+            found.append(days)
+
+    found = [days for days in found if days <= DATE_HORIZON_DAYS]
+    return min(found) if found else None
+
+
+def score_email(email, rates=None, now=None, demoted=False):
+    """
+    Expected-value score of an email, from signals available before extraction
+
+    Args:
+        email (dict): Email as returned by GmailService.get_email_details
+        rates (dict): Sender address -> smoothed event rate (see sender_rates)
+        now (datetime): Reference time for date proximity
+        demoted (bool): The sender stats marked the email as unlikely (see SenderPolicy)
+
+    Returns:
+        tuple: (score, signals) where signals holds each signal's contribution
+    """
+    now = now or datetime.now()
+    rates = rates or {}
+    labels = set(email.get('labels') or ())
+    text = f"{email.get('subject', '')} {email.get('snippet', '')}"
+
+    signals = {}
+    if email.get('has_calendar'):
+        signals['calendar_part'] = WEIGHTS['calendar_part']
+
+    rate = rates.get(sender_address(email.get('sender')), SENDER_PRIOR_EVENTS / SENDER_PRIOR_EMAILS)
+    signals['sender'] = WEIGHTS['sender'] * rate
+
+    days = days_until_mentioned_date(text, now)
+    if days is not None:
+        signals['date'] = WEIGHTS['date'] / (1 + days)
+
+    keywords = len({match.lower() for match in KEYWORD_RE.findall(text)})
+    if keywords:
+        signals['keyword'] = WEIGHTS['keyword'] * min(keywords, MAX_KEYWORDS)
+
+    if 'STARRED' in labels:
+        signals['starred'] = WEIGHTS['starred']
+    if 'IMPORTANT' in labels:
+        signals['important'] = WEIGHTS['important']
+    if labels & CATEGORY_LABELS:
+        signals['category'] = WEIGHTS['category']
+    if demoted:
+        signals['demoted'] = WEIGHTS['demoted']
+
+    return sum(signals.values()), signals
+
+
+def prioritize(emails, rates=None, now=None):
+    """
+    Emails ordered by score, highest first (ties keep their original order)
+
+    Returns:
+        list: (score, email) pairs
+    """
+    now = now or datetime.now()
+    scored = [(score_email(email, rates, now)[0], email) for email in emails]
+    return sorted(scored, key=lambda pair: pair[0], reverse=True)
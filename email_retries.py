@@ -0,0 +1,135 @@
+from gmail_service import TransientGmailError
+from event_extractor import TransientExtractionError
+from models import db, EmailRetry
+from timing import span
+from metrics import RETRIES
+from config import Config
+from datetime import datetime, timedelta
+
+
+# Failures worth retrying in a later sync rather than recording as final
+TRANSIENT_ERRORS = (TransientExtractionError, TransientGmailError)
+
+
+def due_retries_query(user_id, now):
+    """A user's failed emails whose next attempt is due, oldest first"""
+    return db.session.query(EmailRetry.email_id).filter(
+        EmailRetry.user_id == user_id,
+        EmailRetry.next_attempt_at <= now
+    ).order_by(EmailRetry.next_attempt_at)
+
+
+class RetryQueue:
+    """
+    A user's EmailRetry rows for the emails of one sync
+
+    Emails that fail transiently (TRANSIENT_ERRORS) aren't recorded as
+    processed; they're queued here and tried again by later syncs, with
+    exponential backoff, up to SYNC_RETRY_MAX_ATTEMPTS. The rows of queued
+    emails the sync got through are dropped with its next flush.
+
+    Args:
+        user_id (int): User whose sync this is
+        timer (StageTimer, optional): Times the commit of each failure
+    """
+
+    def __init__(self, user_id, timer=None):
+        self.user_id = user_id
+        self.timer = timer
+        self._retries = {}  # email_id -> EmailRetry
+        self._settled = set()  # emails to drop from the queue after the next flush
+
+    def load(self, email_ids):
+        """Read the queued retries among email_ids (one query)"""
+        if not email_ids:
+            return
+        self._retries = {retry.email_id: retry for retry in EmailRetry.query.filter(
+            EmailRetry.user_id == self.user_id,
+            EmailRetry.email_id.in_(email_ids)
+        ).all()}
+
+    def __contains__(self, email_id):
+        return email_id in self._retries
+
+    def queued_ids(self):
+        return set(self._retries)
+
+    def not_due(self, email_id, now):
+        """True if the email is queued and its next attempt is after `now`"""
+        retry = self._retries.get(email_id)
+        return retry is not None and retry.next_attempt_at > now
+
+    def subject(self, email_id):
+        retry = self._retries.get(email_id)
+        return retry.email_subject if retry else None
+
+    def settle(self, email_id):
+        """The email was handled; drop it from the queue with the next flush"""
+        if email_id in self._retries:
+            self._settled.add(email_id)
+
+    def failed(self, email_id, subject, error):
+        """
+        Queue an email that failed transiently, and commit
+
+        The n-th failure waits SYNC_RETRY_BASE_SECONDS * 2^(n-1) (capped at
+        SYNC_RETRY_MAX_SECONDS).
+
+        Returns:
+            tuple: (attempts, seconds until the next one); the delay is None
+            once the email has had SYNC_RETRY_MAX_ATTEMPTS, and the caller
+            should record it as failed instead
+        """
+        retry = self._retries.get(email_id)
+        attempts = (retry.attempts if retry else 0) + 1
+        if attempts >= Config.SYNC_RETRY_MAX_ATTEMPTS:
+            return attempts, None
+
+        RETRIES.inc('gmail' if isinstance(error, TransientGmailError) else 'openai', 'email_queue')
+        now = datetime.utcnow()
+        delay = min(Config.SYNC_RETRY_MAX_SECONDS, Config.SYNC_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+        if retry is None:
+            retry = EmailRetry(user_id=self.user_id, email_id=email_id, created_at=now)
+            db.session.add(retry)
+        retry.email_subject = subject or retry.email_subject
+        retry.attempts = attempts
+        retry.next_attempt_at = now + timedelta(seconds=delay)
+        retry.last_error = str(error)
+        retry.updated_at = now
+        with span(self.timer, 'db.retry'):
+            db.session.commit()
+
+        self._retries[email_id] = retry
+        return attempts, delay
+
+    def defer(self, email_id, subject, until, reason, row_buffer):
+        """
+        Queue an email until `until` without counting a failed attempt
+
+        A new row is added to row_buffer, so it's written with the sync's
+        next flush.
+        """
+        now = datetime.utcnow()
+        retry = self._retries.get(email_id)
+        if retry is None:
+            retry = EmailRetry(user_id=self.user_id, email_id=email_id, attempts=0, created_at=now)
+            row_buffer.add(retry)
+            self._retries[email_id] = retry
+        if subject is not None:
+            retry.email_subject = subject
+        retry.next_attempt_at = until
+        retry.last_error = f"Deferred: {reason}"
+        retry.updated_at = now
+
+    def drop_settled(self):
+        """Delete the settled emails' rows, and commit"""
+        if not self._settled:
+            return
+        EmailRetry.query.filter(
+            EmailRetry.user_id == self.user_id,
+            EmailRetry.email_id.in_(list(self._settled))
+        ).delete(synchronize_session=False)
+        for email_id in self._settled:
+            self._retries.pop(email_id, None)
+        self._settled.clear()
+        db.session.commit()
@@ -1,9 +1,26 @@
 import openai
 import json
 from config import Config
+from timing import span
+from metrics import RETRIES
+from token_estimator import estimate_chat_tokens
 from datetime import datetime
 
 
+class TransientExtractionError(Exception):
+    """Extraction failed for a reason that may go away (timeout, 5xx, throttling); try the email again later"""
+
+
+def is_transient_openai_error(error):
+    """Timeouts, connection failures, throttling and 5xx responses from Azure OpenAI"""
+    if isinstance(error, (openai.error.Timeout, openai.error.APIConnectionError,
+                          openai.error.ServiceUnavailableError, openai.error.TryAgain,
+                          openai.error.RateLimitError)):
+        return True
+    status = getattr(error, 'http_status', None)
+    return isinstance(error, openai.error.OpenAIError) and status is not None and status >= 500
+
+
 class EventExtractor:
     """Extract event information from email text using Azure OpenAI"""
     
@@ -16,41 +33,49 @@ class EventExtractor:
         openai.api_version = "2023-05-15"
         
         self.deployment_name = Config.AZURE_OPENAI_DEPLOYMENT
+        self.model = Config.AZURE_OPENAI_MODEL
+        # Used instead near a budget cap (see budget.BudgetGuard), if configured
+        self.cheap_deployment_name = Config.AZURE_OPENAI_CHEAP_DEPLOYMENT
+        self.cheap_model = Config.AZURE_OPENAI_CHEAP_MODEL
+        self.timer = None  # StageTimer of the sync using this extractor, if any
+    
+    def estimate_prompt_tokens(self, email_data, cheap=False):
+        """Prompt tokens extract_events will send for this email, counted locally"""
+        return estimate_chat_tokens(self._build_messages(email_data), self.cheap_model if cheap else self.model)
     
-    def extract_events(self, email_data, progress_callback=None):
+    def extract_events(self, email_data, progress_callback=None, cheap=False):
         """
         Extract event information from an email
         
         Args:
             email_data (dict): Email with 'subject', 'body', 'sender', 'date'
             progress_callback (function): Optional callback for progress updates
+            cheap (bool): Use the cheaper deployment (AZURE_OPENAI_CHEAP_DEPLOYMENT)
             
         Returns:
-            tuple: (events list, token_usage dict)
+            tuple: (events list, token_usage dict with the model it was billed as)
+        
+        Raises:
+            TransientExtractionError: the model was unreachable, overloaded or
+                still rate limited after the retries below
         """
         import time
-        prompt = self._build_extraction_prompt(email_data)
+        messages = self._build_messages(email_data)
+        deployment_name = self.cheap_deployment_name if cheap else self.deployment_name
+        model = self.cheap_model if cheap else self.model
 
         max_retries = 3
         retry_delay = 10  # seconds
         
         for attempt in range(max_retries):
             try:
-                response = openai.ChatCompletion.create(
-                    engine=self.deployment_name,
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": "You are an expert at extracting event information from emails. Always return valid JSON."
-                        },
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
-                    temperature=0.1,
-                    max_tokens=10000
-                )
+                with span(self.timer, 'openai.extract'):
+                    response = openai.ChatCompletion.create(
+                        engine=deployment_name,
+                        messages=messages,
+                        temperature=0.1,
+                        max_tokens=10000
+                    )
             
                 result_text = response.choices[0].message.content.strip()
 
@@ -72,7 +97,8 @@ class EventExtractor:
                 token_usage = {
                     'input_tokens': response.usage.prompt_tokens,
                     'output_tokens': response.usage.completion_tokens,
-                    'total_tokens': response.usage.total_tokens
+                    'total_tokens': response.usage.total_tokens,
+                    'model': model
                 }
 
                 print(f"Extracted {len(events)} event(s) from email: {email_data['subject']}")
@@ -83,13 +109,14 @@ class EventExtractor:
             except json.JSONDecodeError as e:
                 print(f"JSON decode error: {e}")
                 print(f"Response was: {result_text}")
-                return [], {'input_tokens': 0, 'output_tokens': 0, 'total_tokens': 0}
+                return [], {'input_tokens': 0, 'output_tokens': 0, 'total_tokens': 0, 'model': model}
             except Exception as e:
                 error_message = str(e)
                 
                 # Check if it's a rate limit error
                 if 'rate limit' in error_message.lower() and attempt < max_retries - 1:
                     print(f"Rate limit hit, waiting {retry_delay} seconds before retry {attempt + 1}/{max_retries}")
+                    RETRIES.inc('openai', 'in_call')
                     
                     # Report progress with countdown
                     if progress_callback:
@@ -107,11 +134,29 @@ class EventExtractor:
                     retry_delay *= 2  # Exponential backoff
                     continue
                 
+                # Worth another try in a later sync; don't record the email as empty
+                if is_transient_openai_error(e) or 'rate limit' in error_message.lower():
+                    print(f"Transient error extracting events: {e}")
+                    raise TransientExtractionError(error_message) from e
+                
                 # If not rate limit or last retry, return empty
                 print(f"Error extracting events: {e}")
-                return [], {'input_tokens': 0, 'output_tokens': 0, 'total_tokens': 0}
+                return [], {'input_tokens': 0, 'output_tokens': 0, 'total_tokens': 0, 'model': model}
 
 
+    def _build_messages(self, email_data):
+        """Chat messages for extracting one email's events"""
+        return [
+            {
+                "role": "system",
+                "content": "You are an expert at extracting event information from emails. Always return valid JSON."
+            },
+            {
+                "role": "user",
+                "content": self._build_extraction_prompt(email_data)
+            }
+        ]
+    
     def _build_extraction_prompt(self, email_data):
         """Build the prompt for event extraction"""
         current_year = datetime.now().year
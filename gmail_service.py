@@ -1,10 +1,25 @@
-from googleapiclient.discovery import build
+from google_clients import google_clients, ApiUsage
 from auth import GoogleOAuth
+from googleapiclient.errors import HttpError
+from timing import span
 from datetime import datetime, timedelta
 import base64
+import calendar
+import socket
 from email.mime.text import MIMEText
 
 
+class TransientGmailError(Exception):
+    """A Gmail call failed for a reason that may go away (timeout, 5xx, throttling)"""
+
+
+def is_transient_google_error(error):
+    """Timeouts, connection failures, 429s and 5xx responses from a Google API"""
+    if isinstance(error, HttpError):
+        return error.resp.status == 429 or error.resp.status >= 500
+    return isinstance(error, (socket.timeout, TimeoutError, ConnectionError))
+
+
 class GmailService:
     """Handle Gmail API operations"""
     
@@ -17,7 +32,9 @@ class GmailService:
         """
         self.user = user
         self.credentials = GoogleOAuth.get_credentials(user)
-        self.service = build('gmail', 'v1', credentials=self.credentials)
+        self.usage = ApiUsage('gmail')  # every request this service sends
+        self.service = google_clients.build('gmail', 'v1', self.credentials, usage=self.usage)
+        self.timer = None  # StageTimer of the sync using this service, if any
     
     def get_recent_emails(self, days=1, max_results=25, exclude_categories=True):
         """
@@ -31,38 +48,153 @@ class GmailService:
         Returns:
             list: List of email objects
         """
-        after_date = datetime.now() - timedelta(days=days)
-        after_date_str = after_date.strftime('%Y/%m/%d')
+        emails = []
+        for message_id in self.list_message_ids(days, max_results, exclude_categories):
+            try:
+                email_data = self.get_email_details(message_id)
+            except TransientGmailError:
+                continue
+            if email_data:
+                emails.append(email_data)
+        
+        return emails
+    
+    def list_message_ids(self, days=1, max_results=25, exclude_categories=True, after=None, before=None):
+        """
+        List the IDs of emails from the last N days, newest first, without fetching them
+        
+        Args:
+            days (int): Number of days to look back
+            max_results (int): Maximum number of IDs to return (pages through the results)
+            exclude_categories (bool): If True, exclude Promotions, Social, Updates, Forums
+            after (datetime, optional): UTC start of the window, instead of `days`
+            before (datetime, optional): UTC end of the window
+        
+        Returns:
+            list: Gmail message IDs (empty on error)
+        """
+        if after is not None:
+            query = f'after:{calendar.timegm(after.utctimetuple())}'
+        else:
+            after_date = datetime.now() - timedelta(days=days)
+            after_date_str = after_date.strftime('%Y/%m/%d')
+            query = f'after:{after_date_str}'
+        if before is not None:
+            query += f' before:{calendar.timegm(before.utctimetuple())}'
         
         # Build query to exclude Gmail categories
-        query = f'after:{after_date_str} -in:trash -is:archived'
+        query += ' -in:trash -is:archived'
         
         if exclude_categories:
             # Exclude Gmail's automatic categories
             query += ' -category:promotions -category:social'
         
         try:
-            results = self.service.users().messages().list(
-                userId='me',
-                q=query,
-                maxResults=max_results
-            ).execute()
-            
-            messages = results.get('messages', [])
+            message_ids = []
+            page_token = None
+            while len(message_ids) < max_results:
+                with span(self.timer, 'gmail.list'):
+                    results = self.service.users().messages().list(
+                        userId='me',
+                        q=query,
+                        maxResults=min(500, max_results - len(message_ids)),
+                        pageToken=page_token
+                    ).execute()
+                
+                message_ids.extend(msg['id'] for msg in results.get('messages', []))
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    break
             
-            print(f"Found {len(messages)} emails in last {days} days")
+            print(f"Found {len(message_ids)} emails for {query}")
             
-            emails = []
-            for msg in messages:
-                email_data = self.get_email_details(msg['id'])
-                if email_data:
-                    emails.append(email_data)
-            
-            return emails
+            return message_ids
             
         except Exception as e:
             print(f"Error fetching emails: {e}")
             return []  # Always return empty list on error, not None
+    
+    def watch(self, topic_name, label_ids=('INBOX',)):
+        """
+        Start (or renew) push notifications for new mail to a Pub/Sub topic
+        
+        Gmail stops sending after the returned expiration (about a week), so
+        watches have to be renewed.
+        
+        Returns:
+            dict: historyId (str) and expiration (epoch milliseconds, str)
+        """
+        with span(self.timer, 'gmail.watch'):
+            return self.service.users().watch(userId='me', body={
+                'topicName': topic_name,
+                'labelIds': list(label_ids),
+                'labelFilterBehavior': 'INCLUDE'
+            }).execute()
+    
+    def stop_watch(self):
+        """Stop push notifications for this mailbox"""
+        with span(self.timer, 'gmail.watch'):
+            self.service.users().stop(userId='me').execute()
+    
+    def list_history(self, start_history_id, max_results=100):
+        """
+        IDs of inbox messages added since a history ID, oldest first
+        
+        Args:
+            start_history_id (int): History ID to list changes after
+            max_results (int): Maximum number of IDs to return (pages through the history)
+        
+        Returns:
+            tuple: (message IDs, mailbox history ID the listing reached), or
+                   None if start_history_id is too old for Gmail to list from
+        
+        Raises:
+            TransientGmailError: Gmail timed out, throttled or returned a 5xx
+        """
+        message_ids = []
+        seen = set()
+        history_id = start_history_id
+        page_token = None
+        try:
+            while len(message_ids) < max_results:
+                with span(self.timer, 'gmail.history'):
+                    results = self.service.users().history().list(
+                        userId='me',
+                        startHistoryId=str(start_history_id),
+                        historyTypes=['messageAdded'],
+                        labelId='INBOX',
+                        maxResults=min(500, max_results),
+                        pageToken=page_token
+                    ).execute()
+                
+                history_id = int(results.get('historyId', history_id))
+                for record in results.get('history', []):
+                    for added in record.get('messagesAdded', []):
+                        message_id = added['message']['id']
+                        if message_id not in seen:
+                            seen.add(message_id)
+                            message_ids.append(message_id)
+                
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    break
+            
+            print(f"Found {len(message_ids)} new emails since history {start_history_id}")
+            return message_ids[:max_results], history_id
+        
+        except HttpError as e:
+            if e.resp.status == 404:
+                # History this old has been discarded; the caller falls back to a full listing
+                print(f"History {start_history_id} expired: {e}")
+                return None
+            if is_transient_google_error(e):
+                raise TransientGmailError(str(e)) from e
+            raise
+        except Exception as e:
+            if is_transient_google_error(e):
+                raise TransientGmailError(str(e)) from e
+            raise
+    
     def get_email_details(self, message_id):
         """
         Get full details of a specific email
@@ -71,14 +203,20 @@ class GmailService:
             message_id (str): Gmail message ID
             
         Returns:
-            dict: Email details including id, subject, body, date, sender, snippet
+            dict: Email details including id, subject, body, date, sender, snippet,
+                  labels (Gmail label IDs) and has_calendar (an invite or .ics part),
+                  or None if the email can't be read
+        
+        Raises:
+            TransientGmailError: Gmail timed out, throttled or returned a 5xx
         """
         try:
-            message = self.service.users().messages().get(
-                userId='me',
-                id=message_id,
-                format='full'
-            ).execute()
+            with span(self.timer, 'gmail.get'):
+                message = self.service.users().messages().get(
+                    userId='me',
+                    id=message_id,
+                    format='full'
+                ).execute()
             
             headers = message['payload']['headers']
             
@@ -99,11 +237,15 @@ class GmailService:
                 'sender': sender,
                 'date': date_str,
                 'body': body,
-                'snippet': snippet
+                'snippet': snippet,
+                'labels': message.get('labelIds', []),
+                'has_calendar': self._has_calendar_part(message['payload'])
             }
             
         except Exception as e:
             print(f"Error getting email {message_id}: {e}")
+            if is_transient_google_error(e):
+                raise TransientGmailError(str(e)) from e
             return None
     
     def _get_email_body(self, payload):
@@ -140,6 +282,14 @@ class GmailService:
         
         return body
     
+    def _has_calendar_part(self, payload):
+        """True if the payload or any nested part is an invite (text/calendar or .ics)"""
+        if payload.get('mimeType') in ('text/calendar', 'application/ics'):
+            return True
+        if payload.get('filename', '').lower().endswith('.ics'):
+            return True
+        return any(self._has_calendar_part(part) for part in payload.get('parts', []))
+    
     def search_emails(self, query, max_results=50):
         """
         Search emails with a custom query
@@ -152,11 +302,12 @@ class GmailService:
             list: List of email objects
         """
         try:
-            results = self.service.users().messages().list(
-                userId='me',
-                q=query,
-                maxResults=max_results
-            ).execute()
+            with span(self.timer, 'gmail.list'):
+                results = self.service.users().messages().list(
+                    userId='me',
+                    q=query,
+                    maxResults=max_results
+                ).execute()
             
             messages = results.get('messages', [])
             
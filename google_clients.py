@@ -0,0 +1,237 @@
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import Resource, build_from_document, fix_method_name
+from googleapiclient.http import HttpRequest
+from metrics import RETRIES
+import google_auth_httplib2
+import httplib2
+import json
+import threading
+
+
+class ThreadLocalHttp:
+    """
+    httplib2.Http stand-in that gives every thread its own Http object
+
+    httplib2.Http is not thread-safe, but creating one per request throws away
+    its keep-alive connections. This keeps one Http (and its connection pool)
+    per thread, shared by every user's requests made on that thread, so a
+    service object can also be used safely from worker threads.
+    """
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _http(self):
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = httplib2.Http(timeout=self.timeout)
+            self._local.http = http
+        return http
+
+    def request(self, *args, **kwargs):
+        return self._http().request(*args, **kwargs)
+
+    def close(self):
+        """Close this thread's connections"""
+        http = getattr(self._local, 'http', None)
+        if http is not None:
+            http.close()
+
+    def __getattr__(self, name):
+        # connections, add_certificate, redirect_codes, ... of this thread's Http
+        return getattr(self._http(), name)
+
+
+# Gmail quota units per method (https://developers.google.com/gmail/api/reference/quota);
+# methods not listed are charged DEFAULT_GMAIL_QUOTA_UNITS
+GMAIL_QUOTA_UNITS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.labels.list': 1,
+    'gmail.users.history.list': 2,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.attachments.get': 5,
+    'gmail.users.stop': 50,
+    'gmail.users.watch': 100,
+}
+DEFAULT_GMAIL_QUOTA_UNITS = 5
+
+# Calendar's quota counts requests, not units
+CALENDAR_QUOTA_UNITS = 1
+
+# Hosts the credentials refresh tokens against; not API usage
+NOT_COUNTED_HOSTS = ('oauth2.googleapis.com', 'accounts.google.com')
+
+# The API method being executed on this thread (set by CountedHttpRequest and execute_batch)
+_call = threading.local()
+
+
+def quota_units(api, method_id):
+    if api == 'gmail':
+        return GMAIL_QUOTA_UNITS.get(method_id, DEFAULT_GMAIL_QUOTA_UNITS)
+    return CALENDAR_QUOTA_UNITS
+
+
+class ApiUsage:
+    """
+    HTTP requests one service object sent to a Google API, per method
+
+    Counted at the transport, so a call that googleapiclient or the auth
+    layer re-sends (after a 401, or with num_retries) counts every time it
+    goes out, the repeats as retries; a batch counts each sub-request.
+    Token refreshes aren't counted. If `tracker` (a CostTracker) is set,
+    every request is also charged to it.
+    """
+
+    def __init__(self, api):
+        self.api = api
+        self.tracker = None
+        self._methods = {}  # method ID -> [requests, retries, quota units]
+        self._lock = threading.Lock()
+
+    def record(self, method_id, count=1, retry=False):
+        units = quota_units(self.api, method_id) * count
+        with self._lock:
+            totals = self._methods.setdefault(method_id, [0, 0, 0])
+            totals[0] += count
+            totals[1] += count if retry else 0
+            totals[2] += units
+        if retry:
+            RETRIES.inc(self.api, 'http', amount=count)
+        if self.tracker is not None:
+            self.tracker.add_api_requests(self.api, count, units, retry)
+
+    def summary(self):
+        """method ID -> requests, retries and quota_units"""
+        with self._lock:
+            return {method_id: {'requests': requests, 'retries': retries, 'quota_units': units}
+                    for method_id, (requests, retries, units) in self._methods.items()}
+
+
+class CountingHttp:
+    """Transport wrapper that records every API request in an ApiUsage"""
+
+    def __init__(self, http, usage):
+        self.http = http
+        self.usage = usage
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        call = getattr(_call, 'current', None)
+        if call is not None and not any(host in uri for host in NOT_COUNTED_HOSTS):
+            if call['batch_size']:
+                # The first send carries every sub-request; later ones re-send
+                # the sub-requests that got a 401
+                parts = max(1, str(body or '').count('Content-ID:'))
+                self.usage.record(call['method_id'], parts, retry=call['sent'] > 0)
+            else:
+                self.usage.record(call['method_id'], retry=call['sent'] > 0)
+            call['sent'] += 1
+        return self.http.request(uri, method, body, headers, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+
+class _CallScope:
+    def __init__(self, method_id, batch_size=0):
+        self.call = {'method_id': method_id, 'batch_size': batch_size, 'sent': 0}
+
+    def __enter__(self):
+        self.previous = getattr(_call, 'current', None)
+        _call.current = self.call
+
+    def __exit__(self, *exc):
+        _call.current = self.previous
+
+
+class CountedHttpRequest(HttpRequest):
+    """HttpRequest that tells CountingHttp which API method its sends belong to"""
+
+    def execute(self, http=None, num_retries=0):
+        with _CallScope(self.methodId):
+            return super().execute(http=http, num_retries=num_retries)
+
+
+def execute_batch(batch, method_id):
+    """
+    Execute a BatchHttpRequest whose sub-requests all call `method_id`,
+    counting each sub-request (see ApiUsage)
+    """
+    with _CallScope(method_id, batch_size=1):
+        batch.execute()
+
+
+class GoogleClientFactory:
+    """
+    Build Google API clients without re-parsing discovery documents
+
+    Each (api, version) is parsed once per process from the static discovery
+    documents shipped with google-api-python-client (no network fetch), and
+    a template Resource is built from it. Binding a user's credentials then
+    only creates a lightweight Resource that shares the parsed document,
+    schemas and model with the template, plus an AuthorizedHttp over the
+    shared per-thread transport. With an ApiUsage, the client's requests
+    are counted in it.
+    """
+
+    def __init__(self, transport=None):
+        self.transport = transport or ThreadLocalHttp()
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def _template(self, api, version):
+        key = (api, version)
+        template = self._templates.get(key)
+        if template is not None:
+            return template
+
+        with self._lock:
+            template = self._templates.get(key)
+            if template is None:
+                doc = discovery_cache.get_static_doc(api, version)
+                if doc is None:
+                    raise ValueError(f"No static discovery document for {api} {version}")
+                template = build_from_document(json.loads(doc), http=self.transport)
+                # googleapiclient fixes up method descriptions the first time each
+                # nested resource is built; do it now, before threads share the doc
+                self._warm(template, template._resourceDesc)
+                self._templates[key] = template
+        return template
+
+    def _warm(self, resource, desc):
+        for name, nested_desc in desc.get('resources', {}).items():
+            nested = getattr(resource, fix_method_name(name))()
+            self._warm(nested, nested_desc)
+
+    def build(self, api, version, credentials, usage=None):
+        """
+        Get a client for one API bound to a user's credentials
+
+        Args:
+            api (str): e.g. 'gmail'
+            version (str): e.g. 'v1'
+            credentials: google.auth credentials
+            usage (ApiUsage, optional): Where to count the client's requests
+
+        Returns:
+            googleapiclient Resource
+        """
+        template = self._template(api, version)
+        transport = CountingHttp(self.transport, usage) if usage is not None else self.transport
+        http = google_auth_httplib2.AuthorizedHttp(credentials, http=transport)
+
+        return Resource(
+            http=http,
+            baseUrl=template._baseUrl,
+            model=template._model,
+            requestBuilder=CountedHttpRequest,
+            developerKey=template._developerKey,
+            resourceDesc=template._resourceDesc,
+            rootDesc=template._rootDesc,
+            schema=template._schema
+        )
+
+
+google_clients = GoogleClientFactory()
+
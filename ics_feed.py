@@ -0,0 +1,308 @@
+from models import db, CalendarEvent, CalendarFeed, ProcessedEmail
+from sqlalchemy import func
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import hashlib
+import secrets
+import threading
+import gzip
+
+
+FEED_TIMEZONE = 'America/Los_Angeles'
+CALENDAR_NAME = 'Sift - Inbox Events'
+
+# How far back the feed reaches. Older events are dropped from the feed so it
+# doesn't grow forever; the window start is part of the ETag.
+FEED_LOOKBACK_DAYS = 90
+
+# Events are stored as naive Pacific times (see EventExtractor.format_for_google_calendar),
+# so the feed ships a matching VTIMEZONE definition.
+VTIMEZONE_LINES = [
+    'BEGIN:VTIMEZONE',
+    'TZID:America/Los_Angeles',
+    'BEGIN:DAYLIGHT',
+    'TZOFFSETFROM:-0800',
+    'TZOFFSETTO:-0700',
+    'TZNAME:PDT',
+    'DTSTART:19700308T020000',
+    'RRULE:FREQ=YEARLY;BYMONTH=3;BYDAY=2SU',
+    'END:DAYLIGHT',
+    'BEGIN:STANDARD',
+    'TZOFFSETFROM:-0700',
+    'TZOFFSETTO:-0800',
+    'TZNAME:PST',
+    'DTSTART:19701101T020000',
+    'RRULE:FREQ=YEARLY;BYMONTH=11;BYDAY=1SU',
+    'END:STANDARD',
+    'END:VTIMEZONE',
+]
+
+
+def escape_text(value):
+    """Escape a TEXT property value (RFC 5545 section 3.3.11)"""
+    if not value:
+        return ''
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace(';', '\\;')
+        .replace(',', '\\,')
+        .replace('\r\n', '\\n')
+        .replace('\n', '\\n')
+    )
+
+
+def fold_line(line):
+    """Fold a content line to 75 octets, continuation lines start with a space"""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line
+
+    parts = []
+    current = ''
+    current_len = 0
+    limit = 75
+    for char in line:
+        char_len = len(char.encode('utf-8'))
+        if current_len + char_len > limit:
+            parts.append(current)
+            current = ' '
+            current_len = 1
+            limit = 75
+        current += char
+        current_len += char_len
+    parts.append(current)
+    return '\r\n'.join(parts)
+
+
+def format_local(dt):
+    """Format a naive Pacific datetime for DTSTART/DTEND"""
+    return dt.strftime('%Y%m%dT%H%M%S')
+
+
+def format_utc(dt):
+    """Format a naive UTC datetime as an iCalendar UTC timestamp"""
+    return dt.strftime('%Y%m%dT%H%M%SZ')
+
+
+def render_vevent(uid, title, start, end, location=None, description=None,
+                  dtstamp=None, status=None):
+    """
+    Render a single VEVENT block
+
+    Args:
+        uid (str): Stable unique ID for the event
+        title (str): Event summary
+        start (datetime): Naive start time in FEED_TIMEZONE
+        end (datetime): Naive end time in FEED_TIMEZONE
+        location (str, optional): Event location
+        description (str, optional): Event description
+        dtstamp (datetime, optional): Naive UTC timestamp of the last change
+        status (str, optional): e.g. 'CANCELLED'
+
+    Returns:
+        str: CRLF-terminated VEVENT block
+    """
+    if end is None:
+        end = start + timedelta(hours=1)
+
+    lines = [
+        'BEGIN:VEVENT',
+        f'UID:{uid}',
+        f'DTSTAMP:{format_utc(dtstamp or datetime.utcnow())}',
+        f'DTSTART;TZID={FEED_TIMEZONE}:{format_local(start)}',
+        f'DTEND;TZID={FEED_TIMEZONE}:{format_local(end)}',
+        f'SUMMARY:{escape_text(title)}',
+    ]
+    if location:
+        lines.append(f'LOCATION:{escape_text(location)}')
+    if description:
+        lines.append(f'DESCRIPTION:{escape_text(description)}')
+    if status:
+        lines.append(f'STATUS:{status}')
+    lines.append('END:VEVENT')
+
+    return ''.join(fold_line(line) + '\r\n' for line in lines)
+
+
+def wrap_calendar(vevents, name=CALENDAR_NAME):
+    """Wrap rendered VEVENT blocks into a complete VCALENDAR document"""
+    header = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//Sift//Inbox Events//EN',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        f'X-WR-CALNAME:{escape_text(name)}',
+        f'X-WR-TIMEZONE:{FEED_TIMEZONE}',
+    ] + VTIMEZONE_LINES
+
+    return (
+        ''.join(fold_line(line) + '\r\n' for line in header)
+        + ''.join(vevents)
+        + 'END:VCALENDAR\r\n'
+    )
+
+
+def event_description(email_id=None, email_subject=None):
+    """Build the description the same way format_for_google_calendar does"""
+    if not email_id:
+        return None
+    description = f"📧 Source Email: https://mail.google.com/mail/u/0/#inbox/{email_id}"
+    if email_subject:
+        description += f"\nSubject: {email_subject}"
+    return description
+
+
+def get_or_create_feed(user):
+    """Return the user's CalendarFeed, creating one with a fresh token if needed"""
+    feed = CalendarFeed.query.filter_by(user_id=user.id).first()
+    if not feed:
+        feed = CalendarFeed(user_id=user.id, token=secrets.token_urlsafe(32))
+        db.session.add(feed)
+        db.session.commit()
+    return feed
+
+
+def rotate_feed_token(user):
+    """Replace the user's feed token, invalidating the old subscription URL"""
+    feed = get_or_create_feed(user)
+    feed.token = secrets.token_urlsafe(32)
+    db.session.commit()
+    feed_cache.invalidate(user.id)
+    return feed
+
+
+class RenderedFeed:
+    """A rendered feed body together with its validators"""
+
+    def __init__(self, etag, body):
+        self.etag = etag
+        self.body = body
+        self._gzipped = None
+
+    def gzipped(self):
+        """Gzip the body once and keep it for later requests"""
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, compresslevel=6, mtime=0)
+        return self._gzipped
+
+
+class FeedCache:
+    """
+    Per-process cache of rendered ICS feeds
+
+    A feed's identity is a fingerprint of its rows (count, max id, max
+    last_updated) plus the lookback window, computed with a single aggregate
+    query. When the fingerprint matches the cached one, the cached bytes (and
+    gzipped bytes) are served without loading any rows. When it doesn't, only
+    events whose last_updated changed are re-rendered.
+    """
+
+    def __init__(self, max_feeds=256, max_events=50000):
+        self.max_feeds = max_feeds
+        self.max_events = max_events
+        self._lock = threading.Lock()
+        self._feeds = OrderedDict()   # user_id -> RenderedFeed
+        self._events = OrderedDict()  # event id -> (last_updated, vevent text)
+
+    @staticmethod
+    def window_start(now=None):
+        """Start of the feed window, truncated to the day so it is stable"""
+        now = now or datetime.utcnow()
+        start = now - timedelta(days=FEED_LOOKBACK_DAYS)
+        return start.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    @staticmethod
+    def fingerprint_query(user_id, window_start):
+        """Aggregate query behind fingerprint() (also EXPLAINed by migrations)"""
+        return db.session.query(
+            func.count(CalendarEvent.id),
+            func.max(CalendarEvent.id),
+            func.max(CalendarEvent.last_updated)
+        ).filter(
+            CalendarEvent.user_id == user_id,
+            CalendarEvent.start_datetime >= window_start
+        )
+
+    def fingerprint(self, user_id, window_start):
+        """
+        Compute the ETag for a user's feed
+
+        There is deliberately no Last-Modified: max(last_updated) does not
+        move when events are deleted, so If-Modified-Since would keep serving
+        304s for a feed that lost rows. The row count in the ETag does change.
+
+        Returns:
+            str: etag
+        """
+        count, max_id, max_updated = self.fingerprint_query(user_id, window_start).one()
+
+        key = f"{user_id}:{window_start.isoformat()}:{count}:{max_id}:{max_updated}"
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get(self, user_id, etag):
+        """Return the cached RenderedFeed if it matches the etag"""
+        with self._lock:
+            feed = self._feeds.get(user_id)
+            if feed and feed.etag == etag:
+                self._feeds.move_to_end(user_id)
+                return feed
+        return None
+
+    def render(self, user_id, etag, window_start):
+        """Render (or re-render) a user's feed and cache it"""
+        rows = db.session.query(
+            CalendarEvent,
+            ProcessedEmail.email_id,
+            ProcessedEmail.email_subject
+        ).outerjoin(
+            ProcessedEmail, CalendarEvent.processed_email_id == ProcessedEmail.id
+        ).filter(
+            CalendarEvent.user_id == user_id,
+            CalendarEvent.start_datetime >= window_start
+        ).order_by(CalendarEvent.start_datetime, CalendarEvent.id).all()
+
+        vevents = []
+        with self._lock:
+            for event, email_id, email_subject in rows:
+                if event.user_deleted:
+                    continue
+
+                cached = self._events.get(event.id)
+                if cached and cached[0] == event.last_updated:
+                    self._events.move_to_end(event.id)
+                    vevents.append(cached[1])
+                    continue
+
+                text = render_vevent(
+                    uid=f"sift-{event.id}@sift",
+                    title=event.event_title,
+                    start=event.start_datetime,
+                    end=event.end_datetime,
+                    location=event.location,
+                    description=event_description(email_id, email_subject),
+                    dtstamp=event.last_updated or event.created_at,
+                    status='CANCELLED' if event.is_canceled else None
+                )
+                self._events[event.id] = (event.last_updated, text)
+                vevents.append(text)
+
+            while len(self._events) > self.max_events:
+                self._events.popitem(last=False)
+
+            feed = RenderedFeed(etag, wrap_calendar(vevents).encode('utf-8'))
+            self._feeds[user_id] = feed
+            self._feeds.move_to_end(user_id)
+            while len(self._feeds) > self.max_feeds:
+                self._feeds.popitem(last=False)
+
+        return feed
+
+    def invalidate(self, user_id):
+        """Drop a user's cached feed"""
+        with self._lock:
+            self._feeds.pop(user_id, None)
+
+
+feed_cache = FeedCache()
@@ -0,0 +1,377 @@
+from models import db, SyncJob, User, SyncCheckpoint
+from leases import lease_owner, acquire_lease, release_lease, leased_user_ids
+from leases import renew_lease as renew_user_lease
+from sqlalchemy import or_, and_
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+
+def enqueue_sync(user_id, kind='sync', params=None, priority=0, run_after=None):
+    """
+    Queue a sync for a user
+
+    If the user already has a queued or running job of the same kind, that
+    job is returned instead of queueing a second one. The uq_sync_jobs_active
+    partial unique index makes this hold for concurrent calls too.
+
+    Args:
+        run_after (datetime, optional): Don't start the job before this
+
+    Returns:
+        SyncJob
+    """
+    existing = _active_job(user_id, kind)
+    if existing:
+        return existing
+
+    job = SyncJob(
+        user_id=user_id,
+        kind=kind,
+        params=json.dumps(params or {}),
+        priority=priority,
+        run_after=run_after
+    )
+    db.session.add(job)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another request queued one between our check and insert
+        db.session.rollback()
+        return _active_job(user_id, kind)
+
+    job_available.set()
+    return job
+
+
+def _active_job(user_id, kind):
+    return SyncJob.query.filter(
+        SyncJob.user_id == user_id,
+        SyncJob.kind == kind,
+        SyncJob.status.in_(ACTIVE_STATUSES)
+    ).order_by(SyncJob.created_at.desc()).first()
+
+
+def _claimable(now):
+    """Queued jobs that are due, or running jobs whose worker stopped renewing its lease"""
+    return or_(
+        and_(SyncJob.status == 'queued', or_(SyncJob.run_after.is_(None), SyncJob.run_after <= now)),
+        and_(SyncJob.status == 'running', SyncJob.lease_expires_at < now)
+    )
+
+
+def _user_busy(now):
+    """Jobs for users another worker is syncing right now (they hold the 'sync' lease)"""
+    return SyncJob.user_id.in_(leased_user_ids('sync', now))
+
+
+def claim_job(worker_id, lease_seconds=120):
+    """
+    Claim the next runnable job
+
+    Candidates are read in claim order and taken with a compare-and-set
+    UPDATE, so two workers (threads, processes or machines) can never hold
+    the same job. On Postgres the candidate read also uses
+    FOR UPDATE SKIP LOCKED, and the claim happens in that same transaction,
+    so workers skip rows another worker is claiming instead of waiting on them.
+    Jobs for users whose 'sync' lease is held elsewhere are left for later.
+
+    Returns:
+        SyncJob or None
+    """
+    now = datetime.utcnow()
+
+    query = SyncJob.query.filter(_claimable(now), ~_user_busy(now)).order_by(
+        SyncJob.priority.desc(), SyncJob.created_at
+    ).limit(10)
+    if db.engine.dialect.name == 'postgresql':
+        query = query.with_for_update(skip_locked=True)
+    candidates = [(job.id, job.attempts or 0, job.max_attempts or 1) for job in query.all()]
+
+    # No commit until a job is claimed: it would release the row locks
+    for job_id, attempts, max_attempts in candidates:
+        if attempts >= max_attempts:
+            # Its worker died too many times; give up on it
+            db.session.query(SyncJob).filter(
+                SyncJob.id == job_id, _claimable(now)
+            ).update({
+                'status': 'error',
+                'error_message': f'Gave up after {attempts} attempts',
+                'finished_at': now,
+                'lease_owner': None
+            }, synchronize_session=False)
+            continue
+
+        claimed = db.session.query(SyncJob).filter(
+            SyncJob.id == job_id, _claimable(now)
+        ).update({
+            'status': 'running',
+            'lease_owner': worker_id,
+            'lease_expires_at': now + timedelta(seconds=lease_seconds),
+            'attempts': attempts + 1,
+            'started_at': now
+        }, synchronize_session=False)
+
+        if claimed:
+            db.session.commit()
+            return db.session.get(SyncJob, job_id)
+
+    db.session.commit()
+    return None
+
+
+def renew_lease(job_id, worker_id, lease_seconds=120):
+    """
+    Extend a job's lease
+
+    Returns:
+        bool: False if the lease was lost to another worker
+    """
+    renewed = db.session.query(SyncJob).filter(
+        SyncJob.id == job_id,
+        SyncJob.lease_owner == worker_id,
+        SyncJob.status == 'running'
+    ).update({
+        'lease_expires_at': datetime.utcnow() + timedelta(seconds=lease_seconds)
+    }, synchronize_session=False)
+    db.session.commit()
+    return bool(renewed)
+
+
+def release_job(job_id, worker_id):
+    """Put a claimed job back in the queue without counting the attempt"""
+    released = db.session.query(SyncJob).filter(
+        SyncJob.id == job_id,
+        SyncJob.lease_owner == worker_id,
+        SyncJob.status == 'running'
+    ).update({
+        'status': 'queued',
+        'lease_owner': None,
+        'lease_expires_at': None,
+        'attempts': SyncJob.attempts - 1
+    }, synchronize_session=False)
+    db.session.commit()
+    return bool(released)
+
+
+def finish_job(job_id, worker_id, result=None, error=None):
+    """Record a job's result, if this worker still holds its lease"""
+    finished = db.session.query(SyncJob).filter(
+        SyncJob.id == job_id,
+        SyncJob.lease_owner == worker_id
+    ).update({
+        'status': 'error' if error else 'complete',
+        'result': json.dumps(result) if result is not None else None,
+        'error_message': error,
+        'finished_at': datetime.utcnow(),
+        'lease_owner': None,
+        'lease_expires_at': None
+    }, synchronize_session=False)
+    if finished:
+        # A finished job is never resumed (same commit)
+        SyncCheckpoint.query.filter_by(job_id=job_id).delete()
+    db.session.commit()
+    return bool(finished)
+
+
+def job_to_dict(job):
+    """Public view of a job for the API"""
+    return {
+        'job_id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'attempts': job.attempts,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'error': job.error_message
+    }
+
+
+# Set when a job is enqueued in this process, so local workers wake up immediately
+job_available = threading.Event()
+
+
+class SyncWorkerPool:
+    """
+    Local pool of threads that run queued sync jobs
+
+    Each thread claims a job, runs SyncWorker.run_sync for it while a
+    heartbeat thread renews the lease, and stores the results on the job.
+    Jobs from crashed workers are picked up again once their lease expires.
+
+    A job only runs while its worker also holds the user's 'sync' lease, so
+    two jobs for the same user (different kinds, or a second pool on another
+    machine) never sync that user at once. A job whose user is busy goes
+    back to the queue.
+
+    Args:
+        app: Flask app (threads need an app context for the DB)
+        size (int): Number of worker threads
+        lease_seconds (int): Lease length; renewed every lease_seconds / 3
+        poll_interval (float): Seconds between queue checks when idle
+        progress_factory: Optional callable(job) -> progress_callback
+        worker_factory: Optional callable(user, **SyncWorker kwargs) -> SyncWorker
+    """
+
+    def __init__(self, app, size=2, lease_seconds=120, poll_interval=2.0, progress_factory=None,
+                 worker_factory=None):
+        self.app = app
+        self.size = size
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.progress_factory = progress_factory
+        self.worker_factory = worker_factory
+        self._threads = []
+        self._stop = threading.Event()
+        self._node = f"{socket.gethostname()}:{os.getpid()}"
+
+    def start(self):
+        """Start the worker threads"""
+        if self._threads:
+            return
+        for i in range(self.size):
+            thread = threading.Thread(target=self._run, args=(f"{self._node}:{i}",),
+                                      name=f'sync-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        print(f"Started {self.size} sync workers on {self._node}")
+
+    def stop(self):
+        self._stop.set()
+        job_available.set()
+
+    def _run(self, worker_id):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    job = claim_job(worker_id, self.lease_seconds)
+                    if job:
+                        self.run_job(job, worker_id)
+                        continue
+            except Exception as e:
+                print(f"Sync worker {worker_id} error: {e}")
+                traceback.print_exc()
+
+            job_available.wait(self.poll_interval)
+            job_available.clear()
+
+    def run_job(self, job, worker_id):
+        """Run one claimed job to completion"""
+        from sync_worker import SyncWorker
+
+        job_id = job.id
+        user_id = job.user_id
+        params = json.loads(job.params or '{}')
+
+        user_owner = lease_owner(f'sync:{job_id}')
+        user_ttl = timedelta(seconds=self.lease_seconds)
+        if not acquire_lease(user_id, 'sync', user_owner, ttl=user_ttl):
+            print(f"Worker {worker_id} requeued job {job_id}: user {user_id} is already syncing")
+            release_job(job_id, worker_id)
+            return
+
+        print(f"Worker {worker_id} running job {job_id} for user {user_id}")
+
+        stop_heartbeat = threading.Event()
+        lease_lost = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._heartbeat, args=(job_id, worker_id, stop_heartbeat, lease_lost, user_id, user_owner),
+            name=f'sync-heartbeat-{job_id}', daemon=True
+        )
+        heartbeat.start()
+
+        progress_callback = self.progress_factory(job) if self.progress_factory else None
+
+        try:
+            user = db.session.get(User, user_id)
+
+            make_worker = self.worker_factory or SyncWorker
+            if job.kind == 'backfill':
+                from backfill import run_backfill_window
+                results = run_backfill_window(make_worker, user, job_id=job_id, cancel=lease_lost,
+                                              progress_callback=progress_callback)
+            elif job.kind == 'push':
+                from push import run_push_sync
+                results = run_push_sync(make_worker, user, job_id=job_id, cancel=lease_lost,
+                                        progress_callback=progress_callback)
+            else:
+                # A job taken over from a dead worker resumes from its checkpoint
+                worker = make_worker(user, cancel=lease_lost, job_id=job_id)
+                results = worker.run_sync(days=params.get('days', 1), progress_callback=progress_callback)
+
+            if lease_lost.is_set():
+                # Another worker owns the job or is syncing the user; if the job
+                # is still ours it goes back to the queue, otherwise its new
+                # owner reports the outcome
+                print(f"Worker {worker_id} stopped job {job_id} after losing its lease")
+                release_job(job_id, worker_id)
+                return
+
+            if job.kind not in ('backfill', 'push'):
+                if not results.get('completed'):
+                    # run_sync caught the failure: the job failed and the user
+                    # wasn't synced (the emails it got to are already saved)
+                    error = results['errors'][-1] if results.get('errors') else 'Sync failed'
+                    finish_job(job_id, worker_id, result=results, error=error)
+                    return
+                user.last_sync = datetime.utcnow()
+                db.session.commit()
+
+            finish_job(job_id, worker_id, result=results)
+
+            if job.kind == 'backfill':
+                # One window per job, so live syncs for this user get a turn in between
+                from backfill import queue_next_window
+                queue_next_window(user_id)
+            elif job.kind == 'push':
+                # Mail notified while this job ran gets its own job
+                from push import queue_pending_push
+                queue_pending_push(user_id)
+        except Exception as e:
+            db.session.rollback()
+            print(f"Job {job_id} failed: {e}")
+            traceback.print_exc()
+            if lease_lost.is_set():
+                release_job(job_id, worker_id)
+                return
+            finish_job(job_id, worker_id, error=str(e))
+            if progress_callback:
+                progress_callback('error', 0, 1, f'Sync failed: {e}')
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+            release_lease(user_id, 'sync', user_owner)
+
+    def _heartbeat(self, job_id, worker_id, stop, lost, user_id, user_owner):
+        """Renew the job's and the user's leases until stopped; set `lost` if either can't be kept"""
+        interval = max(1.0, self.lease_seconds / 3)
+        user_ttl = timedelta(seconds=self.lease_seconds)
+        last_renewed = time.monotonic()
+        while not stop.wait(interval):
+            try:
+                with self.app.app_context():
+                    if not renew_lease(job_id, worker_id, self.lease_seconds):
+                        print(f"Lost lease on job {job_id}")
+                        lost.set()
+                        return
+                    if not renew_user_lease(user_id, 'sync', user_owner, ttl=user_ttl):
+                        print(f"Lost sync lease on user {user_id} (job {job_id})")
+                        lost.set()
+                        return
+                last_renewed = time.monotonic()
+            except Exception as e:
+                print(f"Heartbeat for job {job_id} failed: {e}")
+                if time.monotonic() - last_renewed >= self.lease_seconds:
+                    # The lease has run out; another worker may already have the job
+                    lost.set()
+                    return
+
@@ -0,0 +1,86 @@
+from models import db, UserLease
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta
+import os
+import socket
+import threading
+
+
+def lease_owner(role):
+    """Owner string identifying this process and thread for a kind of work"""
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}:{role}"
+
+
+def acquire_lease(user_id, purpose, owner, ttl=timedelta(minutes=1)):
+    """
+    Claim a user for one kind of work, across threads, processes and hosts
+
+    Takes the lease if nobody holds it, if it expired, or if `owner`
+    already holds it (re-entry extends it). Runs on its own connection so
+    it never commits the caller's session.
+
+    Returns:
+        bool: True if `owner` now holds the lease
+    """
+    now = datetime.utcnow()
+    table = UserLease.__table__
+    values = {'owner': owner, 'acquired_at': now, 'heartbeat_at': now, 'expires_at': now + ttl}
+
+    with db.engine.begin() as conn:
+        taken = conn.execute(
+            table.update().where(
+                table.c.user_id == user_id,
+                table.c.purpose == purpose,
+                (table.c.expires_at < now) | (table.c.owner == owner)
+            ).values(**values)
+        ).rowcount
+    if taken:
+        return True
+
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(table.insert().values(user_id=user_id, purpose=purpose, **values))
+        return True
+    except IntegrityError:
+        # Someone else holds a live lease
+        return False
+
+
+def renew_lease(user_id, purpose, owner, ttl=timedelta(minutes=1)):
+    """
+    Extend a lease held by `owner`
+
+    Returns:
+        bool: False if the lease expired and was taken by someone else
+    """
+    now = datetime.utcnow()
+    table = UserLease.__table__
+    with db.engine.begin() as conn:
+        renewed = conn.execute(
+            table.update().where(
+                table.c.user_id == user_id,
+                table.c.purpose == purpose,
+                table.c.owner == owner
+            ).values(heartbeat_at=now, expires_at=now + ttl)
+        ).rowcount
+    return bool(renewed)
+
+
+def release_lease(user_id, purpose, owner):
+    """Give up a lease (no-op if `owner` no longer holds it)"""
+    table = UserLease.__table__
+    with db.engine.begin() as conn:
+        conn.execute(table.delete().where(
+            table.c.user_id == user_id,
+            table.c.purpose == purpose,
+            table.c.owner == owner
+        ))
+
+
+def leased_user_ids(purpose, now=None):
+    """Query for the users with a live lease for `purpose` (usable in IN / NOT IN)"""
+    now = now or datetime.utcnow()
+    return db.session.query(UserLease.user_id).filter(
+        UserLease.purpose == purpose,
+        UserLease.expires_at >= now
+    )
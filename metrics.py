@@ -0,0 +1,432 @@
+from bisect import bisect_left
+import atexit
+import fcntl
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+
+# Services whose calls (timing.span stages '<service>.<call>') are exported as requests
+EXTERNAL_SERVICES = ('gmail', 'calendar', 'openai')
+
+# Dead processes' counters and histograms, folded together (see MetricsRegistry.compact)
+RETIRED_FILE = 'retired-metrics.json'
+
+# A process's file counts as live while it's rewritten at least every
+# max(STALE_AFTER_MIN_SECONDS, STALE_AFTER_INTERVALS * interval) seconds
+STALE_AFTER_MIN_SECONDS = 60.0
+STALE_AFTER_INTERVALS = 10
+
+# Retired process ids are kept this long, so a file of theirs written late isn't counted twice
+RETIRED_ID_SECONDS = 86400
+
+# Seconds; Google and OpenAI calls run from a few ms to tens of seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SYNC_BUCKETS = (1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Values per label tuple, updated under one lock (a dict update per call)"""
+
+    kind = None
+
+    def __init__(self, name, help_text, labels=(), registry=None):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def snapshot(self):
+        """JSON-safe values: [[label values, value], ...]"""
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """A current value; across processes the live processes' values are summed"""
+
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    """Bucket counts, sum and count per label tuple (buckets are upper bounds, not cumulative here)"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help_text, labels, registry)
+
+    def observe(self, value, *labels):
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][idx] += 1
+            state[1] += value
+            state[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), [list(counts), total, count]] for key, (counts, total, count) in self._values.items()]
+
+
+class MetricsRegistry:
+    """
+    The metrics of one process, and their Prometheus text exposition
+
+    Updates only touch memory. For deployments with several processes
+    (gunicorn workers, `flask run-workers`), each process writes its
+    values to `<directory>/metrics-<pid>-<process id>.json` every few
+    seconds and at exit (see start_snapshots), and render() adds up the
+    files of every process: counters and histograms from all of them, so
+    counts survive worker restarts, and gauges only from live processes.
+
+    The process id is a random one per process, so a new process that
+    gets a dead one's pid writes its own file instead of overwriting the
+    dead one's counters. Files of dead processes are folded into
+    RETIRED_FILE and deleted by compact().
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._pid = None
+        self._process_id = None
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    @property
+    def process_id(self):
+        """Random id of this process (a forked child gets a new one)"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._process_id = uuid.uuid4().hex
+        return self._process_id
+
+    def snapshot(self):
+        return {
+            'pid': os.getpid(),
+            'process': self.process_id,
+            'written_at': time.time(),
+            'metrics': {metric.name: metric.snapshot() for metric in self._metrics}
+        }
+
+    def write_snapshot(self, directory):
+        """Atomically replace this process's snapshot file"""
+        os.makedirs(directory, exist_ok=True)
+        _write_json(directory, f'metrics-{os.getpid()}-{self.process_id}.json', self.snapshot())
+
+    def _other_snapshots(self, directory):
+        """Snapshots other processes wrote: [(filename, snapshot), ...]"""
+        snapshots = []
+        if not directory or not os.path.isdir(directory):
+            return snapshots
+        for filename in os.listdir(directory):
+            if not (filename.startswith('metrics-') and filename.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    snapshot = json.load(f)
+            except (ValueError, OSError):
+                # Half-written or removed since the listing
+                continue
+            # Files of older versions were named by pid only
+            snapshot.setdefault('process', filename)
+            if snapshot['process'] != self.process_id:
+                snapshots.append((filename, snapshot))
+        return snapshots
+
+    def _merge(self, metric, merged, values):
+        """Add a snapshot's values of one metric into merged ({label tuple: value})"""
+        for key, value in values:
+            key = tuple(key)
+            if metric.kind == 'histogram':
+                state = merged.setdefault(key, [[0] * (len(metric.buckets) + 1), 0.0, 0])
+                if len(value[0]) != len(state[0]):
+                    continue  # written with other buckets by an older version
+                state[0] = [a + b for a, b in zip(state[0], value[0])]
+                state[1] += value[1]
+                state[2] += value[2]
+            else:
+                merged[key] = merged.get(key, 0) + value
+
+    def compact(self, directory, interval=5.0):
+        """
+        Fold the snapshot files of dead processes into RETIRED_FILE and delete them
+
+        A process is dead once its pid is gone or its file hasn't been
+        rewritten for the stale period (its pid was reused). Only counters
+        and histograms are kept; a dead process's gauges no longer apply.
+
+        Returns:
+            int: Number of files folded
+        """
+        if not directory or not os.path.isdir(directory):
+            return 0
+        now = time.time()
+        with _locked(directory, fcntl.LOCK_EX):
+            retired = _read_retired(directory)
+            metrics = {metric.name: metric for metric in self._metrics}
+            totals = {name: {tuple(key): value for key, value in values}
+                      for name, values in retired['metrics'].items() if name in metrics}
+
+            folded = []
+            for filename, snapshot in self._other_snapshots(directory):
+                if snapshot['process'] in retired['processes']:
+                    folded.append(filename)  # already in the totals; the delete didn't happen
+                    continue
+                if _snapshot_alive(snapshot, now, interval):
+                    continue
+                for name, values in snapshot['metrics'].items():
+                    metric = metrics.get(name)
+                    if metric is not None and metric.kind != 'gauge':
+                        self._merge(metric, totals.setdefault(name, {}), values)
+                retired['processes'][snapshot['process']] = now
+                folded.append(filename)
+            if not folded:
+                return 0
+
+            retired['processes'] = {process: retired_at for process, retired_at in retired['processes'].items()
+                                    if now - retired_at < RETIRED_ID_SECONDS}
+            retired['metrics'] = {name: [[list(key), value] for key, value in values.items()]
+                                  for name, values in totals.items()}
+            _write_json(directory, RETIRED_FILE, retired)
+            for filename in folded:
+                try:
+                    os.unlink(os.path.join(directory, filename))
+                except FileNotFoundError:
+                    pass
+        return len(folded)
+
+    def render(self, directory=None, interval=5.0):
+        """Prometheus text format (0.0.4) for this process plus the snapshots in `directory`"""
+        snapshots = [(self.snapshot(), True)]
+        if directory and os.path.isdir(directory):
+            now = time.time()
+            with _locked(directory, fcntl.LOCK_SH):
+                retired = _read_retired(directory)
+                snapshots.append(({'metrics': retired['metrics']}, False))
+                snapshots += [(snapshot, _snapshot_alive(snapshot, now, interval))
+                              for _, snapshot in self._other_snapshots(directory)
+                              if snapshot['process'] not in retired['processes']]
+
+        lines = []
+        for metric in self._metrics:
+            merged = {}
+            for snapshot, alive in snapshots:
+                if metric.kind == 'gauge' and not alive:
+                    continue
+                self._merge(metric, merged, snapshot['metrics'].get(metric.name, []))
+
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for key in sorted(merged):
+                value = merged[key]
+                if metric.kind != 'histogram':
+                    lines.append(f'{metric.name}{_labels(metric.label_names, key)} {_number(value)}')
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets + (math.inf,), counts):
+                    cumulative += bucket_count
+                    le = _labels(metric.label_names, key, [('le', _number(bound))])
+                    lines.append(f'{metric.name}_bucket{le} {cumulative}')
+                lines.append(f'{metric.name}_sum{_labels(metric.label_names, key)} {_number(float(total))}')
+                lines.append(f'{metric.name}_count{_labels(metric.label_names, key)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _write_json(directory, filename, data):
+    """Atomically replace directory/filename"""
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.metrics-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, os.path.join(directory, filename))
+    except Exception:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def _read_retired(directory):
+    try:
+        with open(os.path.join(directory, RETIRED_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'processes': {}, 'metrics': {}}
+
+
+class _locked:
+    """flock on the directory's lock file (shared to read, exclusive to compact)"""
+
+    def __init__(self, directory, operation):
+        self.path = os.path.join(directory, '.metrics.lock')
+        self.operation = operation
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file, self.operation)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+def _snapshot_alive(snapshot, now, interval):
+    stale_after = max(STALE_AFTER_MIN_SECONDS, STALE_AFTER_INTERVALS * interval)
+    if now - snapshot.get('written_at', 0) > stale_after:
+        return False
+    return _pid_alive(snapshot['pid'])
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+REGISTRY = MetricsRegistry()
+
+EXTERNAL_REQUEST_SECONDS = Histogram(
+    'sift_external_request_seconds', 'Latency of Gmail, Calendar and OpenAI calls', ('service', 'call'))
+EXTERNAL_REQUEST_ERRORS = Counter(
+    'sift_external_request_errors_total', 'Gmail, Calendar and OpenAI calls that raised', ('service', 'call'))
+RETRIES = Counter(
+    'sift_retries_total', 'Retries: in_call (waited and called again), email_queue (EmailRetry) '
+    'or http (requests re-sent by the Google API client)',
+    ('service', 'kind'))
+OPENAI_TOKENS = Counter(
+    'sift_openai_tokens_total', 'OpenAI tokens used, by model and direction', ('model', 'direction'))
+EXTRACTION_CACHE_HITS = Counter(
+    'sift_extraction_cache_hits_total', 'Emails not extracted again because ProcessedEmail already has them')
+EMAILS_SKIPPED = Counter(
+    'sift_emails_skipped_total', 'Emails a sync did not extract for other reasons', ('reason',))
+SSE_CONNECTIONS = Gauge(
+    'sift_sse_connections', 'Open /sync-progress event streams')
+SYNC_DURATION_SECONDS = Histogram(
+    'sift_sync_duration_seconds', 'Wall time of SyncWorker.run_sync', ('outcome',), buckets=SYNC_BUCKETS)
+DB_COMMIT_SECONDS = Histogram(
+    'sift_db_commit_seconds', 'Session commits, including the flush they trigger')
+
+
+def observe_call(stage, seconds, ok=True):
+    """Export one timing.span of a Gmail, Calendar or OpenAI call; other stages are ignored"""
+    service, _, call = stage.partition('.')
+    if service not in EXTERNAL_SERVICES:
+        return
+    EXTERNAL_REQUEST_SECONDS.observe(seconds, service, call)
+    if not ok:
+        EXTERNAL_REQUEST_ERRORS.inc(service, call)
+
+
+_sessions_instrumented = False
+
+
+def instrument_sessions():
+    """Time every ORM session commit into DB_COMMIT_SECONDS (idempotent)"""
+    global _sessions_instrumented
+    if _sessions_instrumented:
+        return
+    _sessions_instrumented = True
+
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+
+    @event.listens_for(Session, 'before_commit')
+    def _commit_started(session):
+        session.info['metrics_commit_started'] = time.perf_counter()
+
+    @event.listens_for(Session, 'after_commit')
+    def _commit_finished(session):
+        started = session.info.pop('metrics_commit_started', None)
+        if started is not None:
+            DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+
+    @event.listens_for(Session, 'after_rollback')
+    def _commit_abandoned(session):
+        session.info.pop('metrics_commit_started', None)
+
+
+_snapshot_thread = None
+
+
+def start_snapshots(directory, interval=5.0, registry=None):
+    """
+    Write this process's metrics to `directory` every `interval` seconds and at exit
+
+    Each write is followed by a compact(), so dead processes' files don't pile up.
+    No-op without a directory (single-process deployments) or if already started.
+    """
+    global _snapshot_thread
+    registry = registry or REGISTRY
+    if not directory or _snapshot_thread is not None:
+        return
+
+    def write():
+        try:
+            registry.write_snapshot(directory)
+        except Exception as e:
+            print(f"Could not write metrics snapshot: {e}")
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            write()
+            try:
+                registry.compact(directory, interval)
+            except Exception as e:
+                print(f"Could not compact metrics snapshots: {e}")
+
+    write()
+    atexit.register(write)
+    _snapshot_thread = threading.Thread(target=loop, name='metrics-snapshots', daemon=True)
+    _snapshot_thread.start()
@@ -0,0 +1,184 @@
+from models import db
+from sqlalchemy import inspect, text
+from datetime import datetime, timedelta
+
+
+def run_migrations():
+    """
+    Bring an existing database up to date with the models
+
+    db.create_all() only creates missing tables, so columns and indexes added
+    to tables that already exist are created here. New columns must be
+    nullable (existing rows get NULL). Safe to run on every startup.
+
+    Returns:
+        list: Names of the columns (table.column) and indexes that were missing and got created
+    """
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+
+    created = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            with db.engine.begin() as conn:
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            created.append(f'{table.name}.{column.name}')
+
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            try:
+                index.create(bind=db.engine, checkfirst=True)
+            except Exception as e:
+                # e.g. a new unique index over rows that already violate it;
+                # keep the app up and leave the index for an operator
+                print(f"WARNING: could not create index {index.name}: {e}")
+                continue
+            created.append(index.name)
+
+    if created:
+        print(f"Created columns and indexes: {', '.join(created)}")
+    return created
+
+
+def hot_queries(now=None):
+    """
+    The app's hot access paths and the index each one is expected to use
+
+    Each entry is built by the same function the app calls, so a change to
+    one of those queries is what gets EXPLAINed. An index of None means
+    "any index" (e.g. unique-constraint indexes whose name differs by dialect).
+
+    Returns:
+        list: (name, query, expected index name or None)
+    """
+    from dedup_index import EventIntervalIndex
+    from ics_feed import FeedCache
+    from cost_tracker import CostTracker
+    from token_refresher import due_users_query
+    from sync_worker import processed_ids_query
+    from email_retries import due_retries_query
+    from email_priority import sender_stats_query
+    from sender_stats import suppressed_stats_query, skipped_emails_query
+    from push import expiring_watches_query
+    from cost_rollups import pending_rollup_query, compactable_query
+
+    now = now or datetime.utcnow()
+    user_id = 1
+    since = now - timedelta(days=30)
+    until = now + timedelta(days=30)
+
+    return [
+        ('duplicate index load', EventIntervalIndex.load_query(user_id, since),
+         'ix_calendar_event_user_start'),
+        ('ics feed fingerprint', FeedCache.fingerprint_query(user_id, since),
+         'ix_calendar_event_user_start'),
+        ('recent syncs', CostTracker.recent_syncs_query(user_id),
+         'ix_sync_costs_user_sync_date'),
+        ('recent syncs page', CostTracker.recent_syncs_query(user_id, before=(since, 100)),
+         'ix_sync_costs_user_sync_date'),
+        ('cost totals', CostTracker.totals_query(user_id),
+         'uq_cost_rollups_user_day_model'),
+        ('30 day cost summary', CostTracker.totals_query(user_id, since.date()),
+         'uq_cost_rollups_user_day_model'),
+        ('cost by model', CostTracker.model_totals_query(user_id),
+         'uq_cost_rollups_user_day_model'),
+        ('sync timings', CostTracker.timings_query([1, 2]),
+         'ix_sync_timings_sync_cost'),
+        ('30 day stage timings', CostTracker.stage_totals_since_query(user_id, since),
+         'ix_sync_costs_user_sync_date'),
+        ('user quota usage', CostTracker.quota_usage_query(since, user_id),
+         'ix_sync_costs_user_sync_date'),
+        ('deployment quota usage', CostTracker.quota_usage_query(since),
+         'ix_sync_costs_sync_date'),
+        ('user budget spend', CostTracker.spend_query(since.date(), since.date(), user_id),
+         'uq_cost_rollups_user_day_model'),
+        ('deployment budget spend', CostTracker.spend_query(since.date(), since.date()),
+         'ix_cost_rollups_day'),
+        ('syncs to roll up', pending_rollup_query(500),
+         'ix_sync_costs_rolled_up'),
+        ('syncs to compact', compactable_query(since, 500),
+         'ix_sync_costs_rolled_up'),
+        ('tokens about to expire', due_users_query(until, since),
+         'ix_users_token_expiry'),
+        ('processed id preload', processed_ids_query(user_id, ['a', 'b']),
+         None),
+        ('due email retries', due_retries_query(user_id, now),
+         'ix_email_retries_user_next_attempt'),
+        ('sender rates', sender_stats_query(user_id, 'address', ['a@example.com', 'b@example.com']),
+         None),
+        ('suppressed senders', suppressed_stats_query(user_id, 5),
+         'ix_sender_stats_user_streak'),
+        ('skipped emails', skipped_emails_query(user_id),
+         'ix_processed_email_user_processed_at'),
+        ('gmail watches to renew', expiring_watches_query(until),
+         'ix_gmail_watches_expiration'),
+    ]
+
+
+def compile_query(query):
+    """SQL for an ORM query with its parameters inlined, for EXPLAIN"""
+    statement = getattr(query, 'statement', query)
+    return str(statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+
+
+def explain(sql, params=None):
+    """
+    Return the query plan for a statement as a single string
+
+    Uses EXPLAIN QUERY PLAN on SQLite and EXPLAIN on Postgres. On Postgres,
+    sequential scans are disabled for the check so that tiny test tables
+    still show whether an index *can* serve the query.
+    """
+    dialect = db.engine.dialect.name
+    params = params or {}
+
+    with db.engine.connect() as conn:
+        with conn.begin() as trans:
+            if dialect == 'sqlite':
+                rows = conn.execute(text('EXPLAIN QUERY PLAN ' + sql), params).fetchall()
+                plan = '\n'.join(str(row[-1]) for row in rows)
+            elif dialect == 'postgresql':
+                conn.execute(text('SET LOCAL enable_seqscan = off'))
+                rows = conn.execute(text('EXPLAIN ' + sql), params).fetchall()
+                plan = '\n'.join(str(row[0]) for row in rows)
+            else:
+                raise ValueError(f"Query plan check not supported on {dialect}")
+            trans.rollback()
+
+    return plan
+
+
+def plan_uses_index(plan, index_name=None):
+    """True if the plan reads through index_name (or any index if None)"""
+    if index_name:
+        return index_name in plan
+    upper = plan.upper()
+    return 'USING INDEX' in upper or 'USING COVERING INDEX' in upper or 'INDEX SCAN' in upper \
+        or 'INDEX ONLY SCAN' in upper or 'PRIMARY KEY' in upper
+
+
+def check_query_plans(verbose=True):
+    """
+    EXPLAIN every hot query and check it uses the expected index
+
+    Returns:
+        list: (name, expected_index, plan) for each query that did NOT use its index
+    """
+    failures = []
+    for name, query, index_name in hot_queries():
+        plan = explain(compile_query(query))
+        ok = plan_uses_index(plan, index_name)
+        if verbose:
+            print(f"[{'ok' if ok else 'FAIL'}] {name}: {plan.replace(chr(10), ' | ')}")
+        if not ok:
+            failures.append((name, index_name, plan))
+
+    return failures
@@ -1,28 +1,98 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from datetime import datetime
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
 import os
 import base64
 
 db = SQLAlchemy()
 
-# Simple encryption key (in production, use a proper key management system)
-# For now, we'll generate one if it doesn't exist
-ENCRYPTION_KEY = os.getenv('ENCRYPTION_KEY', Fernet.generate_key().decode())
+
+# pysqlite only opens a transaction before INSERT/UPDATE/DELETE, so a SAVEPOINT
+# issued first becomes the outermost transaction and its RELEASE commits
+# everything. Open the transaction ourselves right before the first SAVEPOINT
+# so nested transactions behave the same on SQLite as on Postgres, while plain
+# reads keep pysqlite's default (no lock held between statements).
+@event.listens_for(Engine, "savepoint")
+def _sqlite_begin_before_savepoint(conn, name):
+    if conn.dialect.name != 'sqlite':
+        return
+    dbapi_connection = conn.connection.dbapi_connection
+    if not dbapi_connection.in_transaction:
+        dbapi_connection.execute("BEGIN")
+
+
+# Token encryption keys, newest first. ENCRYPTION_KEYS is a comma-separated
+# list so keys can be rotated: new tokens are encrypted with the first key and
+# tokens encrypted with any listed key still decrypt.
+def _load_encryption_keys():
+    keys = [k.strip() for k in os.getenv('ENCRYPTION_KEYS', '').split(',') if k.strip()]
+    if not keys and os.getenv('ENCRYPTION_KEY'):
+        keys = [os.getenv('ENCRYPTION_KEY')]
+    
+    if not keys:
+        if os.getenv("FLASK_ENV", "development") == "production":
+            # A per-process random key makes tokens unreadable by other workers
+            # and after a restart, so every user would have to log in again
+            raise RuntimeError("ENCRYPTION_KEYS (or ENCRYPTION_KEY) is not set.")
+        print("WARNING: no ENCRYPTION_KEYS set, using a random key for this process")
+        keys = [Fernet.generate_key().decode()]
+    
+    return keys
+
+ENCRYPTION_KEYS = _load_encryption_keys()
+ENCRYPTION_KEY = ENCRYPTION_KEYS[0]
+
+_cipher = None
+_fernets = None
+
+
+def get_cipher():
+    """MultiFernet over ENCRYPTION_KEYS, built once per process"""
+    global _cipher, _fernets
+    if _cipher is None:
+        _fernets = [Fernet(key.encode()) for key in ENCRYPTION_KEYS]
+        _cipher = MultiFernet(_fernets)
+    return _cipher
+
 
 def encrypt_token(token):
     """Encrypt sensitive tokens before storing"""
     if not token:
         return None
-    f = Fernet(ENCRYPTION_KEY.encode())
-    return f.encrypt(token.encode()).decode()
+    return get_cipher().encrypt(token.encode()).decode()
 
 def decrypt_token(encrypted_token):
     """Decrypt tokens when needed"""
     if not encrypted_token:
         return None
-    f = Fernet(ENCRYPTION_KEY.encode())
-    return f.decrypt(encrypted_token.encode()).decode()
+    return get_cipher().decrypt(encrypted_token.encode()).decode()
+
+def reencrypted_token(encrypted_token):
+    """
+    A token re-encrypted with ENCRYPTION_KEYS[0], or None if it already is (or is empty)
+
+    Each key is tried in turn until one verifies the token, so it's only
+    decrypted once, by the key that encrypted it. The original timestamp is
+    kept, as MultiFernet.rotate does.
+
+    Raises:
+        InvalidToken: None of ENCRYPTION_KEYS encrypted it
+    """
+    if not encrypted_token:
+        return None
+    get_cipher()
+    token = encrypted_token.encode()
+    for index, fernet in enumerate(_fernets):
+        try:
+            plaintext = fernet.decrypt(token)
+        except InvalidToken:
+            continue
+        if index == 0:
+            return None
+        return _fernets[0].encrypt_at_time(plaintext, fernet.extract_timestamp(token)).decode()
+    raise InvalidToken
 
 
 class User(db.Model):
@@ -36,7 +106,7 @@ class User(db.Model):
     # Encrypted OAuth tokens
     access_token = db.Column(db.Text, nullable=False)
     refresh_token = db.Column(db.Text, nullable=False)
-    token_expiry = db.Column(db.DateTime)
+    token_expiry = db.Column(db.DateTime, index=True)  # scanned by TokenRefresher
     
     # Sift calendar ID in user's Google Calendar
     sift_calendar_id = db.Column(db.String(255))
@@ -45,6 +115,10 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_sync = db.Column(db.DateTime)
     
+    # OpenAI dollar caps (None = Config.USER_*_DOLLAR_CAP, 0 = no cap)
+    daily_dollar_cap = db.Column(db.Float)
+    monthly_dollar_cap = db.Column(db.Float)
+    
     # Relationships
     processed_emails = db.relationship('ProcessedEmail', backref='user', lazy=True, cascade='all, delete-orphan')
     
@@ -71,13 +145,14 @@ class ProcessedEmail(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)    
     email_id = db.Column(db.String(100), nullable=False)
     email_subject = db.Column(db.String(500))
+    email_sender = db.Column(db.String(320))  # lowercased From address
     email_date = db.Column(db.DateTime)
     
     # Processing info
     processed_at = db.Column(db.DateTime, default=datetime.utcnow)
     event_created = db.Column(db.Boolean, default=False)
     events_count = db.Column(db.Integer, default=0)
-    processing_status = db.Column(db.String(50), default='success')  # success, error, partial
+    processing_status = db.Column(db.String(50), default='success')  # success, error, partial, skipped (by sender stats or near a budget cap)
     error_message = db.Column(db.Text)
     
     # Relationship to events
@@ -85,6 +160,8 @@ class ProcessedEmail(db.Model):
     
     __table_args__ = (
         db.UniqueConstraint('user_id', 'email_id', name='unique_user_email'),
+        # Recent-activity lookups per user
+        db.Index('ix_processed_email_user_processed_at', 'user_id', 'processed_at'),
     )
 
 class SyncCost(db.Model):
@@ -105,15 +182,93 @@ class SyncCost(db.Model):
     
     # Costs (in USD)
     openai_cost = db.Column(db.Float, default=0.0)
-    gmail_api_calls = db.Column(db.Integer, default=0)
+    gmail_api_calls = db.Column(db.Integer, default=0)  # HTTP requests, batch sub-requests and retries included
     calendar_api_calls = db.Column(db.Integer, default=0)
     total_cost = db.Column(db.Float, default=0.0)
     
+    # Quota accounting
+    gmail_quota_units = db.Column(db.Integer)
+    gmail_retries = db.Column(db.Integer)
+    calendar_retries = db.Column(db.Integer)
+    duration_seconds = db.Column(db.Float)
+    
+    # Added to CostRollup (NULL for syncs saved before rollups existed; see cost_rollups)
+    rolled_up = db.Column(db.Boolean)
+    
     # Metadata
     model_used = db.Column(db.String(50))  # e.g., "gpt-4", "gpt-3.5-turbo"
     
     user = db.relationship('User', backref=db.backref('sync_costs', lazy=True))
     
+    __table_args__ = (
+        # /costs (latest syncs) and /costs/summary (date-range totals)
+        db.Index('ix_sync_costs_user_sync_date', 'user_id', 'sync_date'),
+        # Deployment-wide quota projection
+        db.Index('ix_sync_costs_sync_date', 'sync_date'),
+        # Syncs still to add to CostRollup, and rolled-up syncs old enough to compact
+        db.Index('ix_sync_costs_rolled_up', 'rolled_up', 'sync_date'),
+    )
+
+
+class CostRollup(db.Model):
+    """
+    A user's sync costs for one UTC day and model, summed as syncs are saved
+    
+    Per-sync counts (syncs, emails, events, Google API requests) are on the
+    row of the sync's main model; rows of other models it used (a cheaper
+    deployment near a budget cap) only have their tokens and cost.
+    """
+    __tablename__ = 'cost_rollups'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    model = db.Column(db.String(50), nullable=False)
+    
+    syncs = db.Column(db.Integer, default=0)
+    emails_processed = db.Column(db.Integer, default=0)
+    events_extracted = db.Column(db.Integer, default=0)
+    input_tokens = db.Column(db.Integer, default=0)
+    output_tokens = db.Column(db.Integer, default=0)
+    openai_cost = db.Column(db.Float, default=0.0)
+    total_cost = db.Column(db.Float, default=0.0)
+    gmail_api_calls = db.Column(db.Integer, default=0)
+    gmail_quota_units = db.Column(db.Integer, default=0)
+    calendar_api_calls = db.Column(db.Integer, default=0)
+    
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # One row per user, day and model; /costs, /costs/summary and user budgets
+        db.Index('uq_cost_rollups_user_day_model', 'user_id', 'day', 'model', unique=True),
+        # Deployment budgets
+        db.Index('ix_cost_rollups_day', 'day'),
+    )
+
+
+class SyncTiming(db.Model):
+    """Latency of one stage (Gmail, OpenAI, Calendar or DB calls) in one sync"""
+    __tablename__ = 'sync_timings'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    sync_cost_id = db.Column(db.Integer, db.ForeignKey('sync_costs.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    stage = db.Column(db.String(50), nullable=False)  # e.g. gmail.get, openai.extract, db.flush
+    
+    count = db.Column(db.Integer, default=0)
+    errors = db.Column(db.Integer, default=0)  # calls that raised
+    total_ms = db.Column(db.Float, default=0.0)
+    p50_ms = db.Column(db.Float)
+    p95_ms = db.Column(db.Float)
+    max_ms = db.Column(db.Float)
+    
+    sync_cost = db.relationship('SyncCost', backref=db.backref('timings', lazy=True))
+    
+    __table_args__ = (
+        # Timings of the syncs /costs lists
+        db.Index('ix_sync_timings_sync_cost', 'sync_cost_id', 'stage'),
+    )
+    
 class CalendarEvent(db.Model):
     """Track calendar events we've created"""
     id = db.Column(db.Integer, primary_key=True)
@@ -140,4 +295,270 @@ class CalendarEvent(db.Model):
     
     __table_args__ = (
         db.UniqueConstraint('user_id', 'gcal_event_id', name='unique_user_gcal_event'),
-    )
\ No newline at end of file
+        # Date-range scans: duplicate index load, ICS feed.
+        # last_updated is included so the feed fingerprint is index-only.
+        db.Index('ix_calendar_event_user_start', 'user_id', 'start_datetime', 'last_updated'),
+    )
+
+class CalendarFeed(db.Model):
+    """Secret-token ICS feed subscription for a user"""
+    __tablename__ = 'calendar_feeds'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, unique=True)
+    
+    # Secret part of the subscription URL (/feed/<token>.ics)
+    token = db.Column(db.String(64), nullable=False, unique=True)
+    
+    # Tracking
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    user = db.relationship('User', backref=db.backref('calendar_feed', uselist=False, lazy=True))
+
+
+def reencrypt_user_tokens(batch_size=100, pause=0.0):
+    """
+    Re-encrypt stored OAuth tokens with the newest key
+
+    Walks the users table by primary key in batches, rotating only tokens
+    that aren't already encrypted with ENCRYPTION_KEYS[0], and commits once
+    per batch. Once it has run, older keys can be dropped from the list.
+    
+    Each write is conditional on the row still holding the ciphertext that
+    was read, so a token refreshed concurrently (e.g. by the credential
+    cache) is never overwritten with the rotated old one. Such rows are
+    skipped; the refresh already encrypted them with the newest key.
+    
+    Rows that no configured key can decrypt (encrypted with a key that was
+    already dropped) are logged and skipped; those users have to log in again.
+    
+    Args:
+        batch_size (int): Users per transaction
+        pause (float): Seconds to sleep between batches
+    
+    Returns:
+        tuple: (users whose tokens were re-encrypted, users skipped as undecryptable)
+    """
+    import time
+    
+    users_table = User.__table__
+    rotated = 0
+    skipped = 0
+    last_id = 0
+    
+    while True:
+        rows = db.session.query(User.id, User.access_token, User.refresh_token)\
+            .filter(User.id > last_id).order_by(User.id).limit(batch_size).all()
+        if not rows:
+            break
+        
+        for user_id, access_token, refresh_token in rows:
+            try:
+                new_access_token = reencrypted_token(access_token)
+                new_refresh_token = reencrypted_token(refresh_token)
+            except InvalidToken:
+                print(f"Skipping user {user_id}: tokens don't decrypt with any of ENCRYPTION_KEYS")
+                skipped += 1
+                continue
+            
+            values = {}
+            if new_access_token:
+                values['access_token'] = new_access_token
+            if new_refresh_token:
+                values['refresh_token'] = new_refresh_token
+            if not values:
+                continue
+            
+            updated = db.session.execute(
+                users_table.update().where(
+                    users_table.c.id == user_id,
+                    users_table.c.access_token == access_token,
+                    users_table.c.refresh_token == refresh_token
+                ).values(**values)
+            ).rowcount
+            rotated += updated
+        
+        last_id = rows[-1][0]
+        db.session.commit()
+        
+        if pause:
+            time.sleep(pause)
+    
+    return rotated, skipped
+
+
+class SyncJob(db.Model):
+    """Queued sync run, claimed by a worker under a time-limited lease"""
+    __tablename__ = 'sync_jobs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    
+    # What to run
+    kind = db.Column(db.String(20), default='sync')
+    params = db.Column(db.Text)  # JSON arguments for the run
+    priority = db.Column(db.Integer, default=0)  # higher runs first
+    run_after = db.Column(db.DateTime)  # not claimed before this (debounced push syncs)
+    
+    # Queue state
+    status = db.Column(db.String(20), default='queued')  # queued, running, complete, error
+    attempts = db.Column(db.Integer, default=0)
+    max_attempts = db.Column(db.Integer, default=3)
+    lease_owner = db.Column(db.String(255))
+    lease_expires_at = db.Column(db.DateTime)
+    
+    # Outcome
+    result = db.Column(db.Text)  # JSON results from SyncWorker.run_sync
+    error_message = db.Column(db.Text)
+    
+    # Tracking
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    
+    user = db.relationship('User', backref=db.backref('sync_jobs', lazy=True))
+    
+    __table_args__ = (
+        # Claim order: runnable jobs by priority, oldest first
+        db.Index('ix_sync_jobs_claim', 'status', 'priority', 'created_at'),
+        db.Index('ix_sync_jobs_user_created', 'user_id', 'created_at'),
+        # At most one queued/running job per user and kind, even under concurrent enqueues
+        db.Index('uq_sync_jobs_active', 'user_id', 'kind', unique=True,
+                 sqlite_where=db.text("status IN ('queued', 'running')"),
+                 postgresql_where=db.text("status IN ('queued', 'running')")),
+    )
+
+
+class SyncProgress(db.Model):
+    """Latest progress update per sync job, shared between processes"""
+    __tablename__ = 'sync_progress'
+    
+    job_id = db.Column(db.Integer, db.ForeignKey('sync_jobs.id'), primary_key=True)
+    seq = db.Column(db.Integer, default=0)
+    status = db.Column(db.Text)  # JSON progress payload
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
+class UserLease(db.Model):
+    """Time-limited claim on a user for one kind of background work"""
+    __tablename__ = 'user_leases'
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    purpose = db.Column(db.String(32), primary_key=True)  # e.g. 'token_refresh'
+    
+    owner = db.Column(db.String(255), nullable=False)  # host:pid:thread of the holder
+    acquired_at = db.Column(db.DateTime, default=datetime.utcnow)
+    heartbeat_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+class SyncCheckpoint(db.Model):
+    """How far a sync job got, so a worker that takes the job over can resume it"""
+    __tablename__ = 'sync_checkpoints'
+    
+    job_id = db.Column(db.Integer, db.ForeignKey('sync_jobs.id'), primary_key=True)
+    
+    message_ids = db.Column(db.Text, nullable=False)  # JSON list of the job's emails, in order
+    position = db.Column(db.Integer, default=0)  # emails before this index are saved
+    results = db.Column(db.Text)  # JSON run_sync results so far
+    costs = db.Column(db.Text)  # JSON CostTracker counters so far
+    
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class EmailRetry(db.Model):
+    """An email whose sync failed transiently, waiting for its next attempt"""
+    __tablename__ = 'email_retries'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    email_id = db.Column(db.String(100), nullable=False)
+    email_subject = db.Column(db.String(500))
+    
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False)
+    last_error = db.Column(db.Text)
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'email_id', name='uq_email_retries_user_email'),
+        # Due retries per user
+        db.Index('ix_email_retries_user_next_attempt', 'user_id', 'next_attempt_at'),
+    )
+
+
+class BackfillState(db.Model):
+    """A user's walk back through older mail, one window at a time, newest first"""
+    __tablename__ = 'backfill_states'
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    
+    status = db.Column(db.String(20), default='running')  # running, paused, complete, budget_exhausted, error
+    oldest = db.Column(db.DateTime, nullable=False)  # done once windows reach back this far
+    cursor = db.Column(db.DateTime, nullable=False)  # the next window ends here
+    window_days = db.Column(db.Integer, default=7)
+    
+    # Budget for the whole backfill, and what it has used
+    token_budget = db.Column(db.Integer)
+    dollar_budget = db.Column(db.Float)
+    tokens_used = db.Column(db.Integer, default=0)
+    cost_used = db.Column(db.Float, default=0.0)
+    
+    windows_done = db.Column(db.Integer, default=0)
+    emails_processed = db.Column(db.Integer, default=0)
+    events_added = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.Text)
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class SenderStat(db.Model):
+    """Emails seen, and how many had events, per sender address, domain or Gmail label"""
+    __tablename__ = 'sender_stats'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    # 0 for stats across all users, so no foreign key
+    user_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(10), nullable=False)  # address, domain, label
+    key = db.Column(db.String(320), nullable=False)
+    
+    emails = db.Column(db.Integer, default=0)
+    with_events = db.Column(db.Integer, default=0)
+    zero_streak = db.Column(db.Integer, default=0)  # emails since the last one with events
+    last_event_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'kind', 'key', name='uq_sender_stats_user_kind_key'),
+        # Senders long enough without events to demote or skip
+        db.Index('ix_sender_stats_user_streak', 'user_id', 'zero_streak'),
+    )
+
+
+class GmailWatch(db.Model):
+    """A user's Gmail push subscription, and the notifications not synced yet"""
+    __tablename__ = 'gmail_watches'
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    email_address = db.Column(db.String(255), nullable=False)  # lowercased; how notifications name the user
+    topic = db.Column(db.String(255))  # Pub/Sub topic, or 'local' for the stand-in notifier
+    expiration = db.Column(db.DateTime)  # Gmail stops sending after this unless renewed
+    
+    history_id = db.Column(db.BigInteger)  # mailbox history synced up to
+    latest_history_id = db.Column(db.BigInteger)  # highest historyId notified
+    pending_since = db.Column(db.DateTime)  # first notification not synced yet
+    last_notified_at = db.Column(db.DateTime)
+    notifications = db.Column(db.Integer, default=0)
+    last_delay_seconds = db.Column(db.Float)  # notification to first calendar event, last push sync
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_gmail_watches_email', 'email_address', unique=True),
+        # Watches to renew before they expire
+        db.Index('ix_gmail_watches_expiration', 'expiration'),
+    )
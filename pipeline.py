@@ -0,0 +1,286 @@
+from email_retries import TRANSIENT_ERRORS
+from config import Config
+from collections import deque
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class StageStats:
+    """Items handled and time spent by one pipeline stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, seconds, ok=True):
+        with self._lock:
+            self.items += 1
+            self.busy_seconds += seconds
+            if not ok:
+                self.errors += 1
+
+    def per_second(self):
+        """Items per wall-clock second since the stage started"""
+        elapsed = time.monotonic() - self.started_at
+        return self.items / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        with self._lock:
+            return {
+                'items': self.items,
+                'errors': self.errors,
+                'busy_seconds': round(self.busy_seconds, 3),
+                'per_second': round(self.per_second(), 2)
+            }
+
+
+class StagePool:
+    """
+    A fixed pool of threads applying one function to items from a bounded queue
+
+    `submit` returns a Future for the item's result and blocks while the queue
+    is full, so a slow stage pushes back on whatever feeds it instead of
+    letting work pile up in memory.
+
+    Args:
+        name (str): Stage name used in stats and thread names
+        fn (callable): Applied to each submitted item's arguments
+        workers (int): Number of threads
+        queue_size (int): Items that may wait for a free thread
+    """
+
+    def __init__(self, name, fn, workers, queue_size):
+        self.name = name
+        self.fn = fn
+        self.stats = StageStats(name)
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._threads = [
+            threading.Thread(target=self._run, name=f'{name}-{i}', daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, *args):
+        """Queue fn(*args), blocking while the stage is saturated"""
+        future = Future()
+        self._queue.put((future, args))
+        return future
+
+    def shutdown(self, cancel_pending=False):
+        """
+        Stop the threads once the queue has drained
+
+        Args:
+            cancel_pending (bool): Cancel items that haven't started instead of running them
+        """
+        if cancel_pending:
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    item[0].cancel()
+
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            future, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            started = time.monotonic()
+            try:
+                result = self.fn(*args)
+            except BaseException as e:
+                self.stats.record(time.monotonic() - started, ok=False)
+                future.set_exception(e)
+            else:
+                self.stats.record(time.monotonic() - started)
+                future.set_result(result)
+
+
+def throughput_message(pools):
+    """One-line per-stage throughput, e.g. 'fetch 12.0/s, extract 2.1/s'"""
+    return ', '.join(f'{pool.name} {pool.stats.per_second():.1f}/s' for pool in pools)
+
+
+class PipelinedSync:
+    """
+    Overlap a SyncWorker's Gmail fetches, extraction and calendar writes in separate thread pools
+
+    Fetch workers hand each email straight to the extraction pool; both pools
+    have bounded queues, and at most `window` emails are in flight, so a slow
+    stage holds back the ones before it. The sync's thread consumes the
+    results in the original email order and runs the worker's own per-email
+    steps (the ones its serial path uses), doing all DB and duplicate-index
+    work, so the outcome matches the serial path. Calendar writes are handed
+    to their own pool once the email is committed; the worker sends them
+    here with submit_write().
+
+    Args:
+        worker (SyncWorker): The sync to run
+    """
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.queue_size = Config.SYNC_PIPELINE_QUEUE_SIZE
+        self.window = Config.SYNC_FETCH_WORKERS + Config.SYNC_EXTRACT_WORKERS + 2 * self.queue_size
+        self._inflight = deque()  # _PendingWrite, oldest first
+        self._write_pool = None
+
+    def run(self, work, results, progress_callback=None):
+        """Process `work` ((index, message_id, skip) from SyncWorker._plan_work) in order"""
+        worker = self.worker
+
+        def extract(email, plan):
+            return worker._extract(email, plan, progress_callback)
+
+        extract_pool = StagePool('extract', extract, Config.SYNC_EXTRACT_WORKERS, self.queue_size)
+
+        def fetch(message_id):
+            """(email, extraction future, BudgetPlan); emails the plan holds back aren't extracted"""
+            plan = worker.admission.exhausted() if worker.admission is not None else None
+            if plan is not None:
+                return None, None, plan
+            email = worker._fetch(message_id)
+            if not email:
+                return None, None, None
+            if worker._sender_decision(email)[0] == 'skip':
+                return email, None, None
+            plan = worker._budget_plan(email)
+            if plan is not None and not plan.extract:
+                return email, None, plan
+            # Blocks while extraction is saturated
+            return email, extract_pool.submit(email, plan), plan
+
+        fetch_pool = StagePool('fetch', fetch, Config.SYNC_FETCH_WORKERS, self.window)
+        self._write_pool = StagePool('write', worker._write_events, Config.SYNC_WRITE_WORKERS, self.queue_size)
+        pools = (fetch_pool, extract_pool, self._write_pool)
+
+        to_fetch = iter([message_id for _, message_id, skip in work if not skip])
+        ahead = deque()  # (message_id, fetch future) in email order
+
+        def top_up():
+            while len(ahead) < self.window:
+                message_id = next(to_fetch, None)
+                if message_id is None:
+                    return
+                ahead.append((message_id, fetch_pool.submit(message_id)))
+
+        total_emails = len(worker._message_ids)
+        aborted = True
+        try:
+            top_up()
+            for idx, message_id, skip in work:
+                worker._check_cancelled()
+                n = idx + 1
+
+                if not skip and worker._budget_spent(results):
+                    # Emails already extracting still count against the budget
+                    break
+
+                if skip:
+                    worker._skip(message_id, skip, results)
+                    worker._position = n
+                    if progress_callback:
+                        progress_callback(
+                            'processing', n, total_emails,
+                            f'[processing] Email {n}/{total_emails}: skipped ({n}/{total_emails}) | {throughput_message(pools)}'
+                        )
+                    continue
+
+                _, fetched = ahead.popleft()
+                top_up()
+                plan = None
+                extraction = None
+                try:
+                    email, extraction, plan = fetched.result()
+                    if plan is not None and not plan.extract:
+                        # Planned while the emails before it still held reservations;
+                        # they've settled by now, so decide again (extracting here if it fits)
+                        email, plan = worker._admit(message_id, results, email)
+                    elif email is None:
+                        results['emails_scanned'] -= 1
+                except TRANSIENT_ERRORS as e:
+                    worker._retry_later(message_id, None, e, results)
+                    email = None
+
+                decision, reason = worker._sender_decision(email) if email is not None else (None, None)
+                if decision == 'skip':
+                    worker._skip_sender(email, reason, results)
+                elif email is not None:
+                    if progress_callback:
+                        progress_callback(
+                            'processing', n, total_emails,
+                            f'[processing] Email {n}/{total_emails}: {worker._short_subject(email)}... ({n}/{total_emails}) | {throughput_message(pools)}'
+                        )
+
+                    worker._process_email(email, results, progress_callback, extraction=extraction, plan=plan)
+
+                # Record finished writes as they come in, and never let more
+                # than a queue's worth wait for the sink
+                while self._inflight and (self._inflight[0].future.done() or len(self._inflight) > self.queue_size):
+                    self._settle_oldest_write(results)
+
+                worker._position = n
+                if worker._should_flush():
+                    worker._flush_rows(results)
+
+            self.settle_writes(results)
+            aborted = results['budget_exhausted']
+        finally:
+            fetch_pool.shutdown(cancel_pending=aborted)
+            extract_pool.shutdown(cancel_pending=aborted)
+            self.settle_writes(results)
+            self._write_pool.shutdown()
+            self._write_pool = None
+            results['pipeline'] = {pool.name: pool.stats.summary() for pool in pools}
+            print(f"Pipeline throughput: {throughput_message(pools)}")
+
+    def submit_write(self, write):
+        """Send a committed email's events (a _PendingWrite) to the write pool"""
+        write.future = self._write_pool.submit(write.events)
+        self._inflight.append(write)
+
+    def _settle_oldest_write(self, results):
+        """Wait for the oldest in-flight write and record its outcome"""
+        write = self._inflight.popleft()
+        self.worker._record_writes(write, write.future.result(), results)
+
+    def settle_writes(self, results, entry=None):
+        """
+        Record in-flight writes, oldest first
+
+        Args:
+            entry: Only settle up to the write that owns this index entry
+
+        Returns:
+            bool: Whether anything was settled
+        """
+        if entry is not None and not any(entry in write.entries for write in self._inflight):
+            return False
+
+        settled = False
+        while self._inflight:
+            write = self._inflight[0]
+            self._settle_oldest_write(results)
+            settled = True
+            if entry is not None and entry in write.entries:
+                break
+        return settled
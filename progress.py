@@ -0,0 +1,426 @@
+from models import db, SyncProgress
+from metrics import SSE_CONNECTIONS
+from sqlalchemy import case, select
+from sqlalchemy.exc import IntegrityError
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+import json
+import threading
+import time
+
+
+FINAL_STAGES = ('complete', 'error')
+
+
+def build_status(stage, current, total, message, seq=0):
+    """Progress payload sent to the browser"""
+    return {
+        'stage': stage,
+        'progress': int((current / total * 100)) if total > 0 else 0,
+        'message': message,
+        'total': total,
+        'current': current,
+        'seq': seq
+    }
+
+
+class ProgressChannel:
+    """Progress for one job: latest status, recent history and its listeners"""
+
+    __slots__ = ('job_id', 'status', 'seq', 'updated_at', 'finished_at', 'local',
+                 'history', 'changed', 'publish_lock')
+
+    def __init__(self, job_id, lock, history_size=50):
+        self.job_id = job_id
+        self.status = None
+        self.seq = 0
+        self.updated_at = time.monotonic()
+        self.finished_at = None
+        self.local = False  # True if a worker in this process publishes it
+        self.history = deque(maxlen=history_size)  # for Last-Event-ID resume
+        self.changed = threading.Condition(lock)
+        self.publish_lock = threading.Lock()  # keeps one job's updates in seq order
+
+
+class ProgressRegistry:
+    """
+    Progress for every sync job this process knows about, keyed by job ID
+
+    Memory is bounded: finished jobs are evicted `ttl` seconds after they
+    finish, and if more than `max_jobs` channels exist the least recently
+    updated ones are dropped (finished ones first).
+
+    Updates published here are also handed to a broker so that listeners
+    in other processes (e.g. another gunicorn worker serving the SSE
+    connection) see them; updates arriving from the broker are delivered
+    back through deliver(). A broker that stores updates also allocates
+    their seq, so seqs keep increasing when a job's updates come from
+    several processes (the web process queues it, a worker runs it).
+
+    Args:
+        max_jobs (int): Max channels kept in memory
+        ttl (float): Seconds to keep a finished job's progress
+        broker: Object with publish(job_id, status) and start(registry)
+        history_size (int): Updates kept per job for resuming streams
+    """
+
+    def __init__(self, max_jobs=1000, ttl=600, broker=None, history_size=50):
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.broker = broker
+        self.history_size = history_size
+        self._channels = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _channel(self, job_id):
+        channel = self._channels.get(job_id)
+        if channel is None:
+            channel = ProgressChannel(job_id, self._lock, self.history_size)
+            self._channels[job_id] = channel
+        self._channels.move_to_end(job_id)
+        return channel
+
+    def _store(self, channel, status):
+        channel.seq = status.get('seq', channel.seq + 1)
+        channel.status = status
+        channel.history.append(status)
+        channel.updated_at = time.monotonic()
+        if status['stage'] in FINAL_STAGES:
+            channel.finished_at = channel.updated_at
+        channel.changed.notify_all()
+
+    def publish(self, job_id, stage, current, total, message, owner=True):
+        """
+        Record a progress update for a job and pass it to the broker
+
+        Args:
+            owner (bool): True when this process runs the job. Pass False for
+                          one-off updates about a job that runs elsewhere (e.g.
+                          'queued' from the web process), so later updates from
+                          the worker are still relayed here.
+        """
+        with self._lock:
+            channel = self._channel(job_id)
+            if owner:
+                channel.local = True
+
+        with channel.publish_lock:
+            with self._lock:
+                status = build_status(stage, current, total, message, seq=channel.seq + 1)
+
+            if self.broker:
+                try:
+                    stored_seq = self.broker.publish(job_id, status)
+                    if stored_seq:
+                        status['seq'] = max(status['seq'], stored_seq)
+                except Exception as e:
+                    print(f"Progress broker publish failed for job {job_id}: {e}")
+
+            with self._lock:
+                if status['seq'] > channel.seq:
+                    self._store(channel, status)
+                self._evict()
+
+        return status
+
+    def deliver(self, job_id, status):
+        """Apply an update received from the broker (ignores stale ones)"""
+        with self._lock:
+            channel = self._channel(job_id)
+            if channel.local or status.get('seq', 0) <= channel.seq:
+                return False
+            self._store(channel, status)
+            self._evict()
+        return True
+
+    def get_status(self, job_id):
+        """Latest progress for a job, or None if unknown here"""
+        with self._lock:
+            channel = self._channels.get(job_id)
+            return channel.status if channel else None
+
+    def wait_for_updates(self, job_id, after_seq=0, timeout=None):
+        """
+        Block until a job has updates newer than after_seq
+
+        Listeners sleep on the job's condition variable and are woken only by
+        updates to that job, so idle streams cost no CPU.
+
+        Args:
+            job_id (int): Job to follow
+            after_seq (int): Last seq the listener has seen (0 = none)
+            timeout (float): Max seconds to wait
+
+        Returns:
+            list: Updates with seq > after_seq still in the history, oldest
+                  first (empty on timeout)
+        """
+        with self._lock:
+            channel = self._channels.get(job_id)
+            if channel is None:
+                channel = self._channel(job_id)
+                self._evict()
+
+            if channel.seq <= after_seq and channel.finished_at is None:
+                channel.changed.wait(timeout)
+
+            return [status for status in channel.history if status['seq'] > after_seq]
+
+    def callback_for(self, job_id):
+        """progress_callback(stage, current, total, message) bound to one job"""
+        def callback(stage, current, total, message):
+            self.publish(job_id, stage, current, total, message)
+        return callback
+
+    def watched_jobs(self):
+        """Unfinished jobs whose updates come from other processes"""
+        with self._lock:
+            return [
+                job_id for job_id, channel in self._channels.items()
+                if not channel.local and channel.finished_at is None
+            ]
+
+    def watch(self, job_id):
+        """Start tracking a job published elsewhere (e.g. for an SSE listener)"""
+        with self._lock:
+            self._channel(job_id)
+            self._evict()
+
+    def _evict(self):
+        now = time.monotonic()
+
+        expired = [
+            job_id for job_id, channel in self._channels.items()
+            if channel.finished_at is not None and now - channel.finished_at > self.ttl
+        ]
+        for job_id in expired:
+            del self._channels[job_id]
+
+        if len(self._channels) > self.max_jobs:
+            finished = [job_id for job_id, c in self._channels.items() if c.finished_at is not None]
+            for job_id in finished[:len(self._channels) - self.max_jobs]:
+                del self._channels[job_id]
+        while len(self._channels) > self.max_jobs:
+            self._channels.popitem(last=False)
+
+    def __len__(self):
+        return len(self._channels)
+
+
+class LocalBroker:
+    """Single-process deployments: nothing to relay"""
+
+    def publish(self, job_id, status):
+        return None
+
+    def start(self, registry):
+        pass
+
+
+class DatabaseBroker:
+    """
+    Relay progress between processes through the sync_progress table
+
+    Publishing upserts one row per job on a separate connection (so it never
+    commits the sync's own session), throttled to one write per
+    `min_interval` unless the stage changes or the job finishes. A throttled
+    update is kept and written by the relay thread once the interval has
+    passed, so the latest state always reaches the table. The row's seq only
+    ever grows, and the stored seq is returned to the publisher.
+
+    One relay thread per process polls only the jobs that have listeners here
+    but are running elsewhere, and prunes rows of long-finished jobs.
+
+    Args:
+        app: Flask app (the relay thread needs an app context)
+        poll_interval (float): Seconds between relay polls
+        min_interval (float): Min seconds between writes for one job
+        retention (float): Seconds to keep rows after their last update
+    """
+
+    def __init__(self, app, poll_interval=0.5, min_interval=0.25, retention=3600):
+        self.app = app
+        self.poll_interval = poll_interval
+        self.min_interval = min_interval
+        self.retention = retention
+        self._last_write = {}  # job_id -> (monotonic time, stage)
+        self._deferred = {}    # job_id -> latest throttled status
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def publish(self, job_id, status):
+        """
+        Store an update (or defer it if throttled)
+
+        Returns:
+            int: seq stored for the update, or None if it was deferred
+        """
+        now = time.monotonic()
+        final = status['stage'] in FINAL_STAGES
+        with self._write_lock:
+            last = self._last_write.get(job_id)
+            if last and not final and last[1] == status['stage'] and now - last[0] < self.min_interval:
+                self._deferred[job_id] = status
+                return None
+            self._deferred.pop(job_id, None)
+            self._last_write[job_id] = (now, status['stage'])
+            if final:
+                self._last_write.pop(job_id, None)
+
+        return self._write(job_id, status)
+
+    def _write(self, job_id, status):
+        """Upsert the job's row; seq becomes max(stored seq + 1, status seq)"""
+        table = SyncProgress.__table__
+        next_seq = case(
+            (table.c.seq + 1 > status['seq'], table.c.seq + 1),
+            else_=status['seq']
+        )
+        values = {'status': json.dumps(status), 'updated_at': datetime.utcnow()}
+
+        for _ in range(2):
+            with db.engine.begin() as conn:
+                updated = conn.execute(
+                    table.update().where(table.c.job_id == job_id).values(seq=next_seq, **values)
+                ).rowcount
+                if updated:
+                    return conn.execute(
+                        select(table.c.seq).where(table.c.job_id == job_id)
+                    ).scalar()
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(table.insert().values(job_id=job_id, seq=status['seq'], **values))
+                return status['seq']
+            except IntegrityError:
+                # Another process inserted the row first; update it instead
+                continue
+        return None
+
+    def flush_deferred(self):
+        """Write throttled updates whose interval has passed"""
+        now = time.monotonic()
+        with self._write_lock:
+            due = [
+                (job_id, status) for job_id, status in self._deferred.items()
+                if now - self._last_write.get(job_id, (0, None))[0] >= self.min_interval
+            ]
+            for job_id, status in due:
+                del self._deferred[job_id]
+                self._last_write[job_id] = (now, status['stage'])
+
+        for job_id, status in due:
+            self._write(job_id, status)
+
+    def start(self, registry):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._relay, args=(registry,), name='progress-relay', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _relay(self, registry):
+        table = SyncProgress.__table__
+        last_prune = 0
+
+        while not self._stop.wait(self.poll_interval):
+            try:
+                with self.app.app_context():
+                    self.flush_deferred()
+
+                    job_ids = registry.watched_jobs()
+                    if job_ids:
+                        with db.engine.connect() as conn:
+                            rows = conn.execute(
+                                table.select().where(table.c.job_id.in_(job_ids))
+                            ).fetchall()
+                        for row in rows:
+                            status = json.loads(row.status)
+                            status['seq'] = row.seq
+                            registry.deliver(row.job_id, status)
+
+                    if time.monotonic() - last_prune > 60:
+                        last_prune = time.monotonic()
+                        cutoff = datetime.utcnow() - timedelta(seconds=self.retention)
+                        with db.engine.begin() as conn:
+                            conn.execute(table.delete().where(table.c.updated_at < cutoff))
+            except Exception as e:
+                print(f"Progress relay error: {e}")
+
+
+def create_registry(app, broker_kind='database', max_jobs=1000, ttl=600):
+    """Build the process-wide progress registry for this deployment"""
+    broker = DatabaseBroker(app) if broker_kind == 'database' else LocalBroker()
+    return ProgressRegistry(max_jobs=max_jobs, ttl=ttl, broker=broker)
+
+
+def format_event(status):
+    """One SSE message; the seq doubles as the event ID for Last-Event-ID resume"""
+    return f"id: {status['seq']}\ndata: {json.dumps(status)}\n\n"
+
+
+def stream_progress(registry, job_id, last_event_id=0, heartbeat=15, idle_timeout=300,
+                    check_job=None):
+    """
+    SSE generator for one job's progress
+
+    Waits on the registry's condition variable instead of polling, sends a
+    comment line every `heartbeat` seconds so proxies keep the connection
+    open, and resumes after `last_event_id` when the browser reconnects.
+
+    If nothing is published for `idle_timeout` seconds, check_job() is asked
+    for the job's state: it returns a final status dict if the job finished
+    or died (sent and the stream ends), or None if it is still alive.
+
+    Args:
+        registry (ProgressRegistry): Where updates are published
+        job_id (int): Job to follow
+        last_event_id (int): Seq of the last event the browser received
+        heartbeat (float): Seconds between keepalive comments
+        idle_timeout (float): Seconds without updates before check_job()
+        check_job: Optional callable() -> final status dict or None
+    """
+    SSE_CONNECTIONS.inc()
+    try:
+        yield "retry: 2000\n\n"
+        yield from _progress_events(registry, job_id, last_event_id, heartbeat, idle_timeout, check_job)
+    finally:
+        # Also runs when the client disconnects (the server closes the generator)
+        SSE_CONNECTIONS.dec()
+
+
+def _progress_events(registry, job_id, last_event_id, heartbeat, idle_timeout, check_job):
+    seq = last_event_id
+    idle_since = time.monotonic()
+
+    while True:
+        updates = registry.wait_for_updates(job_id, after_seq=seq, timeout=heartbeat)
+
+        if not updates:
+            latest = registry.get_status(job_id)
+            if latest and latest['stage'] in FINAL_STAGES and latest['seq'] <= seq:
+                # Reconnected after the final event was already delivered
+                return
+
+        if updates:
+            for status in updates:
+                yield format_event(status)
+                seq = status['seq']
+                if status['stage'] in FINAL_STAGES:
+                    return
+            idle_since = time.monotonic()
+            continue
+
+        if check_job and time.monotonic() - idle_since >= idle_timeout:
+            final = check_job()
+            if final:
+                final.setdefault('seq', seq + 1)
+                yield format_event(final)
+                return
+            idle_since = time.monotonic()
+
+        yield ": keepalive\n\n"
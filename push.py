@@ -0,0 +1,278 @@
+from models import db, User, GmailWatch, SyncJob, SyncCheckpoint
+from job_queue import enqueue_sync
+from config import Config
+from datetime import datetime, timedelta
+import base64
+import json
+import time
+
+
+# Push syncs run with the syncs users ask for
+PUSH_PRIORITY = 0
+
+
+def register_watch(user, gmail=None, topic=None):
+    """
+    Start (or renew) Gmail push notifications for a user
+
+    On renewal the synced-up-to history ID is kept, so mail that arrived
+    while the watch was lapsing is still picked up by the next push sync.
+
+    Args:
+        gmail: GmailService (or stand-in) for the user
+        topic (str): Pub/Sub topic, defaults to Config.GMAIL_PUSH_TOPIC
+
+    Returns:
+        GmailWatch
+    """
+    from gmail_service import GmailService
+
+    topic = topic or Config.GMAIL_PUSH_TOPIC
+    gmail = gmail or GmailService(user)
+    response = gmail.watch(topic)
+
+    now = datetime.utcnow()
+    watch = db.session.get(GmailWatch, user.id)
+    if watch is None:
+        watch = GmailWatch(user_id=user.id, created_at=now, notifications=0)
+        db.session.add(watch)
+    watch.email_address = user.email.lower()
+    watch.topic = topic
+    watch.expiration = datetime.utcfromtimestamp(int(response['expiration']) / 1000)
+    if watch.history_id is None:
+        watch.history_id = int(response['historyId'])
+    watch.updated_at = now
+    db.session.commit()
+
+    print(f"Watching {user.email} on {topic} until {watch.expiration:%Y-%m-%d %H:%M}")
+    return watch
+
+
+def unregister_watch(user, gmail=None):
+    """Stop a user's push notifications and forget the watch"""
+    from gmail_service import GmailService
+
+    watch = db.session.get(GmailWatch, user.id)
+    if watch is None:
+        return False
+    try:
+        (gmail or GmailService(user)).stop_watch()
+    except Exception as e:
+        # Gmail stops sending on its own once the watch expires
+        print(f"Error stopping watch for {user.email}: {e}")
+    db.session.delete(watch)
+    db.session.commit()
+    return True
+
+
+def expiring_watches_query(before):
+    """Watches that expire before `before`"""
+    return GmailWatch.query.filter(GmailWatch.expiration < before)
+
+
+def renew_watches(now=None, gmail_factory=None):
+    """
+    Renew the watches that expire within Config.GMAIL_WATCH_RENEW_HOURS
+
+    Returns:
+        int: Watches renewed
+    """
+    now = now or datetime.utcnow()
+    renewed = 0
+    for watch in expiring_watches_query(now + timedelta(hours=Config.GMAIL_WATCH_RENEW_HOURS)).all():
+        user = db.session.get(User, watch.user_id)
+        try:
+            register_watch(user, gmail=gmail_factory(user) if gmail_factory else None, topic=watch.topic)
+            renewed += 1
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error renewing watch for {user.email}: {e}")
+    return renewed
+
+
+def pubsub_envelope(email_address, history_id, message_id=None):
+    """The body Pub/Sub POSTs to a push endpoint for a Gmail notification"""
+    data = json.dumps({'emailAddress': email_address, 'historyId': int(history_id)})
+    return {
+        'message': {
+            'data': base64.b64encode(data.encode()).decode(),
+            'messageId': message_id or str(time.time_ns()),
+            'publishTime': datetime.utcnow().isoformat() + 'Z'
+        },
+        'subscription': 'projects/local/subscriptions/sift-gmail-push'
+    }
+
+
+def parse_pubsub_envelope(envelope):
+    """
+    (email address, history ID) from a Pub/Sub push body
+
+    Raises:
+        ValueError: The body isn't a Gmail notification
+    """
+    try:
+        data = json.loads(base64.b64decode(envelope['message']['data']))
+        return data['emailAddress'].lower(), int(data['historyId'])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f'Not a Gmail push notification: {e}')
+
+
+def handle_notification(email_address, history_id, now=None):
+    """
+    Record a Gmail notification and queue (or push back) the user's push sync
+
+    Notifications are coalesced: while the user's push job is queued, each
+    new one moves its start to PUSH_DEBOUNCE_SECONDS from now, but never
+    past PUSH_MAX_DELAY_SECONDS after the first unsynced notification.
+
+    Returns:
+        SyncJob or None (unknown address, or history already synced)
+    """
+    now = now or datetime.utcnow()
+    watch = GmailWatch.query.filter_by(email_address=email_address.lower()).first()
+    if watch is None:
+        print(f"Ignoring push notification for unwatched {email_address}")
+        return None
+
+    watch.notifications = (watch.notifications or 0) + 1
+    watch.last_notified_at = now
+    if watch.history_id is not None and history_id <= watch.history_id:
+        # Redelivered, or already covered by a sync
+        db.session.commit()
+        return None
+
+    watch.latest_history_id = max(watch.latest_history_id or 0, history_id)
+    watch.pending_since = watch.pending_since or now
+    watch.updated_at = now
+    db.session.commit()
+
+    return schedule_push_sync(watch, now)
+
+
+def schedule_push_sync(watch, now=None):
+    """Queue the user's debounced push job, or move a queued one's start"""
+    now = now or datetime.utcnow()
+    run_after = min(now + timedelta(seconds=Config.PUSH_DEBOUNCE_SECONDS),
+                    watch.pending_since + timedelta(seconds=Config.PUSH_MAX_DELAY_SECONDS))
+
+    job = enqueue_sync(watch.user_id, kind='push', priority=PUSH_PRIORITY, run_after=run_after)
+    if job.run_after != run_after:
+        # Already queued: debounce it. A job that started already is
+        # followed up by queue_pending_push instead.
+        db.session.query(SyncJob).filter(
+            SyncJob.id == job.id,
+            SyncJob.status == 'queued'
+        ).update({'run_after': run_after}, synchronize_session=False)
+        db.session.commit()
+    return job
+
+
+def queue_pending_push(user_id):
+    """Queue a push sync for notifications that arrived during the last one"""
+    watch = db.session.get(GmailWatch, user_id)
+    if watch is None or watch.pending_since is None:
+        return None
+    return schedule_push_sync(watch)
+
+
+def run_push_sync(make_worker, user, job_id=None, cancel=None, progress_callback=None):
+    """
+    Sync the mail added since the user's last push sync
+
+    Lists the inbox history since the watch's history ID and syncs exactly
+    those emails. When Gmail no longer has that history (or there is no
+    baseline yet), falls back to a one-day sync. A job resuming from a
+    checkpoint finishes its saved emails and leaves the history ID alone,
+    so a follow-up job lists anything it missed.
+
+    Args:
+        make_worker: callable(user, **kwargs) -> SyncWorker
+
+    Returns:
+        dict: run_sync results plus notification_delay_seconds (first
+              unsynced notification to the first new calendar event)
+    """
+    watch = db.session.get(GmailWatch, user.id)
+    if watch is None:
+        return {'skipped': True}
+
+    pending_since = watch.pending_since
+    worker = make_worker(user, cancel=cancel, job_id=job_id)
+
+    synced_to = None
+    started = datetime.utcnow()
+    if job_id is not None and db.session.get(SyncCheckpoint, job_id) is not None:
+        results = worker.run_sync(progress_callback=progress_callback)
+    else:
+        listing = None
+        if watch.history_id is not None and hasattr(worker.gmail, 'list_history'):
+            listing = worker.gmail.list_history(watch.history_id, max_results=Config.PUSH_MAX_MESSAGES)
+        if listing is None:
+            results = worker.run_sync(days=1, progress_callback=progress_callback)
+            synced_to = watch.latest_history_id
+        else:
+            message_ids, synced_to = listing
+            results = worker.run_sync(message_ids=message_ids, progress_callback=progress_callback)
+
+    if cancel is not None and cancel.is_set():
+        return results
+
+    results['notification_delay_seconds'] = None
+    if pending_since is not None and results.get('first_event_seconds') is not None:
+        event_at = started + timedelta(seconds=results['first_event_seconds'])
+        results['notification_delay_seconds'] = round((event_at - pending_since).total_seconds(), 3)
+
+    # Pick up notifications that arrived during the sync
+    db.session.refresh(watch)
+    now = datetime.utcnow()
+    if results.get('completed') and synced_to is not None:
+        watch.history_id = max(watch.history_id or 0, synced_to)
+        if (watch.latest_history_id or 0) <= watch.history_id:
+            watch.pending_since = None
+        else:
+            watch.pending_since = watch.last_notified_at or now
+    if results['notification_delay_seconds'] is not None:
+        watch.last_delay_seconds = results['notification_delay_seconds']
+        print(f"Push sync for {user.email}: first event {watch.last_delay_seconds}s after the notification")
+    watch.updated_at = now
+    db.session.commit()
+
+    return results
+
+
+def push_metrics(limit=500):
+    """
+    Notification-to-event delays over the last `limit` push syncs, and watch counts
+
+    Returns:
+        dict
+    """
+    now = datetime.utcnow()
+    rows = db.session.query(SyncJob.result).filter(
+        SyncJob.kind == 'push',
+        SyncJob.status == 'complete'
+    ).order_by(SyncJob.id.desc()).limit(limit).all()
+
+    samples = []
+    for (result,) in rows:
+        delay = json.loads(result or '{}').get('notification_delay_seconds')
+        if delay is not None:
+            samples.append(delay)
+    samples.sort()
+
+    metrics = {
+        'watches': GmailWatch.query.count(),
+        'pending': GmailWatch.query.filter(GmailWatch.pending_since.isnot(None)).count(),
+        'expiring': expiring_watches_query(now + timedelta(hours=Config.GMAIL_WATCH_RENEW_HOURS)).count(),
+        'push_syncs': len(rows)
+    }
+    if samples:
+        metrics['delay_seconds'] = {
+            'count': len(samples),
+            'avg': round(sum(samples) / len(samples), 3),
+            'p50': samples[int(0.50 * (len(samples) - 1))],
+            'p95': samples[int(0.95 * (len(samples) - 1))],
+            'max': samples[-1]
+        }
+    return metrics
+
@@ -0,0 +1,219 @@
+from models import db, User, SyncJob, SyncCost
+from job_queue import enqueue_sync, ACTIVE_STATUSES
+from config import Config
+from sqlalchemy import func
+from datetime import datetime, timedelta
+import math
+import random
+import threading
+
+
+# Scheduled syncs run after ones users asked for
+SCHEDULED_PRIORITY = -1
+
+
+def event_rate_query(since):
+    """Average events extracted per sync, and sync count, per user since `since`"""
+    return db.session.query(
+        SyncCost.user_id,
+        func.avg(SyncCost.events_extracted),
+        func.count(SyncCost.id)
+    ).filter(
+        SyncCost.sync_date >= since
+    ).group_by(SyncCost.user_id)
+
+
+def last_attempt_query():
+    """When each user's most recent sync job was queued"""
+    return db.session.query(
+        SyncJob.user_id,
+        func.max(SyncJob.created_at)
+    ).filter(
+        SyncJob.kind == 'sync'
+    ).group_by(SyncJob.user_id)
+
+
+class SyncScheduler:
+    """
+    Queue periodic syncs for every user
+
+    Each tick plans every user's next sync from the later of `last_sync` and
+    their last queued job (so a failing sync is retried an interval later,
+    not every tick), plus a per-user jitter so users who signed up together
+    don't all come due at once. Users with event-rich inboxes get shorter
+    intervals: the interval is max_interval / (1 + average events extracted
+    per sync over `history`), clamped to min_interval.
+
+    Fairness: a user never has more than one queued or running sync, at most
+    `max_concurrent` sync jobs are active at a time (backfills don't count;
+    they queue behind live syncs anyway), and free slots go to the
+    most overdue users first (relative to their own interval), so one large
+    mailbox can't starve the rest.
+
+    Run one scheduler per deployment (`flask run-scheduler`); the sync
+    workers that execute the jobs can run anywhere. With GMAIL_PUSH_TOPIC
+    set, each tick also renews the Gmail watches about to expire.
+
+    Args:
+        app: Flask app (the thread needs an app context for the DB)
+        min_interval (timedelta): Shortest interval, for the busiest inboxes
+        max_interval (timedelta): Interval for inboxes with no events
+        jitter (float): Fraction of the interval to shift each user's due time by, +/-
+        max_concurrent (int): Active sync jobs allowed across all users
+        tick (float): Seconds between planning passes
+        history (timedelta): SyncCost window the event rate is averaged over
+        max_days (int): Cap on the lookback of a scheduled sync
+    """
+
+    def __init__(self, app, min_interval=timedelta(minutes=15), max_interval=timedelta(hours=4),
+                 jitter=0.1, max_concurrent=4, tick=30, history=timedelta(days=14), max_days=7):
+        self.app = app
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.max_concurrent = max_concurrent
+        self.tick = tick
+        self.history = history
+        self.max_days = max_days
+
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.ticks = 0
+        self.enqueued = 0
+        self.last_plan = None
+        self.last_error = None
+
+    def start(self):
+        """Start the background thread (no-op if already running)"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sync-scheduler', daemon=True)
+        self._thread.start()
+        print(f"Sync scheduler started (every {self.tick}s, {self.max_concurrent} concurrent syncs)")
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    self.run_once()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Sync scheduler tick failed: {e}")
+                with self._lock:
+                    self.last_error = str(e)
+            self._stop.wait(self.tick)
+
+    def interval_for(self, avg_events):
+        """Sync interval for a user averaging `avg_events` events per sync"""
+        interval = self.max_interval / (1 + max(0.0, avg_events or 0.0))
+        return max(self.min_interval, interval)
+
+    def due_at(self, user_id, anchor, interval):
+        """
+        When a user's next sync is due
+
+        The jitter is seeded by the user and anchor, so every tick (and every
+        process) computes the same due time for the same cycle.
+        """
+        shift = random.Random(f"{user_id}:{anchor.isoformat()}").uniform(-self.jitter, self.jitter)
+        return anchor + interval * (1 + shift)
+
+    def plan(self, now=None):
+        """
+        Users due for a sync, most overdue first
+
+        Returns:
+            list: dicts with user_id, interval, due_at, overdue (in intervals) and days
+        """
+        now = now or datetime.utcnow()
+
+        rates = {user_id: avg for user_id, avg, _ in event_rate_query(now - self.history).all()}
+        attempts = dict(last_attempt_query().all())
+        active = {user_id for (user_id,) in db.session.query(SyncJob.user_id).filter(
+            SyncJob.kind == 'sync',
+            SyncJob.status.in_(ACTIVE_STATUSES)
+        ).all()}
+
+        due = []
+        for user_id, last_sync in db.session.query(User.id, User.last_sync).all():
+            if user_id in active:
+                continue
+
+            interval = self.interval_for(rates.get(user_id))
+            anchors = [t for t in (last_sync, attempts.get(user_id)) if t]
+            if not anchors:
+                # Never synced: due now, ahead of everyone else
+                due.append({'user_id': user_id, 'interval': interval, 'due_at': now,
+                            'overdue': math.inf, 'days': 1})
+                continue
+
+            anchor = max(anchors)
+            due_at = self.due_at(user_id, anchor, interval)
+            if due_at > now:
+                continue
+
+            # Look back to the last successful sync, within reason
+            since = last_sync or anchor
+            days = min(self.max_days, max(1, math.ceil((now - since) / timedelta(days=1))))
+            due.append({'user_id': user_id, 'interval': interval, 'due_at': due_at,
+                        'overdue': (now - due_at) / interval, 'days': days})
+
+        due.sort(key=lambda entry: entry['overdue'], reverse=True)
+        return due
+
+    def run_once(self, now=None):
+        """
+        Queue syncs for the most overdue users, up to the free concurrency slots
+
+        Returns:
+            int: Number of jobs queued
+        """
+        now = now or datetime.utcnow()
+        due = self.plan(now)
+
+        active = db.session.query(func.count(SyncJob.id)).filter(
+            SyncJob.kind == 'sync',
+            SyncJob.status.in_(ACTIVE_STATUSES)
+        ).scalar()
+        slots = max(0, self.max_concurrent - active)
+
+        enqueued = 0
+        for entry in due[:slots]:
+            enqueue_sync(entry['user_id'], params={'days': entry['days'], 'scheduled': True},
+                         priority=SCHEDULED_PRIORITY)
+            enqueued += 1
+
+        with self._lock:
+            self.ticks += 1
+            self.enqueued += enqueued
+            self.last_plan = {
+                'at': now.isoformat(),
+                'due': len(due),
+                'active': active,
+                'slots': slots,
+                'enqueued': enqueued
+            }
+        if enqueued:
+            print(f"Scheduled {enqueued} syncs ({len(due)} users due, {active} active)")
+
+        if Config.GMAIL_PUSH_TOPIC:
+            # Gmail watches lapse after a week
+            from push import renew_watches
+            renew_watches(now)
+
+        return enqueued
+
+    def get_metrics(self):
+        with self._lock:
+            return {
+                'running': bool(self._thread and self._thread.is_alive()),
+                'ticks': self.ticks,
+                'enqueued': self.enqueued,
+                'last_plan': self.last_plan,
+                'last_error': self.last_error
+            }
@@ -0,0 +1,231 @@
+from models import db, SenderStat, ProcessedEmail, EmailRetry
+from email_priority import sender_address, sender_domain
+from config import Config
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime
+import hashlib
+
+
+# SenderStat.user_id of the stats across all users
+GLOBAL_USER_ID = 0
+
+# Labels nearly every email has, which say nothing about the sender
+IGNORED_LABELS = {'INBOX', 'UNREAD'}
+
+
+def email_keys(email):
+    """The (kind, key) pairs an email's outcome counts towards"""
+    keys = []
+    address = sender_address(email.get('sender'))
+    if address:
+        keys.append(('address', address))
+        domain = sender_domain(address)
+        if domain:
+            keys.append(('domain', domain))
+    for label in email.get('labels') or ():
+        if label not in IGNORED_LABELS:
+            keys.append(('label', label))
+    return keys
+
+
+class SenderObservations:
+    """
+    What one sync learned about its senders, to add to SenderStat at the end
+
+    For each key: emails seen, emails with events, and the zero-event emails
+    since the last one with events (in processing order).
+    """
+
+    def __init__(self):
+        self._totals = {}
+
+    def __len__(self):
+        return len(self._totals)
+
+    def add(self, email, had_events):
+        for key in email_keys(email):
+            totals = self._totals.setdefault(key, [0, 0, 0])
+            totals[0] += 1
+            if had_events:
+                totals[1] += 1
+                totals[2] = 0
+            else:
+                totals[2] += 1
+
+    def items(self):
+        return self._totals.items()
+
+
+def record_sender_stats(user_id, observations, now=None):
+    """
+    Add a sync's observations to the user's and the global SenderStat rows
+
+    Counters are incremented in SQL, so syncs of different users updating the
+    same global rows never lose each other's counts. Runs on its own
+    connection and never commits the caller's session.
+
+    Returns:
+        int: Rows updated or created
+    """
+    if not len(observations):
+        return 0
+
+    now = now or datetime.utcnow()
+    table = SenderStat.__table__
+
+    def update(conn, scope, kind, key, emails, with_events, trailing_zeros):
+        return conn.execute(
+            table.update().where(
+                table.c.user_id == scope,
+                table.c.kind == kind,
+                table.c.key == key
+            ).values(
+                emails=table.c.emails + emails,
+                with_events=table.c.with_events + with_events,
+                # A sync with events for the key restarts its streak
+                zero_streak=trailing_zeros if with_events else table.c.zero_streak + emails,
+                last_event_at=now if with_events else table.c.last_event_at,
+                updated_at=now
+            )
+        ).rowcount
+
+    rows = [
+        (scope, kind, key[:320], emails, with_events, trailing_zeros)
+        for (kind, key), (emails, with_events, trailing_zeros) in observations.items()
+        for scope in (user_id, GLOBAL_USER_ID)
+    ]
+
+    missing = []
+    with db.engine.begin() as conn:
+        for row in rows:
+            if not update(conn, *row):
+                missing.append(row)
+
+    for scope, kind, key, emails, with_events, trailing_zeros in missing:
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(table.insert().values(
+                    user_id=scope, kind=kind, key=key, emails=emails, with_events=with_events,
+                    zero_streak=trailing_zeros, last_event_at=now if with_events else None,
+                    updated_at=now
+                ))
+        except IntegrityError:
+            # Another sync created it first
+            with db.engine.begin() as conn:
+                update(conn, scope, kind, key, emails, with_events, trailing_zeros)
+
+    return len(rows)
+
+
+def suppressed_stats_query(user_id, min_streak):
+    """The user's and the global stats with at least `min_streak` emails in a row without events"""
+    return SenderStat.query.filter(
+        SenderStat.user_id.in_([user_id, GLOBAL_USER_ID]),
+        SenderStat.zero_streak >= min_streak
+    )
+
+
+class SenderPolicy:
+    """
+    Which emails of a sync to skip or demote, from the sender stats
+
+    An email is skipped (not extracted) when its sender address went
+    `skip_after` emails in a row without events for this user, or
+    `global_skip_after` across all users. It is demoted (extracted last,
+    see email_priority) when its address, domain or a label went
+    `demote_after` in a row. A fraction `explore_rate` of would-be skips are
+    extracted anyway, so a sender that starts sending events gets its streak
+    reset; the choice is a hash of the email ID, so it's the same on every
+    attempt. Emails with an invite part are never skipped.
+
+    Every stat that could matter is loaded up front, so decisions are
+    in-memory lookups that are safe from any thread.
+    """
+
+    def __init__(self, user_id, streaks, skip_after, global_skip_after, demote_after, explore_rate):
+        self.user_id = user_id
+        self.streaks = streaks  # (user_id, kind, key) -> zero_streak
+        self.skip_after = skip_after
+        self.global_skip_after = global_skip_after
+        self.demote_after = demote_after
+        self.explore_rate = explore_rate
+
+    @classmethod
+    def for_user(cls, user_id):
+        demote_after = Config.SENDER_DEMOTE_AFTER
+        min_streak = min(demote_after, Config.SENDER_SKIP_AFTER, Config.SENDER_GLOBAL_SKIP_AFTER)
+        streaks = {
+            (stat.user_id, stat.kind, stat.key): stat.zero_streak
+            for stat in suppressed_stats_query(user_id, min_streak).all()
+        }
+        return cls(user_id, streaks, Config.SENDER_SKIP_AFTER, Config.SENDER_GLOBAL_SKIP_AFTER,
+                   demote_after, Config.SENDER_EXPLORE_RATE)
+
+    def explore(self, email_id):
+        """Whether this email is in the sample extracted despite its sender"""
+        digest = hashlib.sha1(f"{self.user_id}:{email_id}".encode()).digest()
+        return int.from_bytes(digest[:4], 'big') / 2 ** 32 < self.explore_rate
+
+    def decide(self, email):
+        """
+        Returns:
+            tuple: ('skip' | 'demote' | None, reason)
+        """
+        keys = email_keys(email)
+        user = {key: self.streaks.get((self.user_id,) + key, 0) for key in keys}
+
+        address = sender_address(email.get('sender'))
+        if address and not email.get('has_calendar'):
+            streak = user.get(('address', address), 0)
+            global_streak = self.streaks.get((GLOBAL_USER_ID, 'address', address), 0)
+            if streak >= self.skip_after or global_streak >= self.global_skip_after:
+                if not self.explore(email['id']):
+                    return 'skip', f"{address}: {max(streak, global_streak)} emails without events"
+
+        for (kind, key), streak in user.items():
+            if streak >= self.demote_after:
+                return 'demote', f"{kind} {key}: {streak} emails without events"
+        return None, None
+
+
+def skipped_emails_query(user_id):
+    """The user's emails skipped by sender stats, newest first"""
+    return ProcessedEmail.query.filter(
+        ProcessedEmail.user_id == user_id,
+        ProcessedEmail.processing_status == 'skipped'
+    ).order_by(ProcessedEmail.processed_at.desc())
+
+
+def recover_skipped(user_id, email_ids=None):
+    """
+    Queue skipped emails for extraction by the user's next sync
+
+    The 'skipped' records are replaced by retry-queue entries that are due
+    now. A sync picks those up even outside its lookback window, and never
+    skips them by sender again.
+
+    Args:
+        email_ids (list, optional): Only these emails; all skipped emails if None
+
+    Returns:
+        int: Emails queued
+    """
+    query = skipped_emails_query(user_id)
+    if email_ids is not None:
+        query = query.filter(ProcessedEmail.email_id.in_(email_ids))
+    skipped = query.all()
+    if not skipped:
+        return 0
+
+    now = datetime.utcnow()
+    queued = {email_id for (email_id,) in db.session.query(EmailRetry.email_id).filter(
+        EmailRetry.user_id == user_id,
+        EmailRetry.email_id.in_([row.email_id for row in skipped])
+    ).all()}
+    for row in skipped:
+        if row.email_id not in queued:
+            db.session.add(EmailRetry(user_id=user_id, email_id=row.email_id, email_subject=row.email_subject,
+                                      attempts=0, next_attempt_at=now, created_at=now, updated_at=now))
+        db.session.delete(row)
+    db.session.commit()
+    return len(skipped)
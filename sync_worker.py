@@ -1,27 +1,133 @@
 from gmail_service import GmailService
-from calendar_service import CalendarService
+from calendar_sinks import create_sink, WriteResult
 from event_extractor import EventExtractor
 from cost_tracker import CostTracker
-from models import db, ProcessedEmail, CalendarEvent
+from dedup_index import EventIntervalIndex, title_similarity, title_tokens
+from db_batch import RowBuffer
+from models import db, ProcessedEmail, CalendarEvent, SyncCheckpoint
+from pipeline import StagePool, PipelinedSync
+from email_priority import sender_address, sender_rates, score_email
+from email_retries import TRANSIENT_ERRORS, RetryQueue, due_retries_query
+from budget import BudgetGuard
+from budget_admission import BudgetAdmission
+from sender_stats import SenderPolicy, SenderObservations, record_sender_stats
+from timing import StageTimer, span, attach_timer
+from metrics import SYNC_DURATION_SECONDS, EXTRACTION_CACHE_HITS, EMAILS_SKIPPED
+from config import Config
 from datetime import datetime
+import json
+import time
+
+
+def processed_ids_query(user_id, email_ids):
+    """Which of email_ids the user already has a ProcessedEmail row for"""
+    return db.session.query(ProcessedEmail.email_id).filter(
+        ProcessedEmail.user_id == user_id,
+        ProcessedEmail.email_id.in_(email_ids)
+    )
+
+
+class SyncAborted(Exception):
+    """The sync was cancelled (e.g. its job lease was lost) and must stop"""
+
+
+class _PendingWrite:
+    """An email's events on their way to the sink, with what's needed to record them"""
+    
+    __slots__ = ('processed', 'events', 'entries', 'future')
+    
+    def __init__(self, processed, events, entries):
+        self.processed = processed
+        self.events = events
+        self.entries = entries
+        self.future = None
 
 
 class SyncWorker:
     """Orchestrates the email-to-calendar sync process"""
     
-    def __init__(self, user):
+    # Emails (with their events) written per DB transaction
+    flush_chunk_size = 50
+    
+    def __init__(self, user, sink=None, gmail=None, extractor=None, cancel=None, job_id=None,
+                 budget=None, pipeline=None):
+        """
+        Args:
+            user: User object from database
+            sink: CalendarSink to write events to (defaults to Config.CALENDAR_SINK)
+            gmail: GmailService-like object (defaults to GmailService(user))
+            extractor: EventExtractor-like object (defaults to EventExtractor())
+            cancel: Optional threading.Event; once set, the sync stops before the next email
+            job_id: SyncJob being run; its checkpoint is saved with every flush,
+                    and a sync for a job with a checkpoint resumes from it
+            budget: Optional dict with 'tokens' and/or 'dollars'; the sync stops
+                    before the next email once this run's OpenAI usage reaches either
+            pipeline: Override Config.SYNC_PIPELINE
+        
+        Config.SYNC_PIPELINE picks between fetching, extracting and writing one
+        email at a time and overlapping those stages in thread pools (see
+        pipeline.PipelinedSync). Both paths give the same results.
+        
+        Emails that fail transiently (TRANSIENT_ERRORS) aren't recorded as
+        processed; they go to the retry queue (see email_retries.RetryQueue)
+        and are tried again by later syncs.
+        
+        With daily or monthly dollar caps configured (see budget.BudgetGuard),
+        every extraction is planned against them first (see
+        budget_admission.BudgetAdmission): near a cap emails go to the cheap
+        deployment or are triaged by score, and over it they're deferred
+        until the cap resets.
+        
+        Every Gmail, OpenAI and Calendar call, sink write and DB commit is
+        timed by stage (see timing.StageTimer); the summary is in the results
+        as 'timings' and saved with the sync's costs as SyncTiming rows.
+        """
         self.user = user
-        self.gmail = GmailService(user)
-        self.calendar = CalendarService(user)
-        self.extractor = EventExtractor()
-        self.cost_tracker = CostTracker(user)
+        self.gmail = gmail or GmailService(user)
+        self.sink = sink or create_sink(user)
+        self.extractor = extractor or EventExtractor()
+        self.cost_tracker = CostTracker(user, model=Config.AZURE_OPENAI_MODEL)
+        self.timer = StageTimer()
+        attach_timer(self.timer, self.gmail, self.extractor, getattr(self.sink, 'calendar', None))
+        # Services count their own HTTP requests; charge them to this sync
+        for service in (self.gmail, getattr(self.sink, 'calendar', None)):
+            usage = getattr(service, 'usage', None)
+            if usage is not None:
+                usage.tracker = self.cost_tracker
+        self.dedup_index = None
+        self.row_buffer = None
+        self.cancel = cancel
+        self.budget = budget or {}
+        use_pipeline = Config.SYNC_PIPELINE if pipeline is None else pipeline
+        self.use_pipeline = use_pipeline and hasattr(self.gmail, 'list_message_ids')
+        self.pipeline = None  # PipelinedSync while the pipelined path runs
+        
+        # Checkpoint state
+        self.job_id = job_id
+        self._message_ids = None
+        self._position = 0  # emails before this index are handled
+        self._last_flush = time.monotonic()
+        self._prefetched = {}  # from gmail objects that can only list full emails
+        self.retries = RetryQueue(user.id, self.timer)
+        self._started = None  # time.monotonic() when run_sync began
+        self._first_event_at = None  # time.monotonic() when the sink first accepted an event
+        self.sender_policy = None  # SenderPolicy when Config.SENDER_SKIP is on
+        self._sender_observations = SenderObservations()
+        self._forced = set()  # queued retries, which sender stats never skip
+        self._scores = {}  # email_id -> email_priority score, when prioritized
+        self.budget_guard = None  # BudgetGuard when a dollar cap applies to the user
+        self.admission = None  # BudgetAdmission over budget_guard
         
-    def run_sync(self, days=1, progress_callback=None):
+    def run_sync(self, days=1, progress_callback=None, after=None, before=None, message_ids=None):
         """
         Run the full sync process
         
         Args:
             days: Number of days to look back for emails
+            after: Optional UTC start of the window to sync, instead of `days`
+            before: Optional UTC end of the window
+            message_ids: Optional Gmail message IDs to sync instead of listing
+                         any (e.g. the new mail a push notification announced)
             progress_callback: Function to call with progress updates
                               (stage, current, total, message)
         
@@ -29,16 +135,33 @@ class SyncWorker:
             dict: Summary of sync results
         """
         print(f"\n=== Starting sync for {self.user.email} ===")
+        self._started = time.monotonic()
         
         results = {
             'emails_scanned': 0,
             'emails_processed': 0,
             'emails_skipped': 0,  # NEW: Track skipped emails
+            'emails_retrying': 0,  # failed transiently, queued for a later sync
+            'emails_deferred': 0,  # queued for retry, but not due yet
+            'emails_sender_skipped': 0,  # not extracted: sender with a long run of mail without events
+            'emails_budget_skipped': 0,  # not extracted: low score near a dollar cap
+            'emails_budget_deferred': 0,  # queued until a dollar cap resets
             'events_extracted': 0,
             'events_added': 0,
             'duplicates_skipped': 0,
+            'duplicates': [],  # which existing event each skipped duplicate matched
             'errors': [],
-            'costs': None
+            'costs': None,
+            'calendar_writes': None,
+            'pipeline': None,  # per-stage throughput when the pipelined path ran
+            'resumed_at': None,  # index of the first email, when resuming a checkpoint
+            'budget_exhausted': False,  # stopped early at the token/dollar budget
+            'emails_listed': 0,  # IDs Gmail returned for the window
+            'emails_prioritized': 0,  # emails scored and reordered before extraction
+            'first_event_seconds': None,  # from the start of the sync to the first event in the calendar
+            'timings': None,  # per-stage latency (StageTimer.summary)
+            'budget': None,  # dollar caps and how emails were handled (BudgetGuard.summary)
+            'completed': False  # False if the sync failed as a whole
         }
         
         try:
@@ -47,9 +170,12 @@ class SyncWorker:
                 progress_callback('setup', 1, 4, '[setup] Initializing calendar... (1/4)')
             
             # Ensure Sift calendar exists
-            calendar_id = self.calendar.create_sift_calendar()
+            calendar_id = self.sink.ensure_calendar()
             print(f"Using calendar: {calendar_id}")
-            self.cost_tracker.add_calendar_call()
+            
+            # One query for all upcoming events; duplicate checks are in-memory from here on
+            with span(self.timer, 'db.dedup_load'):
+                self.dedup_index = EventIntervalIndex.for_user(self.user.id)
             
             if progress_callback:
                 progress_callback('setup', 2, 4, '[setup] Connecting to Gmail... (2/4)')
@@ -58,131 +184,55 @@ class SyncWorker:
             if progress_callback:
                 progress_callback('setup', 3, 4, '[setup] Fetching recent emails... (3/4)')
             
-            emails = self.gmail.get_recent_emails(days=days)
-            self.cost_tracker.add_gmail_call()
+            message_ids = self._plan_sync(days, results, after, before, message_ids)
             
-            if not emails:
+            if not message_ids:
                 print("No emails found to process")
                 if progress_callback:
                     progress_callback('complete', 1, 1, '[complete] No emails found')
                 results['costs'] = self.cost_tracker.get_summary()
+                results['calendar_writes'] = self.sink.latency_summary()
+                results['timings'] = self.timer.summary()
+                results['completed'] = True
+                self._observe_duration('complete')
                 return results
             
-            results['emails_scanned'] = len(emails)
-            
             if progress_callback:
-                progress_callback('setup', 4, 4, f'[setup] Found {len(emails)} emails to scan (4/4)')
-            
-            # Process each email
-            total_emails = len(emails)
-            for idx, email in enumerate(emails, 1):
-                email_id = email['id']
-                email_subject = email['subject'][:50] + '...' if len(email['subject']) > 50 else email['subject']
-                
-                if progress_callback:
-                    progress_callback(
-                        'processing', 
-                        idx, 
-                        total_emails, 
-                        f'[processing] Email {idx}/{total_emails}: {email_subject}... ({idx}/{total_emails})'
-                    )
-                
-                # Check if already processed
-                existing = ProcessedEmail.query.filter_by(
-                    user_id=self.user.id,
-                    email_id=email_id
-                ).first()
-                
-                if existing:
-                    print(f"Skipping already processed email: {email['subject']}")
-                    results['emails_skipped'] += 1  # Track skipped
-                    continue
-                
-                # Process this email
+                progress_callback('setup', 4, 4, f'[setup] Found {len(message_ids)} emails to scan (4/4)')
+            
+            self.row_buffer = RowBuffer(chunk_size=self.flush_chunk_size)
+            if Config.SENDER_SKIP:
+                self.sender_policy = SenderPolicy.for_user(self.user.id)
+            self.budget_guard = BudgetGuard.for_user(self.user, self.cost_tracker)
+            if self.budget_guard is not None:
+                self.admission = BudgetAdmission(self.budget_guard, self.extractor, self.retries,
+                                                 self.row_buffer, self.user.id)
+            work = self._plan_work(message_ids, results)
+            if Config.SYNC_PRIORITY and results['resumed_at'] is None:
+                work = self._prioritize(work, results, progress_callback)
+            
+            if self.use_pipeline:
+                self.pipeline = PipelinedSync(self)
                 try:
-                    events, token_usage = self.extractor.extract_events(email, progress_callback=progress_callback)
-                    
-                    # Track costs
-                    self.cost_tracker.add_openai_usage(
-                        token_usage['input_tokens'],
-                        token_usage['output_tokens']
-                    )
-                    self.cost_tracker.emails_processed += 1
-                    results['emails_processed'] += 1
-                    
-                    # Record that we processed this email
-                    processed = ProcessedEmail(
-                        user_id=self.user.id,
-                        email_id=email_id,
-                        email_subject=email['subject'],
-                        events_count=len(events),
-                        event_created=len(events) > 0
-                    )
-                    db.session.add(processed)
-                    db.session.commit()
-                    
-                    # Add events to calendar
-                    for event in events:
-                        try:
-                            gcal_event = self.extractor.format_for_google_calendar(
-                                event, 
-                                email_id=email_id,
-                                email_subject=email['subject']
-                            )
-                            
-                            if not gcal_event:
-                                continue
-                            
-                            # Check for duplicate events
-                            if self._is_duplicate_event(gcal_event):
-                                print(f"Skipping duplicate event: {gcal_event['summary']}")
-                                results['duplicates_skipped'] += 1
-                                continue
-                            
-                            # Add to calendar
-                            event_id = self.calendar.add_event(gcal_event)
-                            self.cost_tracker.add_calendar_call()
-                            
-                            # Record the calendar event
-                            cal_event = CalendarEvent(
-                                user_id=self.user.id,
-                                processed_email_id=processed.id,
-                                gcal_event_id=event_id,
-                                gcal_calendar_id=self.user.sift_calendar_id,
-                                event_title=gcal_event['summary'],
-                                start_datetime=datetime.fromisoformat(gcal_event['start']['dateTime']),
-                                end_datetime=datetime.fromisoformat(gcal_event['end']['dateTime']),
-                                location=gcal_event.get('location')
-                            )
-                            db.session.add(cal_event)
-                            db.session.commit()
-                            
-                            results['events_added'] += 1
-                            results['events_extracted'] += 1
-                            self.cost_tracker.events_extracted += 1
-                            
-                        except Exception as e:
-                            print(f"Error adding event to calendar: {e}")
-                            results['errors'].append(f"Calendar error: {str(e)}")
-                    
-                except Exception as e:
-                    print(f"Error processing email {email_id}: {e}")
-                    results['errors'].append(f"Email {email_id}: {str(e)}")
-                    
-                    # Still record as processed (with error) so we don't retry
-                    processed = ProcessedEmail(
-                        user_id=self.user.id,
-                        email_id=email_id,
-                        email_subject=email['subject'],
-                        processing_status='error',
-                        error_message=str(e)
-                    )
-                    db.session.add(processed)
-                    db.session.commit()
+                    self.pipeline.run(work, results, progress_callback)
+                finally:
+                    self.pipeline = None
+            else:
+                self._sync_serial(work, results, progress_callback)
+            
+            total_emails = len(message_ids)
+            self._flush_rows(results)
             
-            # Save costs
-            self.cost_tracker.save()
+            # Save costs; the job is done, so nothing should resume it (same commit)
+            if self.job_id is not None:
+                SyncCheckpoint.query.filter_by(job_id=self.job_id).delete()
+            results['timings'] = self.timer.summary()
+            results['budget'] = self.budget_guard.summary() if self.budget_guard else None
+            self.cost_tracker.save(timings=results['timings'], duration=time.monotonic() - self._started)
+            self._save_sender_stats()
             results['costs'] = self.cost_tracker.get_summary()
+            results['calendar_writes'] = self.sink.latency_summary()
+            results['completed'] = True
             
             # Final progress update
             if progress_callback:
@@ -193,9 +243,17 @@ class SyncWorker:
             print(f"Emails scanned: {results['emails_scanned']}")
             print(f"Emails processed: {results['emails_processed']}")
             print(f"Emails skipped (already processed): {results['emails_skipped']}")
+            print(f"Emails skipped (sender stats): {results['emails_sender_skipped']}")
+            if results['budget']:
+                print(f"Budget: {results['budget']['modes']}, "
+                      f"{results['emails_budget_skipped']} skipped, {results['emails_budget_deferred']} deferred")
             print(f"Events extracted: {results['events_extracted']}")
             print(f"Events added to calendar: {results['events_added']}")
+            print(f"Time to first event: {results['first_event_seconds']}s")
             print(f"Duplicate events skipped: {results['duplicates_skipped']}")
+            print(f"Calendar writes ({self.sink.name}): {results['calendar_writes']}")
+            stage_times = ', '.join(f"{stage} {timing['total_ms']}" for stage, timing in results['timings'].items())
+            print(f"Time by stage (ms): {stage_times}")
             print(f"Errors: {len(results['errors'])}")
             
             print(f"\n=== Cost Summary ===")
@@ -203,6 +261,7 @@ class SyncWorker:
             print(f"OpenAI cost: ${results['costs']['openai_cost']:.4f}")
             print(f"Total cost: ${results['costs']['total_cost']:.4f}")
             
+            self._observe_duration('complete')
             return results
             
         except Exception as e:
@@ -210,20 +269,583 @@ class SyncWorker:
             import traceback
             traceback.print_exc()
             
-            if progress_callback:
+            # Keep the work done before the failure
+            if self.row_buffer is not None:
+                try:
+                    self._settle_writes(results)
+                    self._flush_rows(results)
+                except Exception as flush_error:
+                    db.session.rollback()
+                    print(f"Error saving buffered rows: {flush_error}")
+            self._save_sender_stats()
+            
+            # An aborted sync is being taken over by another worker, so
+            # listeners shouldn't see it fail
+            if progress_callback and not isinstance(e, SyncAborted):
                 progress_callback('error', 0, 1, f'Error: {str(e)}')
             
             results['errors'].append(str(e))
             results['costs'] = self.cost_tracker.get_summary()
+            results['calendar_writes'] = self.sink.latency_summary()
+            results['timings'] = self.timer.summary()
+            results['budget'] = self.budget_guard.summary() if self.budget_guard else None
+            self._observe_duration('aborted' if isinstance(e, SyncAborted) else 'error')
             return results
     
-    def _is_duplicate_event(self, gcal_event):
-        """Check if this event already exists in the calendar"""
-        # Check by title and start time
-        existing = CalendarEvent.query.filter_by(
+    def _observe_duration(self, outcome):
+        SYNC_DURATION_SECONDS.observe(time.monotonic() - self._started, outcome)
+    
+    def _check_cancelled(self):
+        if self.cancel is not None and self.cancel.is_set():
+            raise SyncAborted('Sync cancelled: job lease lost')
+    
+    def _load_processed_ids(self, email_ids):
+        """Return the subset of email_ids already recorded as ProcessedEmail"""
+        if not email_ids:
+            return set()
+        
+        with span(self.timer, 'db.processed_lookup'):
+            rows = processed_ids_query(self.user.id, email_ids).all()
+        
+        return {row[0] for row in rows}
+    
+    def _plan_sync(self, days, results, after=None, before=None, message_ids=None):
+        """
+        The emails this sync covers, in order
+        
+        A job with a checkpoint continues from it: same emails, same position,
+        and the results and costs counted so far. Otherwise the recent emails
+        are listed, due retries are added and a checkpoint is started.
+        
+        Returns:
+            list: Gmail message IDs
+        """
+        checkpoint = db.session.get(SyncCheckpoint, self.job_id) if self.job_id is not None else None
+        
+        if checkpoint is not None:
+            message_ids = json.loads(checkpoint.message_ids)
+            self._position = checkpoint.position or 0
+            results.update(json.loads(checkpoint.results or '{}'))
+            self.cost_tracker.restore(json.loads(checkpoint.costs or '{}'))
+            results['resumed_at'] = self._position
+            print(f"Resuming job {self.job_id} at email {self._position + 1}/{len(message_ids)}")
+        else:
+            if message_ids is not None:
+                message_ids = list(message_ids)
+            elif after is not None or before is not None:
+                message_ids = self.gmail.list_message_ids(
+                    days=days, max_results=Config.BACKFILL_MAX_EMAILS_PER_WINDOW, after=after, before=before
+                )
+            elif hasattr(self.gmail, 'list_message_ids'):
+                message_ids = self.gmail.list_message_ids(days=days)
+            else:
+                emails = self.gmail.get_recent_emails(days=days)
+                self._prefetched = {email['id']: email for email in emails}
+                message_ids = list(self._prefetched)
+            results['emails_listed'] = len(message_ids)
+            
+            # Retries that came due, even if they've aged out of the window
+            listed = set(message_ids)
+            message_ids += [email_id for (email_id,) in due_retries_query(self.user.id, datetime.utcnow()).all()
+                            if email_id not in listed]
+            results['emails_scanned'] = len(message_ids)
+        
+        self._message_ids = message_ids
+        if message_ids:
+            self.retries.load(message_ids)
+            self._forced = self.retries.queued_ids()
+            if checkpoint is None:
+                self._save_checkpoint(results)
+        return message_ids
+    
+    def _plan_work(self, message_ids, results):
+        """
+        Decide, for each remaining email, whether it needs processing
+        
+        Returns:
+            list: (index, message_id, skip) where skip is None, 'processed' or 'deferred'
+        """
+        # One query for every email we've already handled
+        processed_ids = self._load_processed_ids(message_ids[self._position:])
+        now = datetime.utcnow()
+        
+        work = []
+        for idx in range(self._position, len(message_ids)):
+            message_id = message_ids[idx]
+            if message_id in processed_ids:
+                skip = 'processed'
+            elif self.retries.not_due(message_id, now):
+                skip = 'deferred'
+            else:
+                skip = None
+                processed_ids.add(message_id)
+            work.append((idx, message_id, skip))
+        return work
+    
+    def _prioritize(self, work, results, progress_callback=None):
+        """
+        Reorder the emails to process so the likeliest event mail goes first
+        
+        The emails are fetched up front (on the fetch pool when pipelining)
+        and scored on cheap signals (see email_priority.score_email); the
+        expensive part, extraction, then runs highest score first. Skipped
+        emails keep their place at the front, and emails that couldn't be
+        fetched go last, where the normal path retries or records them. The
+        new order is saved in the checkpoint, so a resumed job keeps it.
+        
+        Returns:
+            list: `work` in the new order, re-indexed
+        """
+        pending = [message_id for _, message_id, skip in work if skip is None]
+        if len(pending) < 2:
+            return work
+        
+        if progress_callback:
+            progress_callback('setup', 4, 4, f'[setup] Ranking {len(pending)} emails (4/4)')
+        
+        def prefetch(message_id):
+            try:
+                return self.gmail.get_email_details(message_id)
+            except TRANSIENT_ERRORS:
+                return None
+        
+        if self.use_pipeline:
+            pool = StagePool('prefetch', prefetch, Config.SYNC_FETCH_WORKERS, len(pending))
+            try:
+                futures = [(message_id, pool.submit(message_id)) for message_id in pending]
+                fetched = [(message_id, future.result()) for message_id, future in futures]
+            finally:
+                pool.shutdown(cancel_pending=True)
+        else:
+            fetched = []
+            for message_id in pending:
+                self._check_cancelled()
+                fetched.append((message_id, prefetch(message_id)))
+        
+        emails = {message_id: email for message_id, email in fetched if email}
+        self._prefetched.update(emails)
+        
+        rates = sender_rates(self.user.id, emails.values())
+        now = datetime.now()
+        scores = {
+            message_id: score_email(email, rates, now, demoted=self._sender_decision(email)[0] is not None)[0]
+            for message_id, email in emails.items()
+        }
+        
+        ordered = [entry for entry in work if entry[2] is not None]
+        ordered += sorted((entry for entry in work if entry[2] is None),
+                          key=lambda entry: scores.get(entry[1], float('-inf')), reverse=True)
+        
+        # Reorder the rest of the sync in place, so positions and the checkpoint follow it
+        self._message_ids[self._position:] = [message_id for _, message_id, _ in ordered]
+        self._save_checkpoint(results)
+        results['emails_prioritized'] = len(scores)
+        self._scores = scores
+        
+        top = ordered[len(work) - len(pending)][1]
+        print(f"Prioritized {len(scores)} emails; first up: {self._short_subject(emails[top]) if top in emails else top}")
+        return [(self._position + i, message_id, skip) for i, (_, message_id, skip) in enumerate(ordered)]
+    
+    def _sender_decision(self, email):
+        """('skip' | 'demote' | None, reason) for an email, from the sender stats"""
+        if self.sender_policy is None or email['id'] in self._forced:
+            return None, None
+        return self.sender_policy.decide(email)
+    
+    def _skip_sender(self, email, reason, results):
+        """Record an email as skipped by sender stats; recover_skipped can bring it back"""
+        print(f"Skipping email from {reason}")
+        results['emails_sender_skipped'] += 1
+        EMAILS_SKIPPED.inc('sender')
+        self.row_buffer.add(ProcessedEmail(
+            user_id=self.user.id,
+            email_id=email['id'],
+            email_subject=email['subject'],
+            email_sender=sender_address(email.get('sender')),
+            processing_status='skipped',
+            error_message=f"Skipped: {reason}"
+        ))
+    
+    def _save_sender_stats(self):
+        """Add what this sync saw to the sender stats (best effort)"""
+        observations, self._sender_observations = self._sender_observations, SenderObservations()
+        try:
+            record_sender_stats(self.user.id, observations)
+        except Exception as e:
+            print(f"Error saving sender stats: {e}")
+    
+    def _skip(self, message_id, skip, results):
+        if skip == 'processed':
+            print(f"Skipping already processed email: {message_id}")
+            results['emails_skipped'] += 1  # Track skipped
+            EXTRACTION_CACHE_HITS.inc()
+        else:
+            print(f"Skipping email {message_id} until its retry is due")
+            results['emails_deferred'] += 1
+            EMAILS_SKIPPED.inc('deferred')
+    
+    def _budget_plan(self, email):
+        """BudgetPlan for extracting an email, or None when no cap applies (any thread)"""
+        if self.admission is None:
+            return None
+        return self.admission.plan(email, self._scores.get(email['id']), forced=email['id'] in self._forced)
+    
+    def _admit(self, message_id, results, email=None):
+        """
+        Fetch an email (unless given) and plan its extraction against the dollar caps
+        
+        Emails the plan holds back are deferred or skipped here (see BudgetAdmission.hold).
+        
+        Returns:
+            tuple: (email, BudgetPlan or None); the email is None if Gmail
+            didn't return it or it was held back
+        
+        Raises:
+            TRANSIENT_ERRORS: from fetching the email
+        """
+        if self.admission is not None:
+            # Past a cap there's no point fetching the email
+            plan = self.admission.exhausted()
+            if plan is not None:
+                self.admission.hold(message_id, email, plan, results)
+                return None, None
+        if email is None:
+            email = self._fetch(message_id)
+            if email is None:
+                results['emails_scanned'] -= 1
+                return None, None
+        if self._sender_decision(email)[0] == 'skip':
+            return email, None
+        plan = self._budget_plan(email)
+        if plan is not None and not plan.extract:
+            self.admission.hold(message_id, email, plan, results)
+            return None, None
+        return email, plan
+    
+    def _extract(self, email, plan=None, progress_callback=None):
+        if plan is not None and plan.cheap:
+            return self.extractor.extract_events(email, progress_callback=progress_callback, cheap=True)
+        return self.extractor.extract_events(email, progress_callback=progress_callback)
+    
+    def _fetch(self, message_id):
+        """Full email for message_id (None if Gmail can't return it)"""
+        email = self._prefetched.pop(message_id, None)
+        if email is not None:
+            return email
+        return self.gmail.get_email_details(message_id)
+    
+    def _sync_serial(self, work, results, progress_callback=None):
+        """Fetch, extract and write the emails one at a time"""
+        total_emails = len(self._message_ids)
+        for idx, message_id, skip in work:
+            self._check_cancelled()
+            n = idx + 1
+            
+            if skip:
+                self._skip(message_id, skip, results)
+                self._position = n
+                if progress_callback:
+                    progress_callback('processing', n, total_emails,
+                                      f'[processing] Email {n}/{total_emails}: skipped ({n}/{total_emails})')
+                continue
+            
+            if self._budget_spent(results):
+                break
+            
+            try:
+                email, plan = self._admit(message_id, results)
+            except TRANSIENT_ERRORS as e:
+                self._retry_later(message_id, None, e, results)
+                email, plan = None, None
+            
+            decision, reason = self._sender_decision(email) if email is not None else (None, None)
+            if decision == 'skip':
+                self._skip_sender(email, reason, results)
+            elif email is not None:
+                if progress_callback:
+                    progress_callback(
+                        'processing', 
+                        n, 
+                        total_emails, 
+                        f'[processing] Email {n}/{total_emails}: {self._short_subject(email)}... ({n}/{total_emails})'
+                    )
+                self._process_email(email, results, progress_callback, plan=plan)
+            
+            self._position = n
+            if self._should_flush():
+                self._flush_rows(results)
+    
+    def _budget_spent(self, results):
+        """True (and flagged in results) once this run has used up its budget"""
+        if self.cost_tracker.within_budget(self.budget.get('tokens'), self.budget.get('dollars')):
+            return False
+        if not results['budget_exhausted']:
+            print(f"Stopping sync for {self.user.email}: budget of {self.budget} used")
+        results['budget_exhausted'] = True
+        return True
+    
+    @staticmethod
+    def _short_subject(email):
+        return email['subject'][:50] + '...' if len(email['subject']) > 50 else email['subject']
+    
+    def _process_email(self, email, results, progress_callback=None, extraction=None, plan=None):
+        """
+        Extract events from one email, write them to the sink and buffer the DB rows
+        
+        Emails without new events are only buffered. An email with events is
+        committed first and its events are written to the sink afterwards
+        (on the pipeline's write pool, when it's running).
+        
+        Args:
+            extraction: Future for (events, token_usage) from the extraction pool;
+                        extracted here when None
+            plan: BudgetPlan the extraction was reserved under; released here
+        """
+        email_id = email['id']
+        token_usage = None
+        
+        try:
+            if extraction is not None:
+                events, token_usage = extraction.result()
+            else:
+                events, token_usage = self._extract(email, plan, progress_callback)
+            
+            write = self._record_extraction(email, events, token_usage, results)
+            if write is None:
+                return
+            
+            if self.pipeline is not None:
+                self.pipeline.submit_write(write)
+            else:
+                self._record_writes(write, self._write_events(write.events), results)
+            
+        except TRANSIENT_ERRORS as e:
+            self._retry_later(email_id, email['subject'], e, results)
+            
+        except Exception as e:
+            print(f"Error processing email {email_id}: {e}")
+            results['errors'].append(f"Email {email_id}: {str(e)}")
+            
+            # Still record as processed (with error) so we don't retry
+            self._record_failure(email_id, email['subject'], str(e))
+        
+        finally:
+            if plan is not None:
+                self.admission.release(plan, token_usage)
+    
+    def _record_failure(self, email_id, subject, error_message):
+        """Record an email as processed with an error, so no sync tries it again"""
+        self.row_buffer.add(ProcessedEmail(
+            user_id=self.user.id,
+            email_id=email_id,
+            email_subject=subject,
+            processing_status='error',
+            error_message=error_message
+        ))
+        self.retries.settle(email_id)
+    
+    def _retry_later(self, email_id, subject, error, results):
+        """Queue an email that failed transiently for a later sync, or record it as failed once it's had its attempts"""
+        attempts, delay = self.retries.failed(email_id, subject, error)
+        if delay is None:
+            print(f"Giving up on email {email_id} after {attempts} attempts: {error}")
+            results['errors'].append(f"Email {email_id}: gave up after {attempts} attempts: {str(error)}")
+            self._record_failure(email_id, subject or self.retries.subject(email_id), str(error))
+            return
+        
+        results['emails_retrying'] += 1
+        print(f"Email {email_id} failed transiently (attempt {attempts}), retrying in {delay}s: {error}")
+    
+    def _record_extraction(self, email, events, token_usage, results):
+        """
+        Account for an email's extracted events, drop duplicates and commit the email
+        
+        Returns:
+            _PendingWrite for the events to send to the sink, or None if there are none
+        """
+        email_id = email['id']
+        self.retries.settle(email_id)
+        
+        # Track costs
+        self.cost_tracker.add_openai_usage(
+            token_usage['input_tokens'],
+            token_usage['output_tokens'],
+            token_usage.get('model')
+        )
+        self.cost_tracker.emails_processed += 1
+        results['emails_processed'] += 1
+        self._sender_observations.add(email, len(events) > 0)
+        
+        # Record that we processed this email
+        processed = ProcessedEmail(
             user_id=self.user.id,
-            event_title=gcal_event['summary'],
-            start_datetime=datetime.fromisoformat(gcal_event['start']['dateTime'])
-        ).first()
+            email_id=email_id,
+            email_subject=email['subject'],
+            email_sender=sender_address(email.get('sender')),
+            events_count=len(events),
+            event_created=len(events) > 0
+        )
+        
+        # Format events and drop duplicates
+        pending = []
+        pending_entries = []
+        for event in events:
+            gcal_event = self.extractor.format_for_google_calendar(
+                event, 
+                email_id=email_id,
+                email_subject=email['subject']
+            )
+            
+            if not gcal_event:
+                continue
+            
+            duplicate = self._find_duplicate(gcal_event, results)
+            if duplicate:
+                print(f"Skipping duplicate event: {gcal_event['summary']}")
+                results['duplicates_skipped'] += 1
+                results['duplicates'].append(duplicate)
+                continue
+            
+            # Index it right away so later events in this sync dedupe against it
+            pending_entries.append(self._index_event(gcal_event))
+            pending.append(gcal_event)
+        
+        if not pending:
+            # Nothing goes to the calendar, so the row can wait for the next chunk
+            self.row_buffer.add(processed)
+            return None
+        
+        # Commit the email (and everything buffered before it) before creating
+        # anything in the calendar, so a crash or a re-run after a lost job
+        # lease finds it processed instead of creating its events twice
+        self.row_buffer.add(processed)
+        self._flush_rows(results)
+        if processed.id is None:
+            for entry in pending_entries:
+                self.dedup_index.remove(entry)
+            print(f"Could not record email {email_id}, not writing its events")
+            return None
         
-        return existing is not None
\ No newline at end of file
+        return _PendingWrite(processed, pending, pending_entries)
+    
+    def _write_events(self, events):
+        """Add one email's events to the calendar in one batch"""
+        try:
+            with span(self.timer, 'sink.write'):
+                write_results = self.sink.add_events(events)
+        except Exception as e:
+            return [WriteResult(error=e) for _ in events]
+        if self._first_event_at is None and any(result.ok for result in write_results):
+            self._first_event_at = time.monotonic()
+        return write_results
+    
+    def _record_writes(self, write, write_results, results):
+        """Buffer CalendarEvent rows for the events the sink accepted"""
+        for gcal_event, entry, write_result in zip(write.events, write.entries, write_results):
+            if not write_result.ok:
+                self.dedup_index.remove(entry)
+                print(f"Error adding event to calendar: {write_result.error}")
+                results['errors'].append(f"Calendar error: {str(write_result.error)}")
+                continue
+            
+            # Record the calendar event (written with the next chunk)
+            self.row_buffer.add(CalendarEvent(
+                user_id=self.user.id,
+                processed_email_id=write.processed.id,
+                gcal_event_id=write_result.event_id,
+                gcal_calendar_id=self.sink.calendar_id,
+                event_title=gcal_event['summary'],
+                start_datetime=datetime.fromisoformat(gcal_event['start']['dateTime']),
+                end_datetime=datetime.fromisoformat(gcal_event['end']['dateTime']),
+                location=gcal_event.get('location')
+            ))
+            
+            results['events_added'] += 1
+            results['events_extracted'] += 1
+            self.cost_tracker.events_extracted += 1
+            
+            if results['first_event_seconds'] is None and self._first_event_at is not None:
+                results['first_event_seconds'] = round(self._first_event_at - self._started, 3)
+    
+    def _settle_writes(self, results, entry=None):
+        """Record the pipeline's in-flight writes (see PipelinedSync.settle_writes); False if none"""
+        if self.pipeline is None:
+            return False
+        return self.pipeline.settle_writes(results, entry)
+    
+    def _should_flush(self):
+        """A full chunk is waiting, or the last save was SYNC_CHECKPOINT_SECONDS ago"""
+        return self.row_buffer.should_flush() or (
+            len(self.row_buffer) and time.monotonic() - self._last_flush >= Config.SYNC_CHECKPOINT_SECONDS
+        )
+    
+    def _flush_rows(self, results):
+        """
+        Write buffered ProcessedEmail/CalendarEvent rows in chunked transactions,
+        then drop settled retries and save the checkpoint
+        """
+        with span(self.timer, 'db.flush'):
+            for row, error in self.row_buffer.flush():
+                results['errors'].append(f"Database error ({type(row).__name__}): {str(error)}")
+            self.retries.drop_settled()
+        self._last_flush = time.monotonic()
+        if self.budget_guard is not None:
+            self.budget_guard.refresh_if_stale()
+        
+        self._save_checkpoint(results)
+    
+    def _save_checkpoint(self, results):
+        """Record this job's emails, position, results and costs so far"""
+        if self.job_id is None or self._message_ids is None:
+            return
+        
+        checkpoint = db.session.get(SyncCheckpoint, self.job_id)
+        if checkpoint is None:
+            checkpoint = SyncCheckpoint(job_id=self.job_id, message_ids=json.dumps(self._message_ids))
+            db.session.add(checkpoint)
+        checkpoint.position = self._position
+        checkpoint.results = json.dumps(results, default=str)
+        checkpoint.costs = json.dumps(self.cost_tracker.counters())
+        checkpoint.updated_at = datetime.utcnow()
+        with span(self.timer, 'db.checkpoint'):
+            db.session.commit()
+    
+    def _find_duplicate(self, gcal_event, results=None):
+        """
+        Check if this event (or a close variant of it) is already on the calendar
+        
+        A match against an event whose write is still in flight waits for that
+        write, since a failed write takes the event back out of the index.
+        
+        Returns:
+            dict describing the suppressed event and what it matched, or None
+        """
+        if self.dedup_index is None:
+            self.dedup_index = EventIntervalIndex.for_user(self.user.id)
+        
+        start = datetime.fromisoformat(gcal_event['start']['dateTime'])
+        end = datetime.fromisoformat(gcal_event['end']['dateTime'])
+        match = self.dedup_index.find_match(gcal_event['summary'], start, end)
+        while match and results is not None and self._settle_writes(results, entry=match):
+            match = self.dedup_index.find_match(gcal_event['summary'], start, end)
+        
+        if not match:
+            return None
+        
+        print(f"Matched existing event: {match.title} @ {match.start}")
+        return {
+            'title': gcal_event['summary'],
+            'start': start.isoformat(),
+            'matched_title': match.title,
+            'matched_start': match.start.isoformat(),
+            'matched_event_id': match.ref,
+            'similarity': round(title_similarity(title_tokens(gcal_event['summary']), match.tokens), 2)
+        }
+    
+    def _index_event(self, gcal_event):
+        """Add an event we're about to create to the duplicate index"""
+        return self.dedup_index.add(
+            gcal_event['summary'],
+            datetime.fromisoformat(gcal_event['start']['dateTime']),
+            datetime.fromisoformat(gcal_event['end']['dateTime'])
+        )
\ No newline at end of file
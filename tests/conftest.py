@@ -0,0 +1,43 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Config is read at import time: point the app at a scratch SQLite file and
+# keep the background threads off before anything imports it
+TEST_DIR = tempfile.mkdtemp(prefix='sift-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(TEST_DIR, 'sift.db')}"
+os.environ['BACKGROUND_SERVICES'] = 'false'
+os.environ['PROGRESS_BROKER'] = 'local'
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app import app as flask_app
+    return flask_app
+
+
+@pytest.fixture
+def db_session(app):
+    """A fresh schema for each test, with an app context pushed"""
+    from models import db
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        yield db.session
+        db.session.remove()
+
+
+@pytest.fixture
+def user(db_session):
+    from models import User
+
+    user = User(google_id='test-user', email='user@example.com', access_token='access', refresh_token='refresh')
+    db_session.add(user)
+    db_session.commit()
+    return user
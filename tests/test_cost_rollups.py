@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta
+
+from config import Config
+from cost_rollups import CostCompactor
+from cost_tracker import project_quota
+from models import SyncCost, SyncTiming
+
+
+def add_sync(db_session, user, sync_date):
+    sync_cost = SyncCost(user_id=user.id, sync_date=sync_date, gmail_api_calls=10, gmail_quota_units=50,
+                         calendar_api_calls=2, duration_seconds=10.0, rolled_up=True)
+    db_session.add(sync_cost)
+    db_session.flush()
+    db_session.add(SyncTiming(sync_cost_id=sync_cost.id, user_id=user.id, stage='gmail.get', count=10, errors=0,
+                              total_ms=100.0, p95_ms=20.0, max_ms=30.0))
+
+
+def test_windows_past_retention_are_capped_and_reported(app, db_session, user, monkeypatch):
+    monkeypatch.setattr(Config, 'COST_RETENTION_DAYS', 10)
+    now = datetime.utcnow()
+    for days_ago in (1, 5, 20):
+        add_sync(db_session, user, now - timedelta(days=days_ago))
+    db_session.commit()
+
+    before = project_quota(user.id, days=30, now=now)
+    assert CostCompactor(app, retention=timedelta(days=10)).run_once(now) == (0, 1)
+    after = project_quota(user.id, days=30, now=now)
+
+    # The 20-day-old sync was never in the window: the same numbers before and after compaction
+    assert before == after
+    assert after['days'] == 30
+    assert after['days_counted'] == 10
+    assert after['syncs'] == 2
+    assert after['gmail']['units_per_day']['used'] == 10.0
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user.id
+    timings = client.get('/costs/timings?days=30').get_json()
+    assert timings['days_counted'] == 10
+    assert timings['stages']['gmail.get']['syncs'] == 2
@@ -0,0 +1,44 @@
+import httplib2
+import pytest
+from google.oauth2.credentials import Credentials
+
+from google_clients import ApiUsage, GoogleClientFactory
+
+
+class RecordingTransport:
+    """Transport that answers every request with an empty JSON body and records it"""
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        self.requests.append((method, uri))
+        return httplib2.Response({'status': '200', 'content-type': 'application/json'}), b'{}'
+
+
+@pytest.mark.parametrize('api, version', [('gmail', 'v1'), ('calendar', 'v3'), ('oauth2', 'v2')])
+def test_builds_clients_without_fetching_discovery(api, version):
+    transport = RecordingTransport()
+    factory = GoogleClientFactory(transport=transport)
+
+    first = factory.build(api, version, Credentials(token='first'))
+    second = factory.build(api, version, Credentials(token='second'))
+
+    assert transport.requests == []
+    assert first._rootDesc is second._rootDesc
+
+
+def test_counting_http_counts_requests_and_quota_units():
+    transport = RecordingTransport()
+    usage = ApiUsage('gmail')
+    gmail = GoogleClientFactory(transport=transport).build('gmail', 'v1', Credentials(token='token'), usage=usage)
+
+    gmail.users().messages().list(userId='me').execute()
+    gmail.users().messages().get(userId='me', id='m1').execute()
+    gmail.users().messages().get(userId='me', id='m2').execute()
+
+    assert len(transport.requests) == 3
+    assert usage.summary() == {
+        'gmail.users.messages.list': {'requests': 1, 'retries': 0, 'quota_units': 5},
+        'gmail.users.messages.get': {'requests': 2, 'retries': 0, 'quota_units': 10}
+    }
@@ -0,0 +1,132 @@
+import multiprocessing
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from event_extractor import EventExtractor
+from job_queue import ACTIVE_STATUSES, SyncWorkerPool, claim_job, enqueue_sync
+from models import CalendarEvent, ProcessedEmail, SyncJob, User
+
+
+class FailingWorker:
+    """SyncWorker stand-in whose sync fails as a whole, the way run_sync reports it"""
+
+    def __init__(self, user, **kwargs):
+        pass
+
+    def run_sync(self, days=1, progress_callback=None):
+        return {'completed': False, 'errors': ['Gmail unavailable']}
+
+
+def test_failed_sync_is_recorded_as_an_error(app, user, db_session):
+    job_id = enqueue_sync(user.id).id
+    pool = SyncWorkerPool(app, size=0, worker_factory=FailingWorker)
+
+    pool.run_job(claim_job('test-worker'), 'test-worker')
+
+    db_session.expire_all()
+    job = db_session.get(SyncJob, job_id)
+    assert job.status == 'error'
+    assert job.error_message == 'Gmail unavailable'
+    assert user.last_sync is None
+
+
+class DemoGmail:
+    """Gmail stand-in: `emails` messages per user, `delay` seconds per API call"""
+
+    def __init__(self, user_id, emails, delay):
+        self.user_id = user_id
+        self.emails = emails
+        self.delay = delay
+
+    def list_message_ids(self, days=1, **kwargs):
+        time.sleep(self.delay)
+        return [f'u{self.user_id}-m{i}' for i in range(self.emails)]
+
+    def get_recent_emails(self, days=1, **kwargs):
+        return [self.get_email_details(message_id) for message_id in self.list_message_ids(days)]
+
+    def get_email_details(self, message_id):
+        time.sleep(self.delay)
+        return {'id': message_id, 'subject': f'Meeting {message_id}', 'sender': 'demo@example.com',
+                'date': '', 'body': '', 'snippet': ''}
+
+
+class DemoExtractor(EventExtractor):
+    """One distinct event per email, after `delay` seconds"""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def extract_events(self, email_data, progress_callback=None):
+        time.sleep(self.delay)
+        n = int(email_data['id'].rsplit('m', 1)[1])
+        start = (datetime.utcnow() + timedelta(days=1 + n)).replace(hour=9, minute=0, second=0, microsecond=0)
+        event = {'title': email_data['subject'], 'start_datetime': start.isoformat(),
+                 'end_datetime': (start + timedelta(hours=1)).isoformat()}
+        return [event], {'input_tokens': 0, 'output_tokens': 0, 'total_tokens': 0}
+
+
+def run_worker_process(index, emails, delay):
+    """One worker process: run jobs until none are queued or running"""
+    from app import app
+    from calendar_sinks import MemoryCalendarSink
+    from sync_worker import SyncWorker
+
+    def make_worker(user, **kwargs):
+        return SyncWorker(user, sink=MemoryCalendarSink(), gmail=DemoGmail(user.id, emails, delay),
+                          extractor=DemoExtractor(delay), **kwargs)
+
+    pool = SyncWorkerPool(app, size=0, lease_seconds=30, worker_factory=make_worker)
+    worker_id = f"{pool._node}:test{index}"
+    with app.app_context():
+        while True:
+            job = claim_job(worker_id, pool.lease_seconds)
+            if job:
+                pool.run_job(job, worker_id)
+                continue
+            if not SyncJob.query.filter(SyncJob.status.in_(ACTIVE_STATUSES)).count():
+                return
+            time.sleep(0.05)
+
+
+def test_worker_processes_run_every_job_once(app, db_session):
+    """
+    Several worker processes drain one queue
+
+    Every user gets two jobs of different kinds, as if a browser tab and the
+    scheduler asked for a sync at the same moment; the per-user 'sync' lease
+    must keep them from running at once.
+    """
+    users, emails, processes = 6, 8, 3
+    for i in range(users):
+        user = User(google_id=f'queue-{i}', email=f'queue{i}@example.com',
+                    access_token='access', refresh_token='refresh')
+        db_session.add(user)
+        db_session.commit()
+        enqueue_sync(user.id, params={'days': 1})
+        enqueue_sync(user.id, kind='resync', params={'days': 1})
+    db_session.remove()
+
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_worker_process, args=(i, emails, 0.01)) for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=120)
+    assert [worker.exitcode for worker in workers] == [0] * processes
+
+    jobs = SyncJob.query.all()
+    assert len(jobs) == 2 * users
+    assert {(job.status, job.attempts) for job in jobs} == {('complete', 1)}
+
+    duplicate_events = db_session.query(func.count()).select_from(
+        db_session.query(CalendarEvent.user_id).group_by(
+            CalendarEvent.user_id, CalendarEvent.event_title, CalendarEvent.start_datetime
+        ).having(func.count() > 1).subquery()
+    ).scalar()
+    assert duplicate_events == 0
+    assert CalendarEvent.query.count() == users * emails
+    assert ProcessedEmail.query.filter_by(processing_status='error').count() == 0
+    assert ProcessedEmail.query.count() == users * emails
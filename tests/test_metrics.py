@@ -0,0 +1,103 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+from metrics import RETIRED_FILE, Counter, Gauge, Histogram, MetricsRegistry
+
+
+def make_registry():
+    registry = MetricsRegistry()
+    syncs = Counter('syncs_total', 'Syncs', ('outcome',), registry=registry)
+    streams = Gauge('streams', 'Open streams', registry=registry)
+    latency = Histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0), registry=registry)
+    return registry, syncs, streams, latency
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def write_process(directory, pid, process, syncs, streams, written_at=None):
+    """A snapshot file as another process would write it"""
+    snapshot = {
+        'pid': pid,
+        'process': process,
+        'written_at': written_at if written_at is not None else time.time(),
+        'metrics': {
+            'syncs_total': [[['ok'], syncs]],
+            'streams': [[[], streams]],
+            'latency_seconds': [[[], [[syncs, 0, 0], 0.05 * syncs, syncs]]],
+        }
+    }
+    with open(os.path.join(directory, f'metrics-{pid}-{process}.json'), 'w') as f:
+        json.dump(snapshot, f)
+
+
+def values(body):
+    return {line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1])
+            for line in body.splitlines() if not line.startswith('#')}
+
+
+def test_dead_processes_are_folded_and_counters_stay_monotonic(tmp_path):
+    directory = str(tmp_path)
+    registry, syncs, streams, latency = make_registry()
+    syncs.inc('ok')
+    streams.set(1)
+    latency.observe(0.5)
+
+    # A process that exited; its pid now belongs to a live one
+    pid = os.getppid()
+    write_process(directory, pid, 'dead', syncs=3, streams=5, written_at=time.time() - 3600)
+    write_process(directory, pid, 'live', syncs=2, streams=1)
+
+    before = values(registry.render(directory))
+    assert before['syncs_total{outcome="ok"}'] == 6
+    assert before['streams'] == 2  # the dead process's gauge doesn't count
+    assert before['latency_seconds_count'] == 6
+
+    assert registry.compact(directory) == 1
+    assert sorted(os.listdir(directory)) == sorted(
+        [RETIRED_FILE, f'metrics-{pid}-live.json', '.metrics.lock'])
+    assert values(registry.render(directory)) == before
+
+    # Another new process that gets the same pid writes its own file
+    write_process(directory, pid, 'reused', syncs=1, streams=1)
+    after = values(registry.render(directory))
+    assert after['syncs_total{outcome="ok"}'] == 7
+    assert after['streams'] == 3
+    assert after['latency_seconds_count'] == 7
+
+    # Folding again adds to the retired totals instead of replacing them
+    write_process(directory, dead_pid(), 'exited', syncs=4, streams=1)
+    assert registry.compact(directory) == 1
+    final = values(registry.render(directory))
+    assert final['syncs_total{outcome="ok"}'] == 11
+    assert final['streams'] == 3
+
+
+def test_a_retired_process_file_written_late_is_not_counted_twice(tmp_path):
+    directory = str(tmp_path)
+    registry, syncs, streams, latency = make_registry()
+
+    pid = dead_pid()
+    write_process(directory, pid, 'dead', syncs=3, streams=0)
+    assert registry.compact(directory) == 1
+
+    write_process(directory, pid, 'dead', syncs=3, streams=0)
+    assert values(registry.render(directory))['syncs_total{outcome="ok"}'] == 3
+    assert registry.compact(directory) == 1
+    assert not os.path.exists(os.path.join(directory, f'metrics-{pid}-dead.json'))
+    assert values(registry.render(directory))['syncs_total{outcome="ok"}'] == 3
+
+
+def test_snapshot_files_are_named_by_process_id(tmp_path):
+    registry, syncs, streams, latency = make_registry()
+    registry.write_snapshot(str(tmp_path))
+
+    assert os.listdir(tmp_path) == [f'metrics-{os.getpid()}-{registry.process_id}.json']
+    # The process's own file is never folded
+    assert registry.compact(str(tmp_path)) == 0
@@ -0,0 +1,127 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from calendar_sinks import MemoryCalendarSink
+from config import Config
+from job_queue import SyncWorkerPool, claim_job
+from models import CalendarEvent, GmailWatch, SyncJob, User
+from push import pubsub_envelope, register_watch
+from sync_worker import SyncWorker
+from test_job_queue import DemoExtractor
+
+
+class LocalMailbox:
+    """
+    In-memory stand-in for a Gmail mailbox with the GmailService methods push syncs use
+
+    Every delivered message bumps the history ID, like Gmail does.
+    """
+
+    def __init__(self, email_address):
+        self.email_address = email_address
+        self.history_id = 1000
+        self.messages = {}  # id -> email dict
+        self.history = []  # (history_id, message id)
+        self._lock = threading.Lock()
+
+    def add(self, email):
+        with self._lock:
+            self.history_id += 1
+            self.messages[email['id']] = email
+            self.history.append((self.history_id, email['id']))
+            return self.history_id
+
+    def watch(self, topic_name, label_ids=('INBOX',)):
+        expiration = datetime.utcnow() + timedelta(days=7)
+        return {'historyId': str(self.history_id),
+                'expiration': str(int((expiration - datetime(1970, 1, 1)).total_seconds() * 1000))}
+
+    def stop_watch(self):
+        pass
+
+    def list_history(self, start_history_id, max_results=100):
+        with self._lock:
+            message_ids = [message_id for history_id, message_id in self.history if history_id > start_history_id]
+            return message_ids[:max_results], self.history_id
+
+    def list_message_ids(self, days=1, max_results=25, **kwargs):
+        with self._lock:
+            return [message_id for _, message_id in reversed(self.history)][:max_results]
+
+    def get_email_details(self, message_id):
+        return self.messages.get(message_id)
+
+
+class LocalNotifier:
+    """Stand-in for Gmail + Pub/Sub: delivers mail and POSTs the notification to the app's real webhook"""
+
+    def __init__(self, app):
+        self.app = app
+        self.mailboxes = {}  # lowercased address -> LocalMailbox
+
+    def mailbox(self, email_address):
+        return self.mailboxes.setdefault(email_address.lower(), LocalMailbox(email_address))
+
+    def deliver(self, email_address, email):
+        """Add `email` to the mailbox and notify the webhook; returns the HTTP status"""
+        history_id = self.mailbox(email_address).add(email)
+        with self.app.test_client() as client:
+            response = client.post(f'/gmail/push?token={Config.GMAIL_PUSH_TOKEN}',
+                                   json=pubsub_envelope(email_address, history_id))
+        return response.status_code
+
+
+@pytest.fixture
+def push_config(monkeypatch):
+    monkeypatch.setattr(Config, 'GMAIL_PUSH_TOKEN', 'test-token')
+    monkeypatch.setattr(Config, 'PUSH_DEBOUNCE_SECONDS', 30.0)
+    monkeypatch.setattr(Config, 'PUSH_MAX_DELAY_SECONDS', 300.0)
+
+
+def test_burst_of_notifications_is_one_push_job_per_user(app, db_session, push_config):
+    users, emails = 3, 5
+    notifier = LocalNotifier(app)
+    addresses = []
+    for i in range(users):
+        user = User(google_id=f'push-{i}', email=f'push{i}@example.com',
+                    access_token='access', refresh_token='refresh')
+        db_session.add(user)
+        db_session.commit()
+        register_watch(user, gmail=notifier.mailbox(user.email), topic='local')
+        addresses.append(user.email)
+
+    for n in range(emails):
+        for i, address in enumerate(addresses):
+            status = notifier.deliver(address, {
+                'id': f'u{i}-m{n}', 'subject': f'Invite {n}', 'sender': 'friend@example.com',
+                'date': '', 'body': '', 'snippet': 'tomorrow', 'labels': ['INBOX'], 'has_calendar': True
+            })
+            assert status == 204
+
+    jobs = SyncJob.query.filter_by(kind='push').all()
+    assert sorted(job.user_id for job in jobs) == sorted(user.id for user in User.query.all())
+    assert {job.status for job in jobs} == {'queued'}
+
+    # Debounced: nothing runs until the burst has been quiet for PUSH_DEBOUNCE_SECONDS
+    assert claim_job('test-worker') is None
+
+    def make_worker(user, **kwargs):
+        return SyncWorker(user, sink=MemoryCalendarSink(), gmail=notifier.mailbox(user.email),
+                          extractor=DemoExtractor(0), **kwargs)
+
+    SyncJob.query.update({'run_after': datetime.utcnow() - timedelta(seconds=1)})
+    db_session.commit()
+    pool = SyncWorkerPool(app, size=0, worker_factory=make_worker)
+    while True:
+        job = claim_job('test-worker')
+        if job is None:
+            break
+        pool.run_job(job, 'test-worker')
+
+    db_session.expire_all()
+    assert {(job.status, job.attempts) for job in SyncJob.query.filter_by(kind='push')} == {('complete', 1)}
+    assert SyncJob.query.count() == users
+    assert CalendarEvent.query.count() == users * emails
+    assert GmailWatch.query.filter(GmailWatch.pending_since.isnot(None)).count() == 0
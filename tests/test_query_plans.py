@@ -0,0 +1,34 @@
+import os
+
+import pytest
+from flask import Flask
+
+from models import db
+from migrations import check_query_plans
+
+# Set to a Postgres SQLAlchemy URL (e.g. postgresql://sift@localhost/sift_test) to check plans there too
+POSTGRES_URL = os.getenv('TEST_POSTGRES_URL')
+
+
+@pytest.fixture(params=['sqlite', 'postgresql'])
+def plan_app(request, tmp_path):
+    if request.param == 'postgresql':
+        if not POSTGRES_URL:
+            pytest.skip('TEST_POSTGRES_URL is not set')
+        url = POSTGRES_URL
+    else:
+        url = f"sqlite:///{tmp_path / 'plans.db'}"
+
+    plan_app = Flask(__name__)
+    plan_app.config['SQLALCHEMY_DATABASE_URI'] = url
+    db.init_app(plan_app)
+    with plan_app.app_context():
+        db.create_all()
+        yield plan_app
+        db.session.remove()
+        db.drop_all()
+
+
+def test_hot_queries_use_their_indexes(plan_app):
+    failures = check_query_plans(verbose=False)
+    assert failures == [], '\n'.join(f"{name} (expected {index}): {plan}" for name, index, plan in failures)
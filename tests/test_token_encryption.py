@@ -0,0 +1,44 @@
+import pytest
+from cryptography.fernet import Fernet
+
+import models
+from models import User, reencrypt_user_tokens
+
+
+@pytest.fixture
+def keys(monkeypatch):
+    """A new key and an old one, as ENCRYPTION_KEYS lists them after a rotation"""
+    new, old = Fernet.generate_key(), Fernet.generate_key()
+    monkeypatch.setattr(models, 'ENCRYPTION_KEYS', [new.decode(), old.decode()])
+    monkeypatch.setattr(models, '_cipher', None)
+    monkeypatch.setattr(models, '_fernets', None)
+    return Fernet(new), Fernet(old)
+
+
+def add_user(session, name, fernet):
+    user = User(google_id=name, email=f'{name}@example.com',
+                access_token=fernet.encrypt(f'{name}-access'.encode()).decode(),
+                refresh_token=fernet.encrypt(f'{name}-refresh'.encode()).decode())
+    session.add(user)
+    session.commit()
+    return user.id
+
+
+def test_rotates_old_tokens_and_skips_undecryptable_rows(db_session, keys):
+    new, old = keys
+    current_id = add_user(db_session, 'current', new)
+    old_id = add_user(db_session, 'old', old)
+    lost_id = add_user(db_session, 'lost', Fernet(Fernet.generate_key()))
+    lost_token = db_session.get(User, lost_id).access_token
+
+    assert reencrypt_user_tokens(batch_size=2) == (1, 1)
+
+    db_session.expire_all()
+    for user_id, name in ((current_id, 'current'), (old_id, 'old')):
+        user = db_session.get(User, user_id)
+        assert new.decrypt(user.access_token.encode()) == f'{name}-access'.encode()
+        assert new.decrypt(user.refresh_token.encode()) == f'{name}-refresh'.encode()
+    assert db_session.get(User, lost_id).access_token == lost_token
+
+    # Nothing left to rotate
+    assert reencrypt_user_tokens(batch_size=2) == (0, 1)
@@ -0,0 +1,18 @@
+from datetime import datetime, timedelta
+
+from models import User
+from token_refresher import TokenRefresher
+
+
+def test_dormant_tokens_do_not_crowd_out_due_ones(app, db_session):
+    now = datetime.utcnow()
+    for i in range(5):
+        db_session.add(User(google_id=f'dormant-{i}', email=f'dormant{i}@example.com', access_token='access', refresh_token='refresh',
+                            token_expiry=now - timedelta(days=30 + i)))
+    db_session.add(User(google_id='active', email='active@example.com', access_token='access', refresh_token='refresh',
+                        token_expiry=now + timedelta(minutes=5)))
+    db_session.commit()
+
+    refresher = TokenRefresher(app, horizon=timedelta(minutes=10), batch_size=2, max_expired=timedelta(days=7))
+
+    assert [user.email for user in refresher.due_users(now)] == ['active@example.com']
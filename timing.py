@@ -0,0 +1,90 @@
+from metrics import observe_call
+from contextlib import contextmanager
+import threading
+import time
+
+
+class StageTimer:
+    """
+    Wall-clock durations of a sync's external calls and DB writes, per stage
+
+    A span is one call: a Gmail request, an OpenAI completion, a Calendar
+    write, a DB commit. Spans are recorded from any thread (the pipelined
+    sync calls Gmail and OpenAI from pools), and summary() reduces them to
+    count, total and percentiles per stage, which is what SyncTiming stores.
+
+    Stage names are '<service>.<call>', e.g. 'gmail.get' or 'db.flush'.
+    Stages can nest: 'sink.write' includes the calendar.* calls a Google
+    sink makes. Gmail, Calendar and OpenAI spans are also exported to
+    /metrics (see metrics.observe_call).
+    """
+
+    def __init__(self):
+        self._samples = {}  # stage -> [seconds, ...]
+        self._errors = {}  # stage -> spans that raised
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage):
+        """Time the block as one call of `stage`; a block that raises counts as an error"""
+        start = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.record(stage, time.perf_counter() - start, ok)
+
+    def record(self, stage, seconds, ok=True):
+        with self._lock:
+            self._samples.setdefault(stage, []).append(seconds)
+            if not ok:
+                self._errors[stage] = self._errors.get(stage, 0) + 1
+        observe_call(stage, seconds, ok)
+
+    def summary(self):
+        """
+        Returns:
+            dict: stage -> count, errors, total_ms, p50_ms, p95_ms and max_ms
+        """
+        with self._lock:
+            samples = {stage: sorted(values) for stage, values in self._samples.items()}
+            errors = dict(self._errors)
+
+        summary = {}
+        for stage, values in sorted(samples.items()):
+            def percentile(p):
+                return values[min(len(values) - 1, int(p * len(values)))] * 1000
+
+            summary[stage] = {
+                'count': len(values),
+                'errors': errors.get(stage, 0),
+                'total_ms': round(sum(values) * 1000, 2),
+                'p50_ms': round(percentile(0.50), 2),
+                'p95_ms': round(percentile(0.95), 2),
+                'max_ms': round(values[-1] * 1000, 2)
+            }
+        return summary
+
+
+@contextmanager
+def _untimed_span(stage):
+    start = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        observe_call(stage, time.perf_counter() - start, ok)
+
+
+def span(timer, stage):
+    """timer.span(stage), or only the /metrics export when there's no timer (services used outside a sync)"""
+    return timer.span(stage) if timer is not None else _untimed_span(stage)
+
+
+def attach_timer(timer, *services):
+    """Point the services that support timing (a `timer` attribute) at `timer`"""
+    for service in services:
+        if service is not None and hasattr(service, 'timer'):
+            service.timer = timer
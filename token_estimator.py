@@ -0,0 +1,77 @@
+import math
+import re
+import threading
+
+try:
+    import tiktoken
+except ImportError:  # in requirements.txt; without it estimates fall back to a character heuristic
+    tiktoken = None
+
+
+# Chat format overhead (role and separators) per message, and for priming the reply
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_PRIMING_TOKENS = 3
+
+# Heuristic: English runs about 4 characters per token; words and punctuation
+# are at least a token each, which matters for short, symbol-heavy text
+CHARS_PER_TOKEN = 4
+PIECE_RE = re.compile(r"\w+|[^\w\s]")
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+
+def _encoding(model):
+    """tiktoken encoding for a model (None without tiktoken)"""
+    if tiktoken is None:
+        return None
+    encoding = _encodings.get(model)
+    if encoding is not None:
+        return encoding
+    with _encodings_lock:
+        encoding = _encodings.get(model)
+        if encoding is None:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                # Azure deployment or model name tiktoken doesn't know
+                encoding = tiktoken.get_encoding('cl100k_base')
+            _encodings[model] = encoding
+    return encoding
+
+
+def heuristic_tokens(text):
+    """Token count estimate without a tokenizer (errs on the high side)"""
+    if not text:
+        return 0
+    return max(math.ceil(len(text) / CHARS_PER_TOKEN), len(PIECE_RE.findall(text)))
+
+
+def count_tokens(text, model='gpt-4o'):
+    """Tokens in `text` for `model`: exact with tiktoken installed, else heuristic_tokens"""
+    encoding = _encoding(model)
+    if encoding is None:
+        return heuristic_tokens(text)
+    return len(encoding.encode(text or '', disallowed_special=()))
+
+
+def estimate_chat_tokens(messages, model='gpt-4o'):
+    """
+    Prompt tokens a chat completion request will be billed for
+
+    Args:
+        messages (list): [{'role': ..., 'content': ...}, ...] as sent to the API
+        model (str): Model name, for picking the tokenizer
+
+    Returns:
+        int
+    """
+    tokens = REPLY_PRIMING_TOKENS
+    for message in messages:
+        tokens += MESSAGE_OVERHEAD_TOKENS + count_tokens(message.get('content', ''), model)
+    return tokens
+
+
+def exact():
+    """Whether estimates use a real tokenizer"""
+    return tiktoken is not None
@@ -0,0 +1,201 @@
+from models import db, User
+from credential_cache import credential_cache
+from leases import lease_owner, acquire_lease, release_lease
+from collections import deque
+from datetime import datetime, timedelta
+import threading
+import time
+
+
+def due_users_query(until, since=None, exclude_ids=(), limit=20):
+    """
+    Users whose access token expires by `until`, soonest first
+
+    Args:
+        since (datetime, optional): Leave out tokens that expired before this
+            (dormant users, or grants that keep failing to refresh)
+    """
+    query = User.query.filter(
+        User.token_expiry.isnot(None),
+        User.token_expiry <= until
+    )
+    if since is not None:
+        query = query.filter(User.token_expiry >= since)
+    if exclude_ids:
+        query = query.filter(User.id.notin_(list(exclude_ids)))
+    return query.order_by(User.token_expiry).limit(limit)
+
+
+class TokenRefresher:
+    """
+    Background thread that refreshes access tokens before they expire
+
+    Every `interval` seconds it asks the database (via the token_expiry index)
+    for the users whose tokens expire within `horizon`, soonest first, and
+    refreshes up to `batch_size` of them at no more than `max_per_second`.
+    A user whose refresh fails is left alone for `failure_backoff` so a
+    revoked grant doesn't get retried every loop. Tokens that expired more
+    than `max_expired` ago aren't scanned at all: those users are dormant or
+    their grant is gone, and soonest-first they would otherwise fill every
+    batch ahead of active users. Their token is refreshed when they next
+    sign in or sync.
+
+    Every app process may run a refresher. Each user is claimed with a
+    'token_refresh' lease before refreshing it, and its expiry is re-read
+    after the claim, so a token that another process just refreshed is
+    skipped instead of being refreshed again.
+
+    Args:
+        app: Flask app (the thread needs an app context for the DB)
+        horizon (timedelta): Refresh tokens expiring within this window
+        interval (float): Seconds between scans
+        batch_size (int): Max users refreshed per scan
+        max_per_second (float): Rate limit on token endpoint calls
+        failure_backoff (timedelta): How long to skip a user after a failure
+        max_expired (timedelta): Skip tokens that expired longer ago than this
+    """
+
+    def __init__(self, app, horizon=timedelta(minutes=10), interval=60, batch_size=20,
+                 max_per_second=5, failure_backoff=timedelta(minutes=30), max_expired=timedelta(days=7)):
+        self.app = app
+        self.horizon = horizon
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_per_second = max_per_second
+        self.failure_backoff = failure_backoff
+        self.max_expired = max_expired
+
+        self._thread = None
+        self._stop = threading.Event()
+        self._retry_after = {}  # user_id -> datetime
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=1000)  # seconds per refresh
+        self.scans = 0
+        self.refreshed = 0
+        self.failures = 0
+        self.skipped_claimed = 0  # held by, or already refreshed by, another process
+        self.last_scan_at = None
+        self.last_error = None
+
+    def start(self):
+        """Start the background thread (no-op if already running)"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='token-refresher', daemon=True)
+        self._thread.start()
+        print(f"Token refresher started (horizon {self.horizon}, every {self.interval}s)")
+
+    def stop(self):
+        """Ask the thread to stop after the current refresh"""
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    self.run_once()
+            except Exception as e:
+                print(f"Token refresher scan failed: {e}")
+                with self._lock:
+                    self.last_error = str(e)
+            self._stop.wait(self.interval)
+
+    def due_users(self, now=None):
+        """Users whose tokens expire within the horizon, soonest first"""
+        now = now or datetime.utcnow()
+
+        # Forget backoffs that have run out; skip the rest in the query itself
+        self._retry_after = {uid: t for uid, t in self._retry_after.items() if t > now}
+
+        return due_users_query(now + self.horizon, now - self.max_expired, self._retry_after, self.batch_size).all()
+
+    def run_once(self):
+        """
+        Refresh one batch of soon-to-expire tokens
+
+        Returns:
+            int: Number of tokens refreshed
+        """
+        now = datetime.utcnow()
+        min_gap = 1.0 / self.max_per_second if self.max_per_second else 0
+        refreshed = 0
+        owner = lease_owner('token_refresh')
+
+        for user in self.due_users(now):
+            if self._stop.is_set():
+                break
+
+            if not self._claim(user, owner, now):
+                with self._lock:
+                    self.skipped_claimed += 1
+                continue
+
+            start = time.perf_counter()
+            try:
+                credential_cache.get(user, force_refresh=True)
+                elapsed = time.perf_counter() - start
+                self._retry_after.pop(user.id, None)
+                refreshed += 1
+                with self._lock:
+                    self._latencies.append(elapsed)
+                    self.refreshed += 1
+            except Exception as e:
+                elapsed = time.perf_counter() - start
+                print(f"Token refresh failed for user {user.id}: {e}")
+                self._retry_after[user.id] = now + self.failure_backoff
+                with self._lock:
+                    self._latencies.append(elapsed)
+                    self.failures += 1
+                    self.last_error = str(e)
+            finally:
+                release_lease(user.id, 'token_refresh', owner)
+
+            # Rate limit calls to the token endpoint
+            if min_gap > elapsed:
+                self._stop.wait(min_gap - elapsed)
+
+        with self._lock:
+            self.scans += 1
+            self.last_scan_at = datetime.utcnow()
+
+        return refreshed
+
+    def _claim(self, user, owner, now):
+        """Lease the user, then confirm its token still needs refreshing"""
+        if not acquire_lease(user.id, 'token_refresh', owner, ttl=timedelta(minutes=1)):
+            return False
+
+        # Another process may have refreshed it between our scan and the claim
+        db.session.refresh(user)
+        if user.token_expiry is None or user.token_expiry > now + self.horizon:
+            release_lease(user.id, 'token_refresh', owner)
+            return False
+        return True
+
+    def get_metrics(self):
+        """Refresh counts and latency stats (milliseconds)"""
+        with self._lock:
+            samples = sorted(self._latencies)
+            metrics = {
+                'running': bool(self._thread and self._thread.is_alive()),
+                'scans': self.scans,
+                'refreshed': self.refreshed,
+                'failures': self.failures,
+                'skipped_claimed': self.skipped_claimed,
+                'users_backing_off': len(self._retry_after),
+                'last_scan_at': self.last_scan_at.isoformat() if self.last_scan_at else None,
+                'last_error': self.last_error
+            }
+
+        if samples:
+            metrics['latency_ms'] = {
+                'count': len(samples),
+                'avg': round(sum(samples) / len(samples) * 1000, 2),
+                'p50': round(samples[int(0.50 * (len(samples) - 1))] * 1000, 2),
+                'p95': round(samples[int(0.95 * (len(samples) - 1))] * 1000, 2),
+                'max': round(samples[-1] * 1000, 2)
+            }
+
+        return metrics